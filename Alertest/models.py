@@ -1,165 +1,327 @@
-"""Classes for work."""
-
-import hashlib
-import hmac
-from base64 import b64encode
-from decimal import Decimal
-from typing import Self
-
-
-class Access:
-    """Class for store access condention to exchange."""
-
-    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
-        """Init access condention keys."""
-        self.key: str = key
-        self.secret: str = secret
-        self.passphrase: str = passphrase
-        self.base_uri: str = base_uri
-
-    def encrypted(self: Self, msg: str) -> str:
-        """Encrypted msg for exchange."""
-        return b64encode(
-            hmac.new(
-                self.secret.encode("utf-8"),
-                msg.encode("utf-8"),
-                hashlib.sha256,
-            ).digest(),
-        ).decode()
-
-
-class Token:
-    """Class for store token data for trade."""
-
-    def __init__(
-        self: Self,
-        currency: list,
-        ignore_currency: list,
-        base_keep: Decimal,
-        time_shift: str = "1hour",
-        base_stable: str = "USDT",
-    ) -> None:
-        """Init class for store trade tokens."""
-        self.trade_currency: list[str] = currency  # Tokens for trade in bot
-        self.ignore_currency: list[str] = ignore_currency
-        self.base_keep: Decimal = base_keep
-        self.base_stable: str = base_stable
-        self.time_shift: str = time_shift
-        self.borrow_size: Decimal = Decimal("0")
-        self.avail_size: Decimal = Decimal("0")
-
-        self.accept_tokens: list[str] = []  # tradable tokens
-        self.new_tokens: list[str] = (
-            []
-        )  # tokens that can be traded but are not in the bot
-        self.del_tokens: list[str] = (
-            []
-        )  # tokens that have been removed from the exchange
-        self.history: dict = {}
-
-    def init_history(self: Self) -> None:
-        """Init history."""
-        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
-
-    def get_candles_for_kline(self: Self, tokens: list) -> str:
-        """Get str candles for kline websocket."""
-        return ",".join(
-            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
-        )
-
-    def get_clear_borrow(self: Self) -> Decimal:
-        """Get clear borrow size."""
-        return self.borrow_size - self.avail_size
-
-    def get_percent_borrow(self: Self) -> int:
-        """Get percent of borrowing."""
-        return (
-            self.get_clear_borrow()
-            * 100
-            / (self.get_len_trade_currency() * self.base_keep)
-        )
-
-    def get_len_trade_currency(self: Self) -> int:
-        """Get len of trade_currency."""
-        return len(self.trade_currency)
-
-    def get_len_accept_tokens(self: Self) -> int:
-        """Get len of accept_tokens."""
-        return len(self.accept_tokens)
-
-    def get_len_del_tokens(self: Self) -> int:
-        """Get len del_tokens."""
-        return len(self.del_tokens)
-
-    def get_len_ignore_currency(self: Self) -> int:
-        """Get len of ignore_currency."""
-        return len(self.ignore_currency)
-
-    def get_len_new_tokens(self: Self) -> int:
-        """Get len of new_tokens."""
-        return len(self.new_tokens)
-
-    @staticmethod
-    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
-        """Remove postfix."""
-        return symbol.replace(postfix, "")
-
-    def save_accept_tokens(self: Self, all_token_in_excange: dict) -> None:
-        """Save all accepted token."""
-        self.accept_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if token_in_excange["isMarginEnabled"]
-            and token_in_excange["quoteCurrency"] == "USDT"
-            and Token.remove_postfix(token_in_excange["symbol"])
-            not in self.ignore_currency
-        ]
-
-    def save_new_tokens(self: Self, all_token_in_excange: dict) -> None:
-        """Get all new token for trade."""
-        self.new_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if token_in_excange["quoteCurrency"] == "USDT"
-            and token_in_excange["isMarginEnabled"]
-            and Token.remove_postfix(token_in_excange["symbol"])
-            not in self.trade_currency
-            and Token.remove_postfix(token_in_excange["symbol"])
-            not in self.ignore_currency
-        ]
-
-    def save_del_tokens(self: Self) -> None:
-        """."""
-        self.del_tokens = [
-            used for used in self.trade_currency if used not in self.accept_tokens
-        ]
-
-
-class Telegram:
-    """Class for store access to telegram."""
-
-    def __init__(self, telegram_bot_key: str, telegram_bot_chat_id: str) -> None:
-        """Init API KEY for telegram."""
-        self.telegram_bot_key = telegram_bot_key
-        self.telegram_bot_chat_id: list = telegram_bot_chat_id
-
-    def get_telegram_url(self: Self) -> str:
-        """Return telegram url."""
-        return f"https://api.telegram.org/bot{self.telegram_bot_key}/sendMessage"
-
-    def get_bot_chat_id(self: Self) -> list:
-        """Return list chat id users."""
-        return self.telegram_bot_chat_id
-
-    def get_telegram_msg(self: Self, token: Token) -> str:
-        """Prepare telegram msg."""
-        return f"""<b>KuCoin</b>
-
-<i>KEEP</i>:{token.base_keep}
-<i>USDT</i>:{token.avail_size:.2f}
-<i>BORROWING USDT</i>:{token.get_clear_borrow():.2f} ({token.get_percent_borrow():.2f}%)
-<i>ALL TOKENS</i>:{token.get_len_accept_tokens()}
-<i>USED TOKENS</i>({token.get_len_trade_currency()})
-<i>DELETED</i>({token.get_len_del_tokens()}):{",".join(token.del_tokens)}
-<i>NEW</i>({token.get_len_new_tokens()}):{",".join(token.new_tokens)}
-<i>IGNORE</i>({token.get_len_ignore_currency()}):{",".join(token.ignore_currency)}"""
+"""Classes for work."""
+
+import asyncio
+import hashlib
+import hmac
+from base64 import b64encode
+from collections.abc import Mapping
+from decimal import Decimal
+from time import monotonic, time
+from typing import Self
+
+import aiohttp
+from loguru import logger
+
+
+class Access:
+    """Class for store access condention to exchange."""
+
+    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
+        """Init access condention keys."""
+        self.key: str = key
+        self.secret: str = secret
+        self.passphrase: str = passphrase
+        self.base_uri: str = base_uri
+        # keyed once, each sign work on copy of this state
+        self.hmac_key = hmac.new(self.secret.encode("utf-8"), digestmod=hashlib.sha256)
+        self.encrypted_passphrase: str = self.encrypted(passphrase)
+        self.auth_headers: dict = {
+            "KC-API-PASSPHRASE": self.encrypted_passphrase,
+            "KC-API-KEY": self.key,
+            "Content-Type": "application/json",
+            "KC-API-KEY-VERSION": "2",
+            "User-Agent": "kucoin-python-sdk/2",
+        }
+
+    def encrypted(self: Self, msg: str) -> str:
+        """Encrypted msg for exchange."""
+        signer = self.hmac_key.copy()
+        signer.update(msg.encode("utf-8"))
+        return b64encode(signer.digest()).decode()
+
+    def get_auth_headers(self: Self, str_to_sign: str, now_time: str) -> dict:
+        """Get auth headers, only timestamp and sign computed per call."""
+        return {
+            **self.auth_headers,
+            "KC-API-SIGN": self.encrypted(f"{now_time}{str_to_sign}"),
+            "KC-API-TIMESTAMP": now_time,
+        }
+
+
+class HttpClient:
+    """Class for store long-lived pooled http session to exchange."""
+
+    def __init__(
+        self: Self,
+        limit: int = 100,
+        limit_per_host: int = 50,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: int = 75,
+        timeout: int = 10,
+    ) -> None:
+        """Init settings of connection pool."""
+        self.limit: int = limit
+        self.limit_per_host: int = limit_per_host
+        self.ttl_dns_cache: int = ttl_dns_cache
+        self.keepalive_timeout: int = keepalive_timeout
+        self.timeout: int = timeout
+        self.session: aiohttp.ClientSession | None = None
+
+    def get_session(self: Self) -> aiohttp.ClientSession:
+        """Get opened session or open new one with warm connection pool.
+
+        Session created lazily, because aiohttp need running event loop.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    ttl_dns_cache=self.ttl_dns_cache,
+                    use_dns_cache=True,
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self: Self) -> None:
+        """Close session and release all pooled connections."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+class RateLimit:
+    """Class for store client side rate limit of exchange.
+
+    Token bucket for each resource pool of exchange, refilled on reset of
+    pool window and corrected by gw-ratelimit headers from responses.
+    """
+
+    def __init__(
+        self: Self,
+        limits: dict | None = None,
+        window: float = 30,
+    ) -> None:
+        """Init pools by default quota for 30 seconds window."""
+        self.window: float = window
+        self.limits: dict[str, int] = limits or {
+            "spot": 4000,
+            "margin": 4000,
+            "management": 2000,
+            "public": 2000,
+        }
+        self.remaining: dict[str, int] = self.limits.copy()
+        self.reset_at: dict[str, float] = dict.fromkeys(
+            self.limits,
+            monotonic() + window,
+        )
+        self.locks: dict[str, asyncio.Lock] = {
+            pool: asyncio.Lock() for pool in self.limits
+        }
+
+    def refill(self: Self, pool: str) -> None:
+        """Refill pool if window of pool is over."""
+        if monotonic() >= self.reset_at[pool]:
+            self.remaining[pool] = self.limits[pool]
+            self.reset_at[pool] = monotonic() + self.window
+
+    async def acquire(self: Self, pool: str, weight: int = 1) -> None:
+        """Wait weight in pool, requests go out in order of call."""
+        async with self.locks[pool]:
+            self.refill(pool)
+            while self.remaining[pool] < weight:
+                logger.warning(f"Rate limit {pool}:wait to reset")
+                await asyncio.sleep(self.reset_at[pool] - monotonic())
+                self.refill(pool)
+            self.remaining[pool] -= weight
+
+    def update(self: Self, pool: str, headers: Mapping, code: str) -> None:
+        """Update pool by code and gw-ratelimit headers of response."""
+        if code == "429000":  # pool is empty till reset
+            self.remaining[pool] = 0
+
+        self.update_by_headers(pool, headers)
+
+    def update_by_headers(self: Self, pool: str, headers: Mapping) -> None:
+        """Update pool by gw-ratelimit headers of response."""
+        if "gw-ratelimit-remaining" not in headers:
+            return
+
+        self.limits[pool] = int(headers["gw-ratelimit-limit"])
+        self.remaining[pool] = min(
+            self.remaining[pool],
+            int(headers["gw-ratelimit-remaining"]),
+        )
+        self.reset_at[pool] = monotonic() + int(headers["gw-ratelimit-reset"]) / 1000
+
+
+class Clock:
+    """Class for store offset of local clock to exchange server clock.
+
+    Offset estimated from samples of server timestamp, compensated by half
+    of round trip and smoothed by exponential moving average.
+    """
+
+    def __init__(self: Self, alpha: float = 0.2, max_rtt: float = 1000) -> None:
+        """Init clock without offset."""
+        self.alpha: float = alpha
+        self.max_rtt: float = max_rtt  # ms, samples with longer round trip ignored
+        self.offset: float = 0  # ms, server minus local
+        self.samples: int = 0
+
+    def add_sample(
+        self: Self,
+        server_time: int,
+        sent_at: float,
+        received_at: float,
+    ) -> None:
+        """Add server time in ms, requested between local sent_at and received_at."""
+        if received_at - sent_at > self.max_rtt:
+            logger.warning(f"Skip clock sample:rtt {received_at - sent_at:.0f} ms")
+            return
+
+        alpha = max(self.alpha, 1 / (self.samples + 1))  # first sample as is
+        self.offset += alpha * (server_time - (sent_at + received_at) / 2 - self.offset)
+        self.samples += 1
+
+    def get_timestamp(self: Self) -> str:
+        """Get corrected timestamp in ms for sign request."""
+        return str(int(time() * 1000 + self.offset))
+
+
+class Token:
+    """Class for store token data for trade."""
+
+    def __init__(
+        self: Self,
+        currency: list,
+        ignore_currency: list,
+        base_keep: Decimal,
+        time_shift: str = "1hour",
+        base_stable: str = "USDT",
+    ) -> None:
+        """Init class for store trade tokens."""
+        self.trade_currency: list[str] = currency  # Tokens for trade in bot
+        self.ignore_currency: list[str] = ignore_currency
+        self.base_keep: Decimal = base_keep
+        self.base_stable: str = base_stable
+        self.time_shift: str = time_shift
+        self.borrow_size: Decimal = Decimal("0")
+        self.avail_size: Decimal = Decimal("0")
+
+        self.accept_tokens: list[str] = []  # tradable tokens
+        self.new_tokens: list[str] = (
+            []
+        )  # tokens that can be traded but are not in the bot
+        self.del_tokens: list[str] = (
+            []
+        )  # tokens that have been removed from the exchange
+        self.history: dict = {}
+
+    def init_history(self: Self) -> None:
+        """Init history."""
+        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
+
+    def get_candles_for_kline(self: Self, tokens: list) -> str:
+        """Get str candles for kline websocket."""
+        return ",".join(
+            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
+        )
+
+    def get_clear_borrow(self: Self) -> Decimal:
+        """Get clear borrow size."""
+        return self.borrow_size - self.avail_size
+
+    def get_percent_borrow(self: Self) -> int:
+        """Get percent of borrowing."""
+        return (
+            self.get_clear_borrow()
+            * 100
+            / (self.get_len_trade_currency() * self.base_keep)
+        )
+
+    def get_len_trade_currency(self: Self) -> int:
+        """Get len of trade_currency."""
+        return len(self.trade_currency)
+
+    def get_len_accept_tokens(self: Self) -> int:
+        """Get len of accept_tokens."""
+        return len(self.accept_tokens)
+
+    def get_len_del_tokens(self: Self) -> int:
+        """Get len del_tokens."""
+        return len(self.del_tokens)
+
+    def get_len_ignore_currency(self: Self) -> int:
+        """Get len of ignore_currency."""
+        return len(self.ignore_currency)
+
+    def get_len_new_tokens(self: Self) -> int:
+        """Get len of new_tokens."""
+        return len(self.new_tokens)
+
+    @staticmethod
+    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
+        """Remove postfix."""
+        return symbol.replace(postfix, "")
+
+    def save_accept_tokens(self: Self, all_token_in_excange: dict) -> None:
+        """Save all accepted token."""
+        self.accept_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if token_in_excange["isMarginEnabled"]
+            and token_in_excange["quoteCurrency"] == "USDT"
+            and Token.remove_postfix(token_in_excange["symbol"])
+            not in self.ignore_currency
+        ]
+
+    def save_new_tokens(self: Self, all_token_in_excange: dict) -> None:
+        """Get all new token for trade."""
+        self.new_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if token_in_excange["quoteCurrency"] == "USDT"
+            and token_in_excange["isMarginEnabled"]
+            and Token.remove_postfix(token_in_excange["symbol"])
+            not in self.trade_currency
+            and Token.remove_postfix(token_in_excange["symbol"])
+            not in self.ignore_currency
+        ]
+
+    def save_del_tokens(self: Self) -> None:
+        """."""
+        self.del_tokens = [
+            used for used in self.trade_currency if used not in self.accept_tokens
+        ]
+
+
+class Telegram:
+    """Class for store access to telegram."""
+
+    def __init__(self, telegram_bot_key: str, telegram_bot_chat_id: str) -> None:
+        """Init API KEY for telegram."""
+        self.telegram_bot_key = telegram_bot_key
+        self.telegram_bot_chat_id: list = telegram_bot_chat_id
+
+    def get_telegram_url(self: Self) -> str:
+        """Return telegram url."""
+        return f"https://api.telegram.org/bot{self.telegram_bot_key}/sendMessage"
+
+    def get_bot_chat_id(self: Self) -> list:
+        """Return list chat id users."""
+        return self.telegram_bot_chat_id
+
+    def get_telegram_msg(self: Self, token: Token) -> str:
+        """Prepare telegram msg."""
+        return f"""<b>KuCoin</b>
+
+<i>KEEP</i>:{token.base_keep}
+<i>USDT</i>:{token.avail_size:.2f}
+<i>BORROWING USDT</i>:{token.get_clear_borrow():.2f} ({token.get_percent_borrow():.2f}%)
+<i>ALL TOKENS</i>:{token.get_len_accept_tokens()}
+<i>USED TOKENS</i>({token.get_len_trade_currency()})
+<i>DELETED</i>({token.get_len_del_tokens()}):{",".join(token.del_tokens)}
+<i>NEW</i>({token.get_len_new_tokens()}):{",".join(token.new_tokens)}
+<i>IGNORE</i>({token.get_len_ignore_currency()}):{",".join(token.ignore_currency)}"""
@@ -1,164 +1,200 @@
-"""Tools for Alertest."""
-
-from datetime import UTC, datetime
-from time import time
-from urllib.parse import urljoin
-
-import aiohttp
-from loguru import logger
-from orjson import loads
-
-from models import Access, Telegram
-
-
-def get_data_json(params: dict) -> str:
-    """Convert dict to url params."""
-    data_json = ""
-
-    data_json += "&".join([f"{key}={params[key]}" for key in sorted(params)])
-    return data_json
-
-
-async def request(
-    url: str,
-    method: str,
-    headers: dict,
-    *,
-    data_json: str | None = None,
-) -> dict:
-    """Universal http reqponse."""
-    async with (
-        aiohttp.ClientSession(headers=headers) as session,
-        session.request(method, url, data=data_json) as response,
-    ):
-        res = await response.read()  # bytes
-        data = loads(res)  # dict ['code':str, 'data':dict]
-
-        match data["code"]:
-            case "200000":
-                result = data["data"]
-                logger.success(f"{response.status}:{method}:{url}")
-            case _:
-                logger.warning(f"{response.status}:{method}:{url}:{headers}")
-                result = {}
-
-        return result
-
-
-def get_headers(
-    access: Access = None,
-    str_to_sign: str = "",
-    now_time: str = "",
-    *,
-    auth: bool = True,
-) -> dict:
-    """Get headers for request."""
-    if auth:
-        result = {
-            "KC-API-SIGN": access.encrypted(str_to_sign),
-            "KC-API-TIMESTAMP": now_time,
-            "KC-API-PASSPHRASE": access.encrypted(access.passphrase),
-            "KC-API-KEY": access.key,
-            "Content-Type": "application/json",
-            "KC-API-KEY-VERSION": "2",
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-    else:
-        result = {
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-
-    return result
-
-
-async def get_symbol_list(
-    access: Access,
-    *,
-    method: str = "GET",
-    uri: str = "/api/v2/symbols",
-) -> dict:
-    """Get all tokens in excange."""
-    logger.info("Run get_symbol_list")
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(auth=False),
-    )
-
-
-async def get_margin_account(
-    access: Access,
-    params: dict,
-    *,
-    method: str = "GET",
-    uri: str = "/api/v3/margin/accounts",
-) -> dict:
-    """Get margin account user data."""
-    logger.info("Run get_margin_account")
-
-    uri += "?" + get_data_json(params)
-    now_time = str(int(time()) * 1000)
-
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(
-            access,
-            f"{now_time}{method}{uri}",
-            now_time,
-        ),
-    )
-
-
-async def send_telegram_msg(telegram: Telegram, text: str) -> None:
-    """Send msg to telegram."""
-    for chat_id in telegram.get_bot_chat_id():
-        async with (
-            aiohttp.ClientSession() as session,
-            session.post(
-                telegram.get_telegram_url(),
-                json={
-                    "chat_id": chat_id,
-                    "parse_mode": "HTML",
-                    "disable_notification": True,
-                    "text": text,
-                },
-            ),
-        ):
-            pass
-
-
-def get_seconds_to_next_minutes(minutes: int) -> int:
-    """Get next 10:00 minutes."""
-    logger.info("Run get_seconds_to_next_minutes")
-
-    now = datetime.now(tz=UTC)
-
-    if now.minute >= minutes:
-        result_minute = 60 - now.minute + minutes
-    else:
-        result_minute = minutes - now.minute
-
-    return result_minute * 60
-
-
-async def get_server_timestamp(
-    access: Access,
-    *,
-    uri: str = "/api/v1/timestamp",
-    method: str = "GET",
-) -> dict:
-    """Get timestamp from excange server."""
-    logger.info("Run get_server_timestamp")
-
-    now_time = str(int(time()) * 1000)
-
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(
-            access,
-            f"{now_time}{method}{uri}",
-            now_time,
-        ),
-    )
+"""Tools for Alertest."""
+
+import asyncio
+from collections.abc import Callable
+from datetime import UTC, datetime
+from functools import partial
+from time import time
+from urllib.parse import urljoin
+
+from loguru import logger
+from orjson import loads
+
+from models import Access, Clock, HttpClient, RateLimit, Telegram
+
+clock = Clock()
+http_client = HttpClient()
+rate_limit = RateLimit()
+
+PUBLIC_HEADERS = {"User-Agent": "kucoin-python-sdk/2"}
+
+
+def get_data_json(params: dict) -> str:
+    """Convert dict to url params."""
+    data_json = ""
+
+    data_json += "&".join([f"{key}={params[key]}" for key in sorted(params)])
+    return data_json
+
+
+async def request(
+    url: str,
+    method: str,
+    headers: Callable[[], dict],
+    *,
+    data_json: str | None = None,
+    pool: tuple[str, int] = ("public", 1),
+) -> dict:
+    """Universal http reqponse.
+
+    Request wait own weight in rate limit pool, headers signed after wait.
+    """
+    await rate_limit.acquire(*pool)
+
+    async with http_client.get_session().request(
+        method,
+        url,
+        headers=headers(),
+        data=data_json,
+    ) as response:
+        res = await response.read()  # bytes
+        data = loads(res)  # dict ['code':str, 'data':dict]
+        rate_limit.update(pool[0], response.headers, data["code"])
+
+        match data["code"]:
+            case "200000":
+                result = data["data"]
+                logger.success(f"{response.status}:{method}:{url}")
+            case _:
+                logger.warning(f"{response.status}:{method}:{url}:{data}")
+                result = {}
+
+        return result
+
+
+def get_headers(
+    access: Access = None,
+    str_to_sign: str = "",
+    *,
+    auth: bool = True,
+) -> dict:
+    """Get headers for request.
+
+    str_to_sign is method, uri and body of request without timestamp.
+    """
+    if auth:
+        result = access.get_auth_headers(str_to_sign, clock.get_timestamp())
+    else:
+        result = PUBLIC_HEADERS
+
+    return result
+
+
+async def get_symbol_list(
+    access: Access,
+    *,
+    method: str = "GET",
+    uri: str = "/api/v2/symbols",
+    pool: tuple[str, int] = ("public", 4),  # rate limit pool and weight
+) -> dict:
+    """Get all tokens in excange."""
+    logger.info("Run get_symbol_list")
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+    )
+
+
+async def get_margin_account(
+    access: Access,
+    params: dict,
+    *,
+    method: str = "GET",
+    uri: str = "/api/v3/margin/accounts",
+    pool: tuple[str, int] = ("margin", 15),  # rate limit pool and weight
+) -> dict:
+    """Get margin account user data."""
+    logger.info("Run get_margin_account")
+
+    uri += "?" + get_data_json(params)
+
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}"),
+        pool=pool,
+    )
+
+
+async def send_telegram_msg(telegram: Telegram, text: str) -> None:
+    """Send msg to telegram."""
+    for chat_id in telegram.get_bot_chat_id():
+        async with http_client.get_session().post(
+            telegram.get_telegram_url(),
+            json={
+                "chat_id": chat_id,
+                "parse_mode": "HTML",
+                "disable_notification": True,
+                "text": text,
+            },
+        ):
+            pass
+
+
+def get_seconds_to_next_minutes(minutes: int) -> int:
+    """Get next 10:00 minutes."""
+    logger.info("Run get_seconds_to_next_minutes")
+
+    now = datetime.now(tz=UTC)
+
+    if now.minute >= minutes:
+        result_minute = 60 - now.minute + minutes
+    else:
+        result_minute = minutes - now.minute
+
+    return result_minute * 60
+
+
+async def get_server_timestamp(
+    access: Access,
+    *,
+    uri: str = "/api/v1/timestamp",
+    method: str = "GET",
+    pool: tuple[str, int] = ("public", 3),  # rate limit pool and weight
+) -> dict:
+    """Get timestamp from excange server."""
+    logger.info("Run get_server_timestamp")
+
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+    )
+
+
+async def update_clock(access: Access) -> None:
+    """Add one sample of server time to clock."""
+    sent_at = time() * 1000
+    server_time = await get_server_timestamp(access)
+    received_at = time() * 1000
+
+    if server_time:
+        clock.add_sample(server_time, sent_at, received_at)
+        logger.info(f"Clock offset:{clock.offset:.0f} ms")
+
+
+async def try_update_clock(access: Access) -> None:
+    """Add one sample of server time, its failure is only logged."""
+    try:
+        await update_clock(access)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def init_clock(access: Access, samples: int = 3) -> None:
+    """Take first samples of server time one by one for fast start."""
+    for _ in range(samples):
+        await update_clock(access)
+
+
+async def sync_clock(access: Access, interval: int = 60) -> None:
+    """Sync clock with exchange server in infinity loop.
+
+    Sample by interval also keep pooled connection to exchange warm.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await try_update_clock(access)
@@ -0,0 +1,138 @@
+"""Microbenchmarks for Balancer hot paths.
+
+Run inside Balancer directory: python benchmark.py
+"""
+
+from collections.abc import Callable
+from time import perf_counter_ns
+
+import orjson
+
+from schemas import decode_balance, symbol_list_decoder
+
+ROUNDS = 100_000
+
+BALANCE = orjson.dumps(
+    {
+        "type": "message",
+        "topic": "/account/balance",
+        "subject": "account.balance",
+        "channelType": "private",
+        "data": {
+            "accountId": "5bd6e9286d99522a52e458de",
+            "available": "12.5",
+            "availableChange": "-0.5",
+            "currency": "BTC",
+            "hold": "0.5",
+            "holdChange": "0.5",
+            "relationContext": {
+                "symbol": "BTC-USDT",
+                "orderId": "5c1d3f0f7d5ff7ec1bc8a4d4",
+            },
+            "relationEvent": "margin.hold",
+            "relationEventId": "354689988084000",
+            "time": "1700000000000",
+            "total": "13",
+        },
+    },
+)
+
+SYMBOLS = orjson.dumps(
+    {
+        "code": "200000",
+        "data": [
+            {
+                "symbol": f"T{number}-USDT",
+                "name": f"T{number}-USDT",
+                "baseCurrency": f"T{number}",
+                "quoteCurrency": "USDT",
+                "feeCurrency": "USDT",
+                "market": "USDS",
+                "baseMinSize": "0.1",
+                "quoteMinSize": "0.1",
+                "baseMaxSize": "10000000000",
+                "quoteMaxSize": "99999999",
+                "baseIncrement": "0.0001",
+                "quoteIncrement": "0.000001",
+                "priceIncrement": "0.000001",
+                "priceLimitRate": "0.1",
+                "minFunds": "0.1",
+                "isMarginEnabled": True,
+                "enableTrading": True,
+                "feeCategory": 1,
+                "makerFeeCoefficient": "1.00",
+                "takerFeeCoefficient": "1.00",
+                "st": False,
+            }
+            for number in range(2000)
+        ],
+    },
+)
+
+
+def timeit_ns(func: Callable, rounds: int = ROUNDS) -> float:
+    """Get mean ns per one call of func."""
+    start = perf_counter_ns()
+    for _ in range(rounds):
+        func()
+    return (perf_counter_ns() - start) / rounds
+
+
+def report(name: str, before: float, after: float, unit: str = "ns") -> None:
+    """Print result of one benchmark."""
+    print(  # noqa: T201
+        f"{name:<24}before:{before:>10.0f} {unit}\tafter:{after:>10.0f} {unit}"
+        f"\tx{before / after:.2f}",
+    )
+
+
+def legacy_balance(recv: bytes) -> tuple[str, str, str]:
+    """Currency, available and event as before: text frame to dict."""
+    data = orjson.loads(recv.decode())["data"]
+    return data["currency"], data["available"], data["relationEvent"]
+
+
+def balance(recv: bytes) -> tuple[str, str, str]:
+    """Currency, available and event by typed struct from bytes."""
+    data = decode_balance(recv)
+    return data.currency, data.available, data.relation_event
+
+
+def legacy_symbols(res: bytes) -> list[tuple[str, str, str]]:
+    """Currencies and increment of symbols as before: body to dict."""
+    return [
+        (symbol["baseCurrency"], symbol["quoteCurrency"], symbol["baseIncrement"])
+        for symbol in orjson.loads(res)["data"]
+    ]
+
+
+def symbols(res: bytes) -> list[tuple[str, str, str]]:
+    """Currencies and increment of symbols by typed structs."""
+    return [
+        (symbol.base_currency, symbol.quote_currency, symbol.base_increment)
+        for symbol in symbol_list_decoder.decode(res).data
+    ]
+
+
+def bench_decode() -> None:
+    """Decode cost of balance frame and symbol list response."""
+    if legacy_balance(BALANCE) != balance(BALANCE) or legacy_symbols(
+        SYMBOLS,
+    ) != symbols(SYMBOLS):
+        msg = "Typed payload differ from dict payload"
+        raise ValueError(msg)
+
+    report(
+        "balance frame",
+        timeit_ns(lambda: legacy_balance(BALANCE)),
+        timeit_ns(lambda: balance(BALANCE)),
+    )
+    report(
+        "symbol list 2000",
+        timeit_ns(lambda: legacy_symbols(SYMBOLS), 100),
+        timeit_ns(lambda: symbols(SYMBOLS), 100),
+    )
+
+
+if __name__ == "__main__":
+    bench_decode()
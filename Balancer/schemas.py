@@ -0,0 +1,72 @@
+"""Typed schemas of exchange payloads decoded straight from bytes."""
+
+from typing import Any
+
+from loguru import logger
+from msgspec import DecodeError, Struct
+from msgspec.json import Decoder
+
+
+class Response(Struct, gc=False):
+    """Body of REST response, data is absent in error."""
+
+    code: str
+    data: Any = {}
+    msg: str = ""
+
+
+class Account(Struct, gc=False):
+    """Account of currency."""
+
+    currency: str
+    available: str
+
+
+class Symbol(Struct, gc=False, rename="camel"):
+    """Symbol of exchange."""
+
+    base_currency: str
+    quote_currency: str
+    base_increment: str
+
+
+class AccountList(Response, gc=False):
+    """Body of account list response."""
+
+    data: list[Account] = []
+
+
+class SymbolList(Response, gc=False):
+    """Body of symbol list response."""
+
+    data: list[Symbol] = []
+
+
+class Balance(Struct, gc=False, rename="camel"):
+    """Change of balance of currency."""
+
+    currency: str
+    available: str
+    relation_event: str
+
+
+class BalanceFrame(Struct, gc=False):
+    """Websocket frame, only message frame has balance in data."""
+
+    type: str
+    data: Balance | None = None
+
+
+response_decoder = Decoder(Response)
+account_list_decoder = Decoder(AccountList)
+symbol_list_decoder = Decoder(SymbolList)
+balance_frame_decoder = Decoder(BalanceFrame)
+
+
+def decode_balance(recv: bytes) -> Balance | None:
+    """Get balance from frame, None for acks, pongs and malformed frames."""
+    try:
+        return balance_frame_decoder.decode(recv).data
+    except DecodeError as e:
+        logger.warning(f"Skip frame:{e}:{recv[:200]}")
+        return None
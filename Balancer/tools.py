@@ -1,131 +1,195 @@
-"""Tools for Balancer."""
-
-from time import time
-from urllib.parse import urljoin
-
-import aiohttp
-from loguru import logger
-from orjson import loads
-
-from models import Access
-
-
-def get_data_json(params: dict) -> str:
-    """Convert dict to url params."""
-    data_json = ""
-
-    data_json += "&".join([f"{key}={params[key]}" for key in sorted(params)])
-    return data_json
-
-
-async def request(
-    url: str,
-    method: str,
-    headers: dict,
-    *,
-    data_json: str | None = None,
-) -> dict:
-    """Universal http reqponse."""
-    async with (
-        aiohttp.ClientSession(headers=headers) as session,
-        session.request(method, url, data=data_json) as response,
-    ):
-        res = await response.read()  # bytes
-        data = loads(res)  # dict ['code':str, 'data':dict]
-
-        match data["code"]:
-            case "200000":
-                result = data["data"]
-                logger.success(f"{response.status}:{method}:{url}")
-            case _:
-                logger.warning(f"{response.status}:{method}:{url}:{headers}")
-                result = {}
-
-        return result
-
-
-def get_headers(
-    access: Access = None,
-    str_to_sign: str = "",
-    now_time: str = "",
-    *,
-    auth: bool = True,
-) -> dict:
-    """Get headers for request."""
-    if auth:
-        result = {
-            "KC-API-SIGN": access.encrypted(str_to_sign),
-            "KC-API-TIMESTAMP": now_time,
-            "KC-API-PASSPHRASE": access.encrypted(access.passphrase),
-            "KC-API-KEY": access.key,
-            "Content-Type": "application/json",
-            "KC-API-KEY-VERSION": "2",
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-    else:
-        result = {
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-
-    return result
-
-
-async def get_account_list(
-    access: Access,
-    params: dict,
-    *,
-    method: str = "GET",
-    uri: str = "/api/v1/accounts",
-) -> dict:
-    """Get margin account list token."""
-    logger.info("Run get_account_list")
-
-    uri += "?" + get_data_json(params)
-
-    now_time = str(int(time()) * 1000)
-
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(
-            access,
-            f"{now_time}{method}{uri}",
-            now_time,
-        ),
-    )
-
-
-async def get_symbol_list(
-    access: Access,
-    *,
-    uri: str = "/api/v2/symbols",
-    method: str = "GET",
-) -> dict:
-    """Get all tokens in excange."""
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(auth=False),
-    )
-
-
-async def get_private_token(
-    access: Access,
-    *,
-    method: str = "POST",
-    uri: str = "/api/v1/bullet-private",
-) -> dict:
-    """Get margin account list token."""
-    logger.info("Run get_private_token")
-
-    now_time = str(int(time()) * 1000)
-
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(
-            access,
-            f"{now_time}{method}{uri}",
-            now_time,
-        ),
-    )
+"""Tools for Balancer."""
+
+import asyncio
+from collections.abc import Callable
+from functools import partial
+from time import time
+from urllib.parse import urljoin
+
+from loguru import logger
+from msgspec.json import Decoder
+
+from models import Access, Clock, HttpClient, RateLimit
+from schemas import (
+    Account,
+    Response,
+    Symbol,
+    account_list_decoder,
+    response_decoder,
+    symbol_list_decoder,
+)
+
+clock = Clock()
+http_client = HttpClient()
+rate_limit = RateLimit()
+
+PUBLIC_HEADERS = {"User-Agent": "kucoin-python-sdk/2"}
+
+
+def get_data_json(params: dict) -> str:
+    """Convert dict to url params."""
+    data_json = ""
+
+    data_json += "&".join([f"{key}={params[key]}" for key in sorted(params)])
+    return data_json
+
+
+async def request(
+    url: str,
+    method: str,
+    headers: Callable[[], dict],
+    *,
+    pool: tuple[str, int] = ("public", 1),
+    decoder: Decoder = response_decoder,
+) -> Response:
+    """Universal http reqponse.
+
+    Request wait own weight in rate limit pool, headers signed after wait.
+    Body decoded by decoder of typed response, its default data on error.
+    """
+    await rate_limit.acquire(*pool)
+
+    async with http_client.get_session().request(
+        method,
+        url,
+        headers=headers(),
+    ) as response:
+        res = await response.read()  # bytes
+        data = decoder.decode(res)  # Response code:str, data:typed
+        rate_limit.update(pool[0], response.headers, data.code)
+
+        match data.code:
+            case "200000":
+                logger.success(f"{response.status}:{method}:{url}")
+            case _:
+                logger.warning(f"{response.status}:{method}:{url}:{data}")
+
+        return data
+
+
+def get_headers(
+    access: Access = None,
+    str_to_sign: str = "",
+    *,
+    auth: bool = True,
+) -> dict:
+    """Get headers for request.
+
+    str_to_sign is method, uri and body of request without timestamp.
+    """
+    if auth:
+        result = access.get_auth_headers(str_to_sign, clock.get_timestamp())
+    else:
+        result = PUBLIC_HEADERS
+
+    return result
+
+
+async def get_account_list(
+    access: Access,
+    params: dict,
+    *,
+    method: str = "GET",
+    uri: str = "/api/v1/accounts",
+    pool: tuple[str, int] = ("management", 5),  # rate limit pool and weight
+) -> list[Account]:
+    """Get margin account list token."""
+    logger.info("Run get_account_list")
+
+    uri += "?" + get_data_json(params)
+
+    response = await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}"),
+        pool=pool,
+        decoder=account_list_decoder,
+    )
+
+    return response.data
+
+
+async def get_symbol_list(
+    access: Access,
+    *,
+    uri: str = "/api/v2/symbols",
+    pool: tuple[str, int] = ("public", 4),  # rate limit pool and weight
+    method: str = "GET",
+) -> list[Symbol]:
+    """Get all tokens in excange."""
+    response = await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+        decoder=symbol_list_decoder,
+    )
+
+    return response.data
+
+
+async def get_private_token(
+    access: Access,
+    *,
+    method: str = "POST",
+    uri: str = "/api/v1/bullet-private",
+    pool: tuple[str, int] = ("spot", 10),  # rate limit pool and weight
+) -> dict:
+    """Get margin account list token."""
+    logger.info("Run get_private_token")
+
+    response = await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}"),
+        pool=pool,
+    )
+
+    return response.data
+
+
+async def get_server_timestamp(
+    access: Access,
+    *,
+    uri: str = "/api/v1/timestamp",
+    method: str = "GET",
+    pool: tuple[str, int] = ("public", 3),  # rate limit pool and weight
+) -> dict:
+    """Get timestamp from excange server."""
+    logger.info("Run get_server_timestamp")
+
+    response = await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+    )
+
+    return response.data
+
+
+async def update_clock(access: Access) -> None:
+    """Add one sample of server time to clock."""
+    sent_at = time() * 1000
+    server_time = await get_server_timestamp(access)
+    received_at = time() * 1000
+
+    if server_time:
+        clock.add_sample(server_time, sent_at, received_at)
+        logger.info(f"Clock offset:{clock.offset:.0f} ms")
+
+
+async def init_clock(access: Access, samples: int = 3) -> None:
+    """Take first samples of server time one by one for fast start."""
+    for _ in range(samples):
+        await update_clock(access)
+
+
+async def sync_clock(access: Access, interval: int = 60) -> None:
+    """Sync clock with exchange server in infinity loop.
+
+    Sample by interval also keep pooled connection to exchange warm.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await update_clock(access)
@@ -0,0 +1,79 @@
+"""Microbenchmarks for Composter hot paths.
+
+Run inside Composter directory: python benchmark.py
+"""
+
+from collections.abc import Callable
+from time import perf_counter_ns
+
+import orjson
+
+from schemas import decode_kline
+
+ROUNDS = 100_000
+
+KLINE = orjson.dumps(
+    {
+        "type": "message",
+        "topic": "/market/candles:BTC-USDT_1hour",
+        "subject": "trade.candles.update",
+        "data": {
+            "symbol": "BTC-USDT",
+            "candles": [
+                "1589968800",
+                "9786.9",
+                "9740.8",
+                "9806.1",
+                "9732",
+                "27.45649579",
+                "268280.09830877",
+            ],
+            "time": 1589970010253893337,
+        },
+    },
+)
+
+
+def timeit_ns(func: Callable, rounds: int = ROUNDS) -> float:
+    """Get mean ns per one call of func."""
+    start = perf_counter_ns()
+    for _ in range(rounds):
+        func()
+    return (perf_counter_ns() - start) / rounds
+
+
+def report(name: str, before: float, after: float, unit: str = "ns") -> None:
+    """Print result of one benchmark."""
+    print(  # noqa: T201
+        f"{name:<24}before:{before:>10.0f} {unit}\tafter:{after:>10.0f} {unit}"
+        f"\tx{before / after:.2f}",
+    )
+
+
+def legacy_kline(recv: bytes) -> tuple[str, str, str]:
+    """Symbol, start and open of kline as before: text frame to dict."""
+    data = orjson.loads(recv.decode())["data"]
+    return data["symbol"], data["candles"][0], data["candles"][1]
+
+
+def kline(recv: bytes) -> tuple[str, str, str]:
+    """Symbol, start and open of kline by typed struct from bytes."""
+    data = decode_kline(recv)
+    return data.symbol, data.candles[0], data.candles[1]
+
+
+def bench_kline() -> None:
+    """Decode cost of one kline frame."""
+    if legacy_kline(KLINE) != kline(KLINE):
+        msg = "Typed kline differ from dict kline"
+        raise ValueError(msg)
+
+    report(
+        "kline frame",
+        timeit_ns(lambda: legacy_kline(KLINE)),
+        timeit_ns(lambda: kline(KLINE)),
+    )
+
+
+if __name__ == "__main__":
+    bench_kline()
@@ -1,177 +1,451 @@
-"""KCN Composter."""
-
-import asyncio
-import signal
-from decimal import Decimal
-from time import time
-from uuid import uuid4
-
-import orjson
-from decouple import Csv, config
-from loguru import logger
-from nats.js import JetStreamContext
-from websockets import ClientProtocol, connect
-
-from models import Token
-from natslocal import get_js_context
-from tools import divide_chunks, get_public_token
-
-
-async def event(data: dict, js: JetStreamContext, token: Token) -> None:
-    """Processing event klines."""
-    symbol = data["symbol"]
-    open_price = data["candles"][1]
-
-    if token.history[symbol] != open_price:
-        logger.info(f"Sent -> \t{symbol}:\t{open_price}")
-        await js.publish("candle", orjson.dumps({symbol: open_price}))
-        token.history[symbol] = open_price
-
-
-async def get_url_websocket() -> str:
-    """SetUp and get url for websocket."""
-    public_token = await get_public_token()
-
-    endpoint = public_token["instanceServers"][0]["endpoint"]
-    token = public_token["token"]
-
-    return f"{endpoint}?token={token}&connectId={str(uuid4()).replace('-', '')}"
-
-
-async def tunnel(
-    ws: ClientProtocol,
-    tunnelid: str,
-    type_: str,
-) -> None:
-    """Working with tunnel."""
-    logger.info(f"Tunnel {type_}")
-    await ws.send(
-        orjson.dumps(
-            {
-                "id": str(int(time() * 1000)),
-                "type": type_,
-                "newTunnelId": tunnelid,
-            },
-        ).decode(),
-    )
-
-
-async def klines(
-    ws: ClientProtocol,
-    tunnelid: str,
-    token: Token,
-    tokens: list,
-    type_: str,
-) -> None:
-    """Init/final klines subscribe/unsubscribe."""
-    logger.info(f"KLines {type_}")
-    await ws.send(
-        orjson.dumps(
-            {
-                "id": str(int(time() * 1000)),
-                "type": type_,
-                "topic": f"/market/candles:{token.get_candles_for_kline(tokens)}",
-                "privateChannel": False,
-                "tunnelId": tunnelid,
-            },
-        ).decode(),
-    )
-
-
-async def set_up_subscribe(
-    ws: ClientProtocol,
-    token: Token,
-) -> None:
-    """SetUp all subscribe."""
-    logger.info("Set up subscribe")
-    tunnelid = "all_klines"
-
-    await tunnel(ws, tunnelid, "openTunnel")
-
-    await asyncio.gather(
-        *[
-            klines(ws, tunnelid, token, tokens, "subscribe")
-            for tokens in divide_chunks(token.trade_currency, 20)
-        ],
-    )
-
-
-async def set_down_subscribe(
-    ws: ClientProtocol,
-    token: Token,
-    loop: asyncio.AbstractEventLoop,
-) -> None:
-    """SetUp all subscribe."""
-    logger.info("Set down subscribe")
-    tunnelid = "all_klines"
-
-    await asyncio.gather(
-        *[
-            klines(ws, tunnelid, token, tokens, "unsubscribe")
-            for tokens in divide_chunks(token.trade_currency, 20)
-        ],
-    )
-
-    await tunnel(ws, tunnelid, "closeTunnel")
-
-    await ws.close()
-    loop.stop()
-
-
-async def main() -> None:
-    """Main func in microservice."""
-    loop = asyncio.get_event_loop()
-
-    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
-
-    js = await get_js_context()
-    url = await get_url_websocket()
-
-    # Token's object
-    token = Token(
-        time_shift=config("TIME_SHIFT", cast=str, default="1hour"),
-        base_stable=config("BASE_STABLE", cast=str, default="USDT"),
-        currency=config("ALLCURRENCY", cast=Csv(str)),
-        ignore_currency=config("IGNORECURRENCY", cast=Csv(str)),
-        base_keep=Decimal(config("BASE_KEEP", cast=int)),
-    )
-
-    token.init_history()
-
-    async with connect(
-        url,
-        max_queue=1024,
-    ) as ws:
-        await ws.recv()
-        await set_up_subscribe(ws, token)
-
-        for s in signals:
-            loop.add_signal_handler(
-                s,
-                lambda s=s: asyncio.create_task(
-                    set_down_subscribe(
-                        ws,
-                        token,
-                        loop,
-                    ),
-                ),
-            )
-
-        background_tasks = set()
-
-        while True:
-            recv = await ws.recv()
-
-            task = asyncio.create_task(
-                event(
-                    orjson.loads(recv)["data"],
-                    js,
-                    token,
-                ),
-            )
-            background_tasks.add(task)
-            task.add_done_callback(background_tasks.discard)
-
-
-if __name__ == "__main__":
-    asyncio.run(main())
+"""KCN Composter."""
+
+import asyncio
+import signal
+from collections.abc import Callable, Coroutine
+from contextlib import suppress
+from decimal import Decimal
+from functools import partial
+from time import time
+
+import aiohttp
+import orjson
+from decouple import Csv, config
+from loguru import logger
+from websockets import ClientProtocol, ConnectionClosed, connect
+
+from models import (
+    Bullet,
+    CandleOpens,
+    CandleSynth,
+    LatestPool,
+    Shard,
+    TickBatch,
+    Token,
+)
+from natslocal import Publisher, get_js_context, read_bucket
+from schemas import Kline, decode_kline, decode_match
+from tools import (
+    divide_chunks,
+    get_candles,
+    get_interval,
+    get_public_token,
+    http_client,
+)
+
+# Requests of candles with error answer repeated so many times
+BACKFILL_ATTEMPTS = 5
+
+# Network errors and broken bodies of candles request are error answers
+BACKFILL_ERRORS = (aiohttp.ClientError, TimeoutError, orjson.JSONDecodeError, KeyError)
+
+# Symbol without saved start get candles of last day
+BACKFILL_FIRST_FROM = 24 * 60 * 60
+
+
+async def send_candle(
+    publisher: Publisher,
+    symbol: str,
+    start: str,
+    open_price: str,
+) -> None:
+    """Send open price of candle in own message."""
+    logger.info(f"Sent -> \t{symbol}:\t{open_price}")
+    await publisher.publish(
+        f"candle.{symbol}",
+        orjson.dumps({symbol: open_price}),
+        f"{symbol}:{start}:{open_price}",
+    )
+
+
+async def event(data: Kline, opens: CandleOpens) -> None:
+    """Processing event klines."""
+    start, open_price = data.candles[:2]
+    await opens.open(data.symbol, start, open_price)
+
+
+async def fetch_candles(symbol: str, start: int, time_shift: str) -> list | dict:
+    """Get candles of symbol from start, empty dict on error of request."""
+    try:
+        return await get_candles(
+            {"symbol": symbol, "type": time_shift, "startAt": start},
+        )
+    except BACKFILL_ERRORS as e:
+        logger.warning(f"Backfill {symbol}:{e!r}")
+        return {}
+
+
+async def get_last_candles(
+    symbol: str,
+    start: int,
+    time_shift: str,
+    attempt: int = 1,
+) -> list:
+    """Get candles of symbol from start, error answer is retried."""
+    candles = await fetch_candles(symbol, start, time_shift)
+
+    if isinstance(candles, dict) and attempt < BACKFILL_ATTEMPTS:
+        logger.warning(f"Backfill {symbol}:retry {attempt}")
+        await asyncio.sleep(2**attempt)
+        return await get_last_candles(symbol, start, time_shift, attempt + 1)
+
+    return candles or []
+
+
+async def backfill(
+    opens: CandleOpens,
+    symbol: str,
+    time_shift: str,
+    semaphore: asyncio.Semaphore,
+) -> None:
+    """Send open of last candle of symbol if feed missed it."""
+    async with semaphore:
+        candles = await get_last_candles(
+            symbol,
+            opens.get_start(symbol) or int(time()) - BACKFILL_FIRST_FROM,
+            time_shift,
+        )
+
+    # only last open is sent, orders by older opens are stale
+    if candles:
+        await opens.open(symbol, *candles[0][:2])
+
+
+async def backfill_shard(
+    opens: CandleOpens,
+    token: Token,
+    semaphore: asyncio.Semaphore,
+    chunks: list[list[str]],
+) -> None:
+    """Backfill candles of all tokens of shard missed while it was down.
+
+    Failure of one symbol is logged and does not stop others.
+    """
+    symbols = [f"{sym}-{token.base_stable}" for tokens in chunks for sym in tokens]
+    results = await asyncio.gather(
+        *[backfill(opens, symbol, token.time_shift, semaphore) for symbol in symbols],
+        return_exceptions=True,
+    )
+    failed = [
+        (symbol, result)
+        for symbol, result in zip(symbols, results, strict=True)
+        if isinstance(result, Exception)
+    ]
+
+    for symbol, error in failed:
+        logger.error(f"Backfill {symbol}:failed:{error!r}")
+
+    logger.info(f"Backfill {len(symbols) - len(failed)}/{len(symbols)} tokens done")
+
+
+def put_kline(pool: LatestPool, recv: bytes) -> None:
+    """Put kline from websocket frame to pool, skip acks and pongs."""
+    data = decode_kline(recv)
+
+    if data is not None:
+        pool.put(data.symbol, data)
+
+
+def put_match(synth: CandleSynth, recv: bytes) -> None:
+    """Add trade from websocket frame to candle, skip acks and pongs."""
+    data = decode_match(recv)
+
+    if data is not None:
+        synth.add(data.symbol, data.price, data.size, data.time)
+
+
+async def get_url_websocket(bullet: Bullet, *, renew: bool = False) -> str:
+    """SetUp and get url for websocket, token reused while it is valid."""
+    async with bullet.lock:
+        if renew or not bullet.is_valid():
+            bullet.update(await get_public_token())
+
+    return bullet.get_url()
+
+
+async def tunnel(
+    ws: ClientProtocol,
+    tunnelid: str,
+    type_: str,
+) -> None:
+    """Working with tunnel."""
+    logger.info(f"Tunnel {type_}")
+    await ws.send(
+        orjson.dumps(
+            {
+                "id": str(int(time() * 1000)),
+                "type": type_,
+                "newTunnelId": tunnelid,
+            },
+        ).decode(),
+    )
+
+
+def get_kline_topic(token: Token, tokens: list[str]) -> str:
+    """Get topic of klines of tokens."""
+    return f"/market/candles:{token.get_candles_for_kline(tokens)}"
+
+
+def get_match_topic(token: Token, tokens: list[str]) -> str:
+    """Get topic of trades of tokens."""
+    return f"/market/match:{','.join(f'{sym}-{token.base_stable}' for sym in tokens)}"
+
+
+async def klines(
+    ws: ClientProtocol,
+    tunnelid: str,
+    topic: str,
+    type_: str,
+) -> None:
+    """Init/final klines subscribe/unsubscribe."""
+    logger.info(f"KLines {type_}")
+    await ws.send(
+        orjson.dumps(
+            {
+                "id": str(int(time() * 1000)),
+                "type": type_,
+                "topic": topic,
+                "privateChannel": False,
+                "tunnelId": tunnelid,
+            },
+        ).decode(),
+    )
+
+
+async def set_up_subscribe(ws: ClientProtocol, shard: Shard) -> None:
+    """SetUp all subscribe of connection, one message per chunk of tokens."""
+    logger.info(f"Set up subscribe {sum(map(len, shard.chunks))} tokens")
+    tunnelid = "all_klines"
+
+    await tunnel(ws, tunnelid, "openTunnel")
+
+    await asyncio.gather(
+        *[
+            klines(ws, tunnelid, shard.topic(tokens), "subscribe")
+            for tokens in shard.chunks
+        ],
+    )
+
+
+async def set_down_subscribe(ws: ClientProtocol, shard: Shard) -> None:
+    """SetDown all subscribe of connection and close it."""
+    logger.info(f"Set down subscribe {sum(map(len, shard.chunks))} tokens")
+    tunnelid = "all_klines"
+
+    await asyncio.gather(
+        *[
+            klines(ws, tunnelid, shard.topic(tokens), "unsubscribe")
+            for tokens in shard.chunks
+        ],
+    )
+
+    await tunnel(ws, tunnelid, "closeTunnel")
+
+    await ws.close()
+
+
+async def set_down(
+    shards: list[Shard],
+    publisher: Publisher,
+    loop: asyncio.AbstractEventLoop,
+) -> None:
+    """SetDown subscribe of all connections and stop."""
+    for shard in shards:
+        shard.closed = True
+
+    await asyncio.gather(
+        *[
+            set_down_subscribe(shard.ws, shard)
+            for shard in shards
+            if shard.ws is not None
+        ],
+    )
+
+    await http_client.close()
+    await publisher.flush()
+    loop.stop()
+
+
+async def keepalive(ws: ClientProtocol, interval: float) -> None:
+    """Send ping to exchange each interval while connection is open."""
+    with suppress(ConnectionClosed):
+        while True:
+            await asyncio.sleep(interval)
+            await ws.send(
+                orjson.dumps(
+                    {"id": str(int(time() * 1000)), "type": "ping"},
+                ).decode(),
+            )
+
+
+async def listen(
+    ws: ClientProtocol,
+    put: Callable[[bytes], None],
+    stale_after: float,
+) -> None:
+    """Put frames to put, feed silent longer than stale_after is stale."""
+    while True:
+        async with asyncio.timeout(stale_after):
+            recv = await ws.recv(decode=False)
+
+        put(recv)
+
+
+async def session(
+    bullet: Bullet,
+    shard: Shard,
+    put: Callable[[bytes], None],
+) -> None:
+    """Connect, subscribe, ping and receive klines till connection drop."""
+    url = await get_url_websocket(bullet, renew=shard.attempt > 1)
+
+    async with connect(url, max_queue=1024) as ws:
+        await ws.recv()
+        await set_up_subscribe(ws, shard)
+        shard.connected(ws)
+
+        ping_task = asyncio.create_task(keepalive(ws, bullet.ping_interval))
+        try:
+            # pong answer each ping, so silence is longer than ping period
+            await listen(ws, put, bullet.ping_interval + bullet.ping_timeout)
+        finally:
+            ping_task.cancel()
+            shard.ws = None
+
+
+async def try_session(
+    bullet: Bullet,
+    shard: Shard,
+    put: Callable[[bytes], None],
+) -> None:
+    """Run session, its drop or failure is only logged."""
+    try:
+        await session(bullet, shard, put)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def receive(
+    bullet: Bullet,
+    shard: Shard,
+    put: Callable[[bytes], None],
+) -> None:
+    """Keep connection of shard, reconnect and resubscribe after drop."""
+    while not shard.closed:
+        await try_session(bullet, shard, put)
+
+        delay = shard.get_delay()
+        logger.warning(f"Reconnect {shard.attempt} after {delay:.1f} s")
+        await asyncio.sleep(delay)
+
+
+def get_feed(
+    token: Token,
+    pool: LatestPool,
+    *,
+    synth: bool,
+) -> tuple[Callable[[bytes], None], Callable[[list[str]], str], list[Coroutine]]:
+    """Get put of frames, topic of tokens and timers of feed.
+
+    Feed of exchange klines or of trades with candles built locally.
+    """
+    if not synth:
+        return partial(put_kline, pool), partial(get_kline_topic, token), []
+
+    candles = CandleSynth(pool, get_interval(token.time_shift))
+    return (
+        partial(put_match, candles),
+        partial(get_match_topic, token),
+        [candles.run()],
+    )
+
+
+async def main() -> None:
+    """Main func in microservice."""
+    loop = asyncio.get_event_loop()
+
+    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+
+    js = await get_js_context()
+    publisher = Publisher(js, config("PUBLISH_WINDOW", cast=int, default=256))
+
+    # Token's object
+    token = Token(
+        time_shift=config("TIME_SHIFT", cast=str, default="1hour"),
+        base_stable=config("BASE_STABLE", cast=str, default="USDT"),
+        currency=config("ALLCURRENCY", cast=Csv(str)),
+        ignore_currency=config("IGNORECURRENCY", cast=Csv(str)),
+        base_keep=Decimal(config("BASE_KEEP", cast=int)),
+    )
+
+    # Candles of one tick go in one message after TICK_DEADLINE seconds
+    send = (
+        TickBatch(publisher, config("TICK_DEADLINE", cast=float, default=0.5)).add
+        if config("TICK_BATCH", cast=bool, default=False)
+        else partial(send_candle, publisher)
+    )
+
+    # Start of last sent candle of each symbol from key value bucket
+    kv = await js.create_key_value(bucket="composter")
+    opens = CandleOpens(send, kv)
+    opens.load(await read_bucket(kv))
+
+    # Latest kline of each symbol processed by fixed count of workers
+    pool = LatestPool(
+        partial(event, opens=opens),
+        config("WORKERS", cast=int, default=8),
+    )
+    pool.start()
+
+    # Candles built from trades, opens come without exchange klines delay
+    put, topic, timers = get_feed(
+        token,
+        pool,
+        synth=config("SYNTH_CANDLES", cast=bool, default=False),
+    )
+
+    # After each connect missed candles come by BACKFILL_CONCURRENCY requests
+    on_connect = partial(
+        backfill_shard,
+        opens,
+        token,
+        asyncio.Semaphore(config("BACKFILL_CONCURRENCY", cast=int, default=10)),
+    )
+
+    # Each connection follow TOPICS_PER_CONNECTION tokens subscribed
+    # by TOPICS_PER_SUBSCRIBE in one message
+    shards = [
+        Shard(
+            list(
+                divide_chunks(
+                    tokens,
+                    config("TOPICS_PER_SUBSCRIBE", cast=int, default=20),
+                ),
+            ),
+            topic,
+            on_connect,
+        )
+        for tokens in divide_chunks(
+            token.trade_currency,
+            config("TOPICS_PER_CONNECTION", cast=int, default=300),
+        )
+    ]
+
+    for s in signals:
+        loop.add_signal_handler(
+            s,
+            lambda s=s: asyncio.create_task(
+                set_down(shards, publisher, loop),
+            ),
+        )
+
+    # Bullet token is shared by connections and reused on reconnect
+    bullet = Bullet()
+    await asyncio.gather(
+        *[receive(bullet, shard, put) for shard in shards],
+        *timers,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,168 +1,598 @@
-"""Classes for work."""
-
-import hashlib
-import hmac
-from base64 import b64encode
-from decimal import Decimal
-from typing import Self
-
-
-class Access:
-    """Class for store access condention to exchange."""
-
-    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
-        """Init access condention keys."""
-        self.key: str = key
-        self.secret: str = secret
-        self.passphrase: str = passphrase
-        self.base_uri: str = base_uri
-
-    def encrypted(self: Self, msg: str) -> str:
-        """Encrypted msg for exchange."""
-        return b64encode(
-            hmac.new(
-                self.secret.encode("utf-8"),
-                msg.encode("utf-8"),
-                hashlib.sha256,
-            ).digest(),
-        ).decode()
-
-
-class Token:
-    """Class for store token data for trade."""
-
-    def __init__(
-        self: Self,
-        currency: list,
-        ignore_currency: list,
-        base_keep: Decimal,
-        time_shift: str = "1hour",
-        base_stable: str = "USDT",
-    ) -> None:
-        """Init class for store trade tokens."""
-        self.trade_currency: list[str] = currency  # Tokens for trade in bot
-        self.ignore_currency: list[str] = ignore_currency
-        self.base_keep: Decimal = base_keep
-        self.base_stable: str = base_stable
-        self.time_shift: str = time_shift
-        self.borrow_size: Decimal = Decimal("0")
-        self.avail_size: Decimal = Decimal("0")
-
-        self.accept_tokens: list[str] = []  # tradable tokens
-        self.new_tokens: list[str] = (
-            []
-        )  # tokens that can be traded but are not in the bot
-        self.del_tokens: list[str] = (
-            []
-        )  # tokens that have been removed from the exchange
-        self.history: dict = {}
-
-    def init_history(self: Self) -> None:
-        """Init history."""
-        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
-
-    def get_candles_for_kline(self: Self, tokens: list) -> str:
-        """Get str candles for kline websocket."""
-        return ",".join(
-            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
-        )
-
-    def get_clear_borrow(self: Self) -> Decimal:
-        """Get clear borrow size."""
-        return self.borrow_size - self.avail_size
-
-    def get_percent_borrow(self: Self) -> int:
-        """Get percent of borrowing."""
-        return (
-            self.get_clear_borrow()
-            * 100
-            / (self.trade_currency * float(self.base_keep))
-        )
-
-    def get_len_trade_currency(self: Self) -> int:
-        """Get len of trade_currency."""
-        return len(self.trade_currency)
-
-    def get_len_accept_tokens(self: Self) -> int:
-        """Get len of accept_tokens."""
-        return len(self.accept_tokens)
-
-    def get_len_del_tokens(self: Self) -> int:
-        """Get len del_tokens."""
-        return len(self.del_tokens)
-
-    def get_len_ignore_currency(self: Self) -> int:
-        """Get len of ignore_currency."""
-        return len(self.ignore_currency)
-
-    def get_len_new_tokens(self: Self) -> int:
-        """Get len of new_tokens."""
-        return len(self.new_tokens)
-
-    @staticmethod
-    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
-        """Remove postfix."""
-        return symbol.replace(postfix, "")
-
-    def save_accept_tokens(self: Self, all_token_in_excange: list) -> None:
-        """Save all accepted token."""
-        self.accept_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if token_in_excange["isMarginEnabled"]
-            and token_in_excange["quoteCurrency"] == "USDT"
-            and Token.remove_postfix(token_in_excange["symbol"])
-            not in self.ignore_currency
-        ]
-
-    def save_new_tokens(self: Self, all_token_in_excange: list) -> None:
-        """."""
-        self.new_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if Token.remove_postfix(token_in_excange["symbol"])
-            not in self.accept_tokens
-        ]
-
-    def save_del_tokens(self: Self) -> None:
-        """."""
-        self.del_tokens = [
-            used for used in self.trade_currency if used not in self.accept_tokens
-        ]
-
-
-class OrderBook:
-    """Class for store orders data from excange."""
-
-    def __init__(self: Self, token: Token) -> None:
-        """Init order book by symbol from config by available 0."""
-        self.order_book: dict = {s: {"available": 0} for s in token.trade_currency}
-
-    def fill_order_book(self: Self, account_list: list) -> None:
-        """Fill real available from exchange."""
-        self.order_book: dict = {
-            account["currency"]: {"available": account["available"]}
-            for account in account_list
-            if account["currency"] in self.order_book
-        }
-
-    def fill_base_increment(self: Self, symbol_increments: list) -> None:
-        """Fill real baseincrement from exchange.
-
-        after:
-        {"ICP":{"available":"123"}}
-
-        before:
-        {"ICP":{"available":"123","baseincrement":"0.0001"}}
-        """
-        self.order_book.update(
-            {
-                symbol_increment["baseCurrency"]: {
-                    "baseincrement": symbol_increment["baseIncrement"],
-                    "available": self.order_book[symbol_increment["baseCurrency"]],
-                }
-                for symbol_increment in symbol_increments
-                if symbol_increment["baseCurrency"] in self.order_book
-                and symbol_increment["quoteCurrency"] == "USDT"
-            },
-        )
+"""Classes for work."""
+
+import asyncio
+import hashlib
+import hmac
+from base64 import b64encode
+from collections.abc import Awaitable, Callable, Mapping
+from decimal import Decimal
+from time import monotonic, time
+from typing import Any, Self
+from uuid import uuid4
+
+import aiohttp
+import orjson
+from loguru import logger
+from nats.js.kv import KeyValue
+from websockets import ClientProtocol
+
+from natslocal import Publisher
+from schemas import Kline
+
+
+class Access:
+    """Class for store access condention to exchange."""
+
+    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
+        """Init access condention keys."""
+        self.key: str = key
+        self.secret: str = secret
+        self.passphrase: str = passphrase
+        self.base_uri: str = base_uri
+        # keyed once, each sign work on copy of this state
+        self.hmac_key = hmac.new(self.secret.encode("utf-8"), digestmod=hashlib.sha256)
+        self.encrypted_passphrase: str = self.encrypted(passphrase)
+        self.auth_headers: dict = {
+            "KC-API-PASSPHRASE": self.encrypted_passphrase,
+            "KC-API-KEY": self.key,
+            "Content-Type": "application/json",
+            "KC-API-KEY-VERSION": "2",
+            "User-Agent": "kucoin-python-sdk/2",
+        }
+
+    def encrypted(self: Self, msg: str) -> str:
+        """Encrypted msg for exchange."""
+        signer = self.hmac_key.copy()
+        signer.update(msg.encode("utf-8"))
+        return b64encode(signer.digest()).decode()
+
+    def get_auth_headers(self: Self, str_to_sign: str, now_time: str) -> dict:
+        """Get auth headers, only timestamp and sign computed per call."""
+        return {
+            **self.auth_headers,
+            "KC-API-SIGN": self.encrypted(f"{now_time}{str_to_sign}"),
+            "KC-API-TIMESTAMP": now_time,
+        }
+
+
+class HttpClient:
+    """Class for store long-lived pooled http session to exchange."""
+
+    def __init__(
+        self: Self,
+        limit: int = 100,
+        limit_per_host: int = 50,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: int = 75,
+        timeout: int = 10,
+    ) -> None:
+        """Init settings of connection pool."""
+        self.limit: int = limit
+        self.limit_per_host: int = limit_per_host
+        self.ttl_dns_cache: int = ttl_dns_cache
+        self.keepalive_timeout: int = keepalive_timeout
+        self.timeout: int = timeout
+        self.session: aiohttp.ClientSession | None = None
+
+    def get_session(self: Self) -> aiohttp.ClientSession:
+        """Get opened session or open new one with warm connection pool.
+
+        Session created lazily, because aiohttp need running event loop.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    ttl_dns_cache=self.ttl_dns_cache,
+                    use_dns_cache=True,
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self: Self) -> None:
+        """Close session and release all pooled connections."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+class RateLimit:
+    """Class for store client side rate limit of exchange.
+
+    Token bucket for each resource pool of exchange, refilled on reset of
+    pool window and corrected by gw-ratelimit headers from responses.
+    """
+
+    def __init__(
+        self: Self,
+        limits: dict | None = None,
+        window: float = 30,
+    ) -> None:
+        """Init pools by default quota for 30 seconds window."""
+        self.window: float = window
+        self.limits: dict[str, int] = limits or {
+            "spot": 4000,
+            "margin": 4000,
+            "management": 2000,
+            "public": 2000,
+        }
+        self.remaining: dict[str, int] = self.limits.copy()
+        self.reset_at: dict[str, float] = dict.fromkeys(
+            self.limits,
+            monotonic() + window,
+        )
+        self.locks: dict[str, asyncio.Lock] = {
+            pool: asyncio.Lock() for pool in self.limits
+        }
+
+    def refill(self: Self, pool: str) -> None:
+        """Refill pool if window of pool is over."""
+        if monotonic() >= self.reset_at[pool]:
+            self.remaining[pool] = self.limits[pool]
+            self.reset_at[pool] = monotonic() + self.window
+
+    async def acquire(self: Self, pool: str, weight: int = 1) -> None:
+        """Wait weight in pool, requests go out in order of call."""
+        async with self.locks[pool]:
+            self.refill(pool)
+            while self.remaining[pool] < weight:
+                logger.warning(f"Rate limit {pool}:wait to reset")
+                await asyncio.sleep(self.reset_at[pool] - monotonic())
+                self.refill(pool)
+            self.remaining[pool] -= weight
+
+    def update(self: Self, pool: str, headers: Mapping, code: str) -> None:
+        """Update pool by code and gw-ratelimit headers of response."""
+        if code == "429000":  # pool is empty till reset
+            self.remaining[pool] = 0
+
+        self.update_by_headers(pool, headers)
+
+    def update_by_headers(self: Self, pool: str, headers: Mapping) -> None:
+        """Update pool by gw-ratelimit headers of response."""
+        if "gw-ratelimit-remaining" not in headers:
+            return
+
+        self.limits[pool] = int(headers["gw-ratelimit-limit"])
+        self.remaining[pool] = min(
+            self.remaining[pool],
+            int(headers["gw-ratelimit-remaining"]),
+        )
+        self.reset_at[pool] = monotonic() + int(headers["gw-ratelimit-reset"]) / 1000
+
+
+class LatestPool:
+    """Class for process latest value of each key by fixed count of workers.
+
+    Newer value of key replace pending one, so memory is bounded by count
+    of keys and one key is never processed by two workers at once.
+    """
+
+    def __init__(
+        self: Self,
+        handler: Callable[[Any], Awaitable[None]],
+        workers: int = 8,
+    ) -> None:
+        """Init pool of workers for handler."""
+        self.handler = handler
+        self.workers: int = workers
+        self.pending: dict[str, object] = {}
+        self.busy: set[str] = set()
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        self.tasks: set[asyncio.Task] = set()
+
+    def start(self: Self) -> None:
+        """Start workers."""
+        for _ in range(self.workers):
+            self.tasks.add(asyncio.create_task(self.work()))
+
+    def stop(self: Self) -> None:
+        """Stop workers, pending values are dropped."""
+        for task in self.tasks:
+            task.cancel()
+
+    def put(self: Self, key: str, value: object) -> None:
+        """Put latest value of key, queue key only once."""
+        if key not in self.pending and key not in self.busy:
+            self.queue.put_nowait(key)
+        self.pending[key] = value
+
+    async def work(self: Self) -> None:
+        """Process keys from queue one by one."""
+        while True:
+            await self.process(await self.queue.get())
+
+    async def process(self: Self, key: str) -> None:
+        """Process latest value of key."""
+        self.busy.add(key)
+        try:
+            await self.handler(self.pending.pop(key))
+        except Exception as e:
+            logger.exception(e)
+        self.done(key)
+
+    def done(self: Self, key: str) -> None:
+        """Free key, queue it again if newer value came while processing."""
+        self.busy.discard(key)
+        if key in self.pending:
+            self.queue.put_nowait(key)
+
+
+class Candle:
+    """Class for store candle of symbol built from trades."""
+
+    __slots__ = ("close", "high", "low", "open", "start", "volume")
+
+    def __init__(self: Self, start: int, price: str, size: str) -> None:
+        """Init candle by first trade or by close of previous candle."""
+        self.start: int = start
+        self.open: str = price
+        self.close: str = price
+        self.high: Decimal = Decimal(price)
+        self.low: Decimal = self.high
+        self.volume: Decimal = Decimal(size)
+
+    def add(self: Self, price: str, size: str) -> None:
+        """Add trade to candle."""
+        value = Decimal(price)
+        self.close = price
+        self.high = max(self.high, value)
+        self.low = min(self.low, value)
+        self.volume += Decimal(size)
+
+
+class CandleSynth:
+    """Class for build candles of symbols from trades.
+
+    Open of new candle is put to pool by first trade after boundary or at
+    boundary by close of previous candle, what comes first. First candle of
+    symbol after start is silent, its open comes from backfill.
+    """
+
+    def __init__(self: Self, pool: LatestPool, interval: int) -> None:
+        """Init candles of interval seconds."""
+        self.pool = pool
+        self.interval: int = interval
+        self.candles: dict[str, Candle] = {}
+
+    def get_start(self: Self, timestamp: float) -> int:
+        """Get start of candle with timestamp in seconds."""
+        return int(timestamp) // self.interval * self.interval
+
+    def open(self: Self, symbol: str, start: int, price: str, size: str) -> None:
+        """Open new candle of symbol and put its open to pool."""
+        self.candles[symbol] = Candle(start, price, size)
+        self.pool.put(symbol, Kline(symbol=symbol, candles=[str(start), price]))
+
+    def add(self: Self, symbol: str, price: str, size: str, time_ns: str) -> None:
+        """Add trade to candle of symbol, open new one after boundary."""
+        start = self.get_start(int(time_ns) / 1_000_000_000)
+        candle = self.candles.get(symbol)
+
+        if candle is None:
+            # Boundary of interval was not seen, trade price is not its open
+            self.candles[symbol] = Candle(start, price, size)
+        else:
+            self.update(symbol, candle, start, price, size)
+
+    def update(
+        self: Self,
+        symbol: str,
+        candle: Candle,
+        start: int,
+        price: str,
+        size: str,
+    ) -> None:
+        """Add trade to seen candle of symbol, open new one after boundary."""
+        if candle.start < start:
+            self.open(symbol, start, price, size)
+        else:
+            candle.add(price, size)
+
+    def roll(self: Self) -> None:
+        """Open new candle of symbols without trade after boundary."""
+        start = self.get_start(time())
+        stale = [
+            symbol for symbol, candle in self.candles.items() if candle.start < start
+        ]
+
+        for symbol in stale:
+            self.open(symbol, start, self.candles[symbol].close, "0")
+
+    async def run(self: Self) -> None:
+        """Roll candles at each boundary."""
+        while True:
+            await asyncio.sleep(self.get_start(time()) + self.interval - time())
+            self.roll()
+
+
+class TickBatch:
+    """Class for collect open prices of candles started in the same tick.
+
+    Candles of one start time go out in one message after deadline from
+    the first of them: {"start": start, "candles": [[symbol, open], ...]}.
+    """
+
+    def __init__(self: Self, publisher: Publisher, deadline: float = 0.5) -> None:
+        """Init batch of ticks sent by publisher."""
+        self.publisher = publisher
+        self.deadline: float = deadline
+        self.ticks: dict[str, list[list[str]]] = {}
+        self.background_tasks: set[asyncio.Task] = set()
+
+    async def add(self: Self, symbol: str, start: str, open_price: str) -> None:
+        """Add open price of candle to batch of its start time."""
+        if start not in self.ticks:
+            self.ticks[start] = []
+            task = asyncio.create_task(self.flush_later(start))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+        self.ticks[start].append([symbol, open_price])
+
+    async def flush_later(self: Self, start: str) -> None:
+        """Send batch of start time after deadline."""
+        await asyncio.sleep(self.deadline)
+        candles = self.ticks.pop(start)
+
+        logger.info(f"Sent -> \ttick {start}:\t{len(candles)} candles")
+        # Candles of late batch of the same start are not in first one
+        await self.publisher.publish(
+            "tick",
+            orjson.dumps({"start": start, "candles": candles}),
+            f"{start}:{candles[0][0]}",
+        )
+
+
+class Bullet:
+    """Class for store token of websocket connections to exchange.
+
+    One token serve all connections and reconnects while it is younger
+    than ttl, exchange accept it for 24 hours.
+    """
+
+    def __init__(self: Self, ttl: float = 23 * 60 * 60) -> None:
+        """Init empty token."""
+        self.ttl: float = ttl
+        self.endpoint: str = ""
+        self.token: str = ""
+        self.ping_interval: float = 18
+        self.ping_timeout: float = 10
+        self.fetched_at: float = float("-inf")
+        self.lock = asyncio.Lock()
+
+    def is_valid(self: Self) -> bool:
+        """Token is fetched and not expired."""
+        return monotonic() - self.fetched_at < self.ttl
+
+    def update(self: Self, public_token: dict) -> None:
+        """Update token and ping settings by answer of bullet request."""
+        server = public_token["instanceServers"][0]
+        self.endpoint = server["endpoint"]
+        self.token = public_token["token"]
+        self.ping_interval = server["pingInterval"] / 1000
+        self.ping_timeout = server["pingTimeout"] / 1000
+        self.fetched_at = monotonic()
+
+    def get_url(self: Self) -> str:
+        """Get url of new connection by token."""
+        return f"{self.endpoint}?token={self.token}&connectId={uuid4().hex}"
+
+
+class Shard:
+    """Class for store websocket connection of part of tokens.
+
+    Reconnect wait twice longer after each failed attempt till max_delay.
+    """
+
+    def __init__(
+        self: Self,
+        chunks: list[list[str]],
+        topic: Callable[[list[str]], str],
+        on_connect: Callable[[list[list[str]]], Awaitable[None]],
+        base_delay: float = 0.5,
+        max_delay: float = 30,
+    ) -> None:
+        """Init shard of tokens subscribed by chunks to topic of chunk."""
+        self.chunks: list[list[str]] = chunks
+        self.topic = topic
+        self.on_connect = on_connect
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.attempt: int = 0
+        self.ws: ClientProtocol | None = None
+        self.closed: bool = False
+        self.background_tasks: set[asyncio.Task] = set()
+
+    def get_delay(self: Self) -> float:
+        """Get delay before next reconnect."""
+        self.attempt += 1
+        return min(self.base_delay * 2 ** (self.attempt - 1), self.max_delay)
+
+    def connected(self: Self, ws: ClientProtocol) -> None:
+        """Save subscribed connection and run on_connect of its tokens.
+
+        Next failure start delays over.
+        """
+        self.ws = ws
+        self.attempt = 0
+
+        task = asyncio.create_task(self.on_connect(self.chunks))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+
+class CandleOpens:
+    """Class for send open of each candle of symbol once.
+
+    Start of last sent candle of symbol saved in key value bucket, so after
+    reconnect or restart candles missed by feed are found by start time.
+    """
+
+    def __init__(
+        self: Self,
+        send: Callable[[str, str, str], Awaitable[None]],
+        kv: KeyValue,
+    ) -> None:
+        """Init opens sent by send and starts saved in kv."""
+        self.send = send
+        self.kv = kv
+        self.starts: dict[str, int] = {}
+
+    def load(self: Self, snapshot: dict[str, bytes]) -> None:
+        """Load starts from snapshot of key value bucket."""
+        self.starts = {symbol: int(start) for symbol, start in snapshot.items()}
+
+    def get_start(self: Self, symbol: str) -> int:
+        """Get start of last sent candle of symbol, 0 if unknown."""
+        return self.starts.get(symbol, 0)
+
+    async def open(self: Self, symbol: str, start: str, open_price: str) -> None:
+        """Send open of candle newer than last sent candle of symbol."""
+        if int(start) > self.get_start(symbol):
+            # marked before await, so feed and backfill send it once
+            self.starts[symbol] = int(start)
+            await self.send(symbol, start, open_price)
+            await self.kv.put(symbol, start.encode())
+
+
+class Token:
+    """Class for store token data for trade."""
+
+    def __init__(
+        self: Self,
+        currency: list,
+        ignore_currency: list,
+        base_keep: Decimal,
+        time_shift: str = "1hour",
+        base_stable: str = "USDT",
+    ) -> None:
+        """Init class for store trade tokens."""
+        self.trade_currency: list[str] = currency  # Tokens for trade in bot
+        self.ignore_currency: list[str] = ignore_currency
+        self.base_keep: Decimal = base_keep
+        self.base_stable: str = base_stable
+        self.time_shift: str = time_shift
+        self.borrow_size: Decimal = Decimal("0")
+        self.avail_size: Decimal = Decimal("0")
+
+        self.accept_tokens: list[str] = []  # tradable tokens
+        self.new_tokens: list[str] = (
+            []
+        )  # tokens that can be traded but are not in the bot
+        self.del_tokens: list[str] = (
+            []
+        )  # tokens that have been removed from the exchange
+        self.history: dict = {}
+
+    def init_history(self: Self) -> None:
+        """Init history."""
+        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
+
+    def get_candles_for_kline(self: Self, tokens: list) -> str:
+        """Get str candles for kline websocket."""
+        return ",".join(
+            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
+        )
+
+    def get_clear_borrow(self: Self) -> Decimal:
+        """Get clear borrow size."""
+        return self.borrow_size - self.avail_size
+
+    def get_percent_borrow(self: Self) -> int:
+        """Get percent of borrowing."""
+        return (
+            self.get_clear_borrow()
+            * 100
+            / (self.trade_currency * float(self.base_keep))
+        )
+
+    def get_len_trade_currency(self: Self) -> int:
+        """Get len of trade_currency."""
+        return len(self.trade_currency)
+
+    def get_len_accept_tokens(self: Self) -> int:
+        """Get len of accept_tokens."""
+        return len(self.accept_tokens)
+
+    def get_len_del_tokens(self: Self) -> int:
+        """Get len del_tokens."""
+        return len(self.del_tokens)
+
+    def get_len_ignore_currency(self: Self) -> int:
+        """Get len of ignore_currency."""
+        return len(self.ignore_currency)
+
+    def get_len_new_tokens(self: Self) -> int:
+        """Get len of new_tokens."""
+        return len(self.new_tokens)
+
+    @staticmethod
+    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
+        """Remove postfix."""
+        return symbol.replace(postfix, "")
+
+    def save_accept_tokens(self: Self, all_token_in_excange: list) -> None:
+        """Save all accepted token."""
+        self.accept_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if token_in_excange["isMarginEnabled"]
+            and token_in_excange["quoteCurrency"] == "USDT"
+            and Token.remove_postfix(token_in_excange["symbol"])
+            not in self.ignore_currency
+        ]
+
+    def save_new_tokens(self: Self, all_token_in_excange: list) -> None:
+        """."""
+        self.new_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if Token.remove_postfix(token_in_excange["symbol"])
+            not in self.accept_tokens
+        ]
+
+    def save_del_tokens(self: Self) -> None:
+        """."""
+        self.del_tokens = [
+            used for used in self.trade_currency if used not in self.accept_tokens
+        ]
+
+
+class OrderBook:
+    """Class for store orders data from excange."""
+
+    def __init__(self: Self, token: Token) -> None:
+        """Init order book by symbol from config by available 0."""
+        self.order_book: dict = {s: {"available": 0} for s in token.trade_currency}
+
+    def fill_order_book(self: Self, account_list: list) -> None:
+        """Fill real available from exchange."""
+        self.order_book: dict = {
+            account["currency"]: {"available": account["available"]}
+            for account in account_list
+            if account["currency"] in self.order_book
+        }
+
+    def fill_base_increment(self: Self, symbol_increments: list) -> None:
+        """Fill real baseincrement from exchange.
+
+        after:
+        {"ICP":{"available":"123"}}
+
+        before:
+        {"ICP":{"available":"123","baseincrement":"0.0001"}}
+        """
+        self.order_book.update(
+            {
+                symbol_increment["baseCurrency"]: {
+                    "baseincrement": symbol_increment["baseIncrement"],
+                    "available": self.order_book[symbol_increment["baseCurrency"]],
+                }
+                for symbol_increment in symbol_increments
+                if symbol_increment["baseCurrency"] in self.order_book
+                and symbol_increment["quoteCurrency"] == "USDT"
+            },
+        )
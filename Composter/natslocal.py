@@ -1,41 +1,140 @@
-"""Nats tools for get js context."""
-
-from loguru import logger
-from nats.aio.client import Client
-from nats.js import JetStreamContext
-
-
-async def disconnected_cb(*args: list) -> None:
-    """CallBack на отключение от nats."""
-    logger.error(f"Got disconnected... {args}")
-
-
-async def reconnected_cb(*args: list) -> None:
-    """CallBack на переподключение к nats."""
-    logger.error(f"Got reconnected... {args}")
-
-
-async def error_cb(excep: Exception) -> None:
-    """CallBack на ошибку подключения к nats."""
-    logger.error(f"Error ... {excep}")
-
-
-async def closed_cb(*args: list) -> None:
-    """CallBack на закрытие подключения к nats."""
-    logger.error(f"Closed ... {args}")
-
-
-async def get_js_context() -> JetStreamContext:
-    """Get JetStream Context."""
-    nc = Client()
-
-    await nc.connect(
-        servers="kcn_nats",
-        max_reconnect_attempts=-1,
-        reconnected_cb=reconnected_cb,
-        disconnected_cb=disconnected_cb,
-        error_cb=error_cb,
-        closed_cb=closed_cb,
-    )
-
-    return nc.jetstream()
+"""Nats tools for get js context."""
+
+import asyncio
+from typing import Self
+
+from loguru import logger
+from nats.aio.client import Client
+from nats.errors import Error as NatsError
+from nats.js import JetStreamContext
+from nats.js.api import PubAck
+from nats.js.kv import KeyValue
+
+
+async def disconnected_cb(*args: list) -> None:
+    """CallBack на отключение от nats."""
+    logger.error(f"Got disconnected... {args}")
+
+
+async def reconnected_cb(*args: list) -> None:
+    """CallBack на переподключение к nats."""
+    logger.error(f"Got reconnected... {args}")
+
+
+async def error_cb(excep: Exception) -> None:
+    """CallBack на ошибку подключения к nats."""
+    logger.error(f"Error ... {excep}")
+
+
+async def closed_cb(*args: list) -> None:
+    """CallBack на закрытие подключения к nats."""
+    logger.error(f"Closed ... {args}")
+
+
+async def get_js_context() -> JetStreamContext:
+    """Get JetStream Context."""
+    nc = Client()
+
+    await nc.connect(
+        servers="kcn_nats",
+        max_reconnect_attempts=-1,
+        reconnected_cb=reconnected_cb,
+        disconnected_cb=disconnected_cb,
+        error_cb=error_cb,
+        closed_cb=closed_cb,
+    )
+
+    return nc.jetstream()
+
+
+async def read_bucket(kv: KeyValue) -> dict[str, bytes]:
+    """Read last values of all keys in bucket by one watcher."""
+    watcher = await kv.watchall(ignore_deletes=True)
+    values = {}
+
+    # None is end of values stored before watch
+    while (entry := await watcher.updates()) is not None:
+        values[entry.key] = entry.value
+
+    await watcher.stop()
+    return values
+
+
+class Publisher:
+    """Publish to JetStream with window of messages waiting for ack."""
+
+    def __init__(
+        self: Self,
+        js: JetStreamContext,
+        window: int = 256,
+        attempts: int = 5,
+        retry_delay: float = 0.5,
+    ) -> None:
+        """Init publisher of js with window of in flight messages."""
+        self.js = js
+        self.window = asyncio.Semaphore(window)
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.background_tasks: set[asyncio.Task] = set()
+
+    async def publish(
+        self: Self,
+        subject: str,
+        payload: bytes,
+        msg_id: str,
+    ) -> asyncio.Task:
+        """Start publish and wait only free place in window, not the ack."""
+        await self.window.acquire()
+
+        task = asyncio.create_task(
+            self.send(subject, payload, {"Nats-Msg-Id": msg_id}),
+        )
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    async def send(
+        self: Self,
+        subject: str,
+        payload: bytes,
+        headers: dict,
+    ) -> PubAck | None:
+        """Publish message until ack and free its place in window."""
+        try:
+            return await self.send_with_retry(subject, payload, headers)
+        finally:
+            self.window.release()
+
+    async def send_with_retry(
+        self: Self,
+        subject: str,
+        payload: bytes,
+        headers: dict,
+        attempt: int = 1,
+    ) -> PubAck | None:
+        """Publish message, retry by the same Nats-Msg-Id is safe for dedupe."""
+        try:
+            return await self.js.publish(subject, payload, headers=headers)
+        except NatsError as exc:
+            return await self.retry(subject, payload, headers, attempt, exc)
+
+    async def retry(
+        self: Self,
+        subject: str,
+        payload: bytes,
+        headers: dict,
+        attempt: int,
+        exc: NatsError,
+    ) -> PubAck | None:
+        """Retry publish after backoff or give up after all attempts."""
+        if attempt >= self.attempts:
+            logger.error(f"Lost {subject}:{headers['Nats-Msg-Id']}:{exc!r}")
+            return None
+
+        logger.warning(f"Retry {attempt} {subject}:{headers['Nats-Msg-Id']}:{exc!r}")
+        await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+        return await self.send_with_retry(subject, payload, headers, attempt + 1)
+
+    async def flush(self: Self) -> None:
+        """Wait ack of all messages in window."""
+        await asyncio.gather(*self.background_tasks)
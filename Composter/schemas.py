@@ -0,0 +1,59 @@
+"""Typed schemas of exchange payloads decoded straight from bytes."""
+
+from typing import Annotated
+
+from loguru import logger
+from msgspec import DecodeError, Meta, Struct
+from msgspec.json import Decoder
+
+
+class Kline(Struct, gc=False):
+    """Kline of symbol, candles is [start, open, close, high, low, ...]."""
+
+    symbol: str
+    candles: Annotated[list[str], Meta(min_length=2)]
+
+
+class KlineFrame(Struct, gc=False):
+    """Websocket frame, only message frame has kline in data."""
+
+    type: str
+    data: Kline | None = None
+
+
+class Match(Struct, gc=False):
+    """Trade of symbol, time in nanoseconds."""
+
+    symbol: str
+    price: str
+    size: str
+    time: str
+
+
+class MatchFrame(Struct, gc=False):
+    """Websocket frame, only message frame has trade in data."""
+
+    type: str
+    data: Match | None = None
+
+
+kline_frame_decoder = Decoder(KlineFrame)
+match_frame_decoder = Decoder(MatchFrame)
+
+
+def decode_kline(recv: bytes) -> Kline | None:
+    """Get kline from frame, None for acks, pongs and malformed frames."""
+    try:
+        return kline_frame_decoder.decode(recv).data
+    except DecodeError as e:
+        logger.warning(f"Skip frame:{e}:{recv[:200]}")
+        return None
+
+
+def decode_match(recv: bytes) -> Match | None:
+    """Get trade from frame, None for acks, pongs and malformed frames."""
+    try:
+        return match_frame_decoder.decode(recv).data
+    except DecodeError as e:
+        logger.warning(f"Skip frame:{e}:{recv[:200]}")
+        return None
@@ -1,79 +1,127 @@
-"""Tools for Composter."""
-
-from collections.abc import Generator
-
-import aiohttp
-from loguru import logger
-from orjson import loads
-
-from models import Access
-
-
-async def request(
-    url: str,
-    method: str,
-    headers: dict,
-    *,
-    data_json: str | None = None,
-) -> dict:
-    """Universal http reqponse."""
-    async with (
-        aiohttp.ClientSession(headers=headers) as session,
-        session.request(method, url, data=data_json) as response,
-    ):
-        res = await response.read()  # bytes
-        data = loads(res)  # dict ['code':str, 'data':dict]
-
-        match data["code"]:
-            case "200000":
-                result = data["data"]
-                logger.success(f"{response.status}:{method}:{url}")
-            case _:
-                logger.warning(f"{response.status}:{method}:{url}:{headers}")
-                result = {}
-
-        return result
-
-
-def get_headers(
-    access: Access = None,
-    str_to_sign: str = "",
-    now_time: str = "",
-    *,
-    auth: bool = True,
-) -> dict:
-    """Get headers for request."""
-    if auth:
-        result = {
-            "KC-API-SIGN": access.encrypted(str_to_sign),
-            "KC-API-TIMESTAMP": now_time,
-            "KC-API-PASSPHRASE": access.encrypted(access.passphrase),
-            "KC-API-KEY": access.key,
-            "Content-Type": "application/json",
-            "KC-API-KEY-VERSION": "2",
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-    else:
-        result = {
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-
-    return result
-
-
-def divide_chunks(length: list, number: int) -> Generator:
-    """Функция разбиения словаря на подсловари по number значений."""
-    for itr in range(0, len(length), number):
-        yield length[itr : itr + number]
-
-
-async def get_public_token(
-    method: str = "POST",
-    url: str = "https://api.kucoin.com/api/v1/bullet-public",
-) -> dict:
-    """Get auth data for create websocket connection."""
-    return await request(
-        url,
-        method,
-        get_headers(auth=False),
-    )
+"""Tools for Composter."""
+
+from collections.abc import Callable, Generator
+from functools import partial
+from time import time
+
+from loguru import logger
+from orjson import loads
+
+from models import Access, HttpClient, RateLimit
+
+http_client = HttpClient()
+rate_limit = RateLimit()
+
+PUBLIC_HEADERS = {"User-Agent": "kucoin-python-sdk/2"}
+
+
+def get_data_json(params: dict) -> str:
+    """Convert dict to url params."""
+    data_json = ""
+
+    data_json += "&".join([f"{key}={params[key]}" for key in sorted(params)])
+    return data_json
+
+
+async def request(
+    url: str,
+    method: str,
+    headers: Callable[[], dict],
+    *,
+    data_json: str | None = None,
+    pool: tuple[str, int] = ("public", 1),
+) -> dict:
+    """Universal http reqponse.
+
+    Request wait own weight in rate limit pool, headers signed after wait.
+    """
+    await rate_limit.acquire(*pool)
+
+    async with http_client.get_session().request(
+        method,
+        url,
+        headers=headers(),
+        data=data_json,
+    ) as response:
+        res = await response.read()  # bytes
+        data = loads(res)  # dict ['code':str, 'data':dict]
+        rate_limit.update(pool[0], response.headers, data["code"])
+
+        match data["code"]:
+            case "200000":
+                result = data["data"]
+                logger.success(f"{response.status}:{method}:{url}")
+            case _:
+                logger.warning(f"{response.status}:{method}:{url}:{data}")
+                result = {}
+
+        return result
+
+
+def get_headers(
+    access: Access = None,
+    str_to_sign: str = "",
+    *,
+    auth: bool = True,
+) -> dict:
+    """Get headers for request.
+
+    str_to_sign is method, uri and body of request without timestamp.
+    """
+    if auth:
+        result = access.get_auth_headers(str_to_sign, str(int(time()) * 1000))
+    else:
+        result = PUBLIC_HEADERS
+
+    return result
+
+
+def divide_chunks(length: list, number: int) -> Generator:
+    """Функция разбиения словаря на подсловари по number значений."""
+    for itr in range(0, len(length), number):
+        yield length[itr : itr + number]
+
+
+async def get_public_token(
+    method: str = "POST",
+    url: str = "https://api.kucoin.com/api/v1/bullet-public",
+    pool: tuple[str, int] = ("public", 10),  # rate limit pool and weight
+) -> dict:
+    """Get auth data for create websocket connection."""
+    return await request(
+        url,
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+    )
+
+
+async def get_candles(
+    params: dict,
+    *,
+    method: str = "GET",
+    url: str = "https://api.kucoin.com/api/v1/market/candles",
+    pool: tuple[str, int] = ("public", 3),  # rate limit pool and weight
+) -> list | dict:
+    """Get candles of symbol newest first, empty dict on error."""
+    return await request(
+        f"{url}?{get_data_json(params)}",
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+    )
+
+
+# Seconds in unit of candle type of exchange
+INTERVAL_UNITS = {
+    "min": 60,
+    "hour": 60 * 60,
+    "day": 24 * 60 * 60,
+    "week": 7 * 24 * 60 * 60,
+}
+
+
+def get_interval(time_shift: str) -> int:
+    """Get seconds of candle type like 15min or 1hour."""
+    unit = time_shift.lstrip("0123456789")
+    return int(time_shift.removesuffix(unit)) * INTERVAL_UNITS[unit]
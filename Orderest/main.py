@@ -1,47 +1,358 @@
-"""KCN Orderest."""
-
-import asyncio
-
-from decouple import config
-from loguru import logger
-
-from models import Access
-from tools import cancel_order, get_order_list, get_seconds_to_next_minutes
-
-
-async def find_order_for_cancel(access: Access) -> None:
-    """Find order created more then 1 hour ago."""
-    orders = await get_order_list(
-        access,
-        params={
-            "type": "limit",
-            "tradeType": "MARGIN_TRADE",
-            "status": "active",
-        },
-    )
-    for item in orders["items"]:
-        logger.warning(f"Need cancel:{item}")
-        await cancel_order(access, f"/api/v1/orders/{item['id']}")
-
-
-async def main() -> None:
-    """Main func in microservice."""
-    # Access object
-    access = Access(
-        key=config("KEY", cast=str),
-        secret=config("SECRET", cast=str),
-        passphrase=config("PASSPHRASE", cast=str),
-        base_uri="https://api.kucoin.com",
-    )
-
-    while True:
-        wait_seconds = get_seconds_to_next_minutes(59)
-
-        logger.info(f"Wait {wait_seconds} to run find_order_for_cancel")
-        await asyncio.sleep(wait_seconds)
-
-        await find_order_for_cancel(access)
-
-
-if __name__ == "__main__":
-    asyncio.run(main())
+"""KCN Orderest."""
+
+import asyncio
+from collections import Counter, defaultdict
+from itertools import chain
+from time import perf_counter, time
+from uuid import uuid4
+
+import orjson
+from decouple import config
+from loguru import logger
+from websockets import ClientProtocol, connect
+
+from models import Access, TimerWheel
+from tools import (
+    cancel_all_orders,
+    cancel_order,
+    clock,
+    get_all_orders,
+    get_private_token,
+    get_seconds_to_next_minutes,
+    http_client,
+    init_clock,
+    sync_clock,
+)
+
+# Symbol with so many orders cancelled by one cancel all request
+BULK_CANCEL_FROM = 2
+
+# Expired order not confirmed as cancelled tried again after this many
+# seconds, at most CANCEL_RETRIES times
+CANCEL_RETRY_DELAY = 5
+CANCEL_RETRIES = 12
+
+ACTIVE_ORDERS = {
+    "type": "limit",
+    "tradeType": "MARGIN_TRADE",
+    "status": "active",
+}
+
+
+async def get_orders_by_symbol(access: Access) -> dict[str, list[str]]:
+    """Get ids of all active margin limit orders grouped by symbol."""
+    orders = defaultdict(list)
+
+    for item in await get_all_orders(access, params=ACTIVE_ORDERS):
+        orders[item.symbol].append(item.id)
+
+    return orders
+
+
+async def cancel_one_order(
+    access: Access,
+    order_id: str,
+    semaphore: asyncio.Semaphore,
+) -> list[str]:
+    """Cancel one order, return list of cancelled ids."""
+    async with semaphore:
+        result = await cancel_order(access, f"/api/v1/orders/{order_id}")
+
+    return result.get("cancelledOrderIds", [])
+
+
+async def cancel_each_order(
+    access: Access,
+    order_ids: list[str],
+    semaphore: asyncio.Semaphore,
+) -> list[str]:
+    """Cancel orders one by one in parallel, return list of cancelled ids."""
+    results = await asyncio.gather(
+        *[cancel_one_order(access, order_id, semaphore) for order_id in order_ids],
+    )
+    return list(chain.from_iterable(results))
+
+
+async def cancel_symbol_orders(
+    access: Access,
+    symbol: str,
+    order_ids: list[str],
+    semaphore: asyncio.Semaphore,
+) -> list[str]:
+    """Cancel orders of symbol by one request to cancel all by symbol."""
+    async with semaphore:
+        result = await cancel_all_orders(
+            access,
+            {"symbol": symbol, "tradeType": "MARGIN_TRADE"},
+        )
+
+    logger.info(f"Bulk cancel:{symbol}:{len(order_ids)} orders")
+    return result.get("cancelledOrderIds", [])
+
+
+async def cancel_orders(
+    access: Access,
+    symbol: str,
+    order_ids: list[str],
+    semaphore: asyncio.Semaphore,
+) -> tuple[str, list[str]]:
+    """Cancel orders of symbol, few orders cancelled one by one."""
+    if len(order_ids) >= BULK_CANCEL_FROM:
+        cancelled = await cancel_symbol_orders(access, symbol, order_ids, semaphore)
+    else:
+        cancelled = await cancel_each_order(access, order_ids, semaphore)
+
+    return symbol, cancelled
+
+
+def report_sweep(orders: dict, results: dict, duration: float) -> None:
+    """Log per symbol results and duration of cancel sweep."""
+    for symbol, order_ids in orders.items():
+        not_cancelled = set(order_ids) - set(results[symbol])
+        log = logger.warning if not_cancelled else logger.success
+        log(f"Cancel:{symbol}:{len(order_ids) - len(not_cancelled)}/{len(order_ids)}")
+
+    logger.info(
+        f"Cancel sweep:{sum(map(len, orders.values()))} orders:"
+        f"{len(orders)} symbols:{duration:.2f} s",
+    )
+
+
+async def find_order_for_cancel(
+    access: Access,
+    semaphore: asyncio.Semaphore,
+) -> None:
+    """Find order created more then 1 hour ago and cancel all of them."""
+    start = perf_counter()
+
+    orders = await get_orders_by_symbol(access)
+
+    results = await asyncio.gather(
+        *[
+            cancel_orders(access, symbol, order_ids, semaphore)
+            for symbol, order_ids in orders.items()
+        ],
+    )
+
+    report_sweep(orders, dict(results), perf_counter() - start)
+
+
+def get_server_time() -> float:
+    """Get corrected server time in seconds."""
+    return time() + clock.offset / 1000
+
+
+async def get_url_websocket(access: Access) -> tuple[str, float]:
+    """SetUp and get url and ping interval in seconds for websocket."""
+    private_token = await get_private_token(access)
+
+    instance_server = private_token["instanceServers"][0]
+    endpoint = instance_server["endpoint"]
+    token = private_token["token"]
+
+    return (
+        f"{endpoint}?token={token}&connectId={str(uuid4()).replace('-', '')}",
+        instance_server["pingInterval"] / 1000,
+    )
+
+
+async def set_up_subscribe(ws: ClientProtocol) -> None:
+    """SetUp subscribe to change of orders."""
+    await ws.send(
+        orjson.dumps(
+            {
+                "id": str(int(time() * 1000)),
+                "type": "subscribe",
+                "topic": "/spotMarket/tradeOrders",
+                "privateChannel": True,
+            },
+        ).decode(),
+    )
+
+
+async def ping(ws: ClientProtocol, interval: float) -> None:
+    """Send ping by interval to keep websocket alive."""
+    while True:
+        await asyncio.sleep(interval)
+        await ws.send(
+            orjson.dumps({"id": str(int(time() * 1000)), "type": "ping"}).decode(),
+        )
+
+
+async def seed_orders(access: Access, wheel: TimerWheel, ttl: int) -> None:
+    """Add timers of orders active in excange before subscribe."""
+    for item in await get_all_orders(access, params=ACTIVE_ORDERS):
+        wheel.add(item.id, item.created_at / 1000 + ttl)
+
+    logger.info(f"Watch {len(wheel)} active orders")
+
+
+def open_order(data: dict, wheel: TimerWheel, ttl: int) -> None:
+    """Add timer of opened order."""
+    wheel.add(data["orderId"], data["orderTime"] / 1e9 + ttl)
+
+
+def close_order(data: dict, wheel: TimerWheel, _ttl: int) -> None:
+    """Cancel timer of filled or canceled order."""
+    wheel.cancel(data["orderId"])
+
+
+# Handlers of order change by its type, other types are skipped
+ORDER_HANDLERS = {
+    "open": open_order,
+    "filled": close_order,
+    "canceled": close_order,
+}
+
+
+def event(msg: dict, wheel: TimerWheel, ttl: int) -> None:
+    """Work with change of order on exchange.
+
+    Only limit order can be open, market order go straight to filled.
+    """
+    data = msg.get("data")  # str in error frames
+    handler = ORDER_HANDLERS.get(data.get("type")) if isinstance(data, dict) else None
+
+    if handler is not None:
+        handler(data, wheel, ttl)
+
+
+async def get_cancelled(
+    access: Access,
+    order_ids: list[str],
+    semaphore: asyncio.Semaphore,
+) -> set[str]:
+    """Cancel orders, get ids confirmed as cancelled, none on error."""
+    try:
+        return set(await cancel_each_order(access, order_ids, semaphore))
+    except Exception as e:
+        logger.exception(e)
+        return set()
+
+
+def rearm_order(wheel: TimerWheel, order_id: str, retries: Counter) -> None:
+    """Put timer of not cancelled order again, give up after CANCEL_RETRIES."""
+    retries[order_id] += 1
+
+    if retries[order_id] <= CANCEL_RETRIES:
+        logger.warning(f"Cancel again:{order_id}:{retries[order_id]}")
+        wheel.add(order_id, get_server_time() + CANCEL_RETRY_DELAY)
+    else:
+        logger.error(f"Not cancelled:{order_id}")
+        del retries[order_id]
+
+
+def forget_orders(retries: Counter, order_ids: set[str]) -> None:
+    """Drop retries of cancelled orders."""
+    for order_id in order_ids:
+        retries.pop(order_id, None)
+
+
+async def expire_tick(
+    access: Access,
+    wheel: TimerWheel,
+    semaphore: asyncio.Semaphore,
+    retries: Counter,
+) -> None:
+    """Cancel orders expired on tick, re-arm ones not confirmed as cancelled.
+
+    Filled or canceled order event cancel the re-armed timer.
+    """
+    order_ids = wheel.advance(get_server_time())
+    cancelled = await get_cancelled(access, order_ids, semaphore)
+    forget_orders(retries, cancelled)
+
+    for order_id in [order_id for order_id in order_ids if order_id not in cancelled]:
+        rearm_order(wheel, order_id, retries)
+
+
+async def expire_orders(
+    access: Access,
+    wheel: TimerWheel,
+    semaphore: asyncio.Semaphore,
+) -> None:
+    """Cancel orders with expired ttl on each tick of timer wheel."""
+    background_tasks = set()
+    retries = Counter()  # order id -> cancels tried again
+
+    while True:
+        await asyncio.sleep(wheel.resolution)
+
+        task = asyncio.create_task(expire_tick(access, wheel, semaphore, retries))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def watch_orders(
+    access: Access,
+    semaphore: asyncio.Semaphore,
+    ttl: int,
+) -> None:
+    """Cancel each order exactly after ttl since its creation.
+
+    Open orders indexed by private order stream, REST listing used only
+    once after subscribe to get orders created before start.
+    """
+    wheel = TimerWheel(now=get_server_time())
+    url, ping_interval = await get_url_websocket(access)
+
+    async with connect(url, max_queue=1024) as ws:
+        await ws.recv()  # {  "id": "hQvf8jkno",  "type": "welcome"}
+        await set_up_subscribe(ws)
+        await seed_orders(access, wheel, ttl)
+
+        expire_task = asyncio.create_task(expire_orders(access, wheel, semaphore))
+        ping_task = asyncio.create_task(ping(ws, ping_interval))
+
+        try:
+            while True:
+                event(orjson.loads(await ws.recv()), wheel, ttl)
+        finally:
+            expire_task.cancel()
+            ping_task.cancel()
+
+
+async def sweep_orders(access: Access, semaphore: asyncio.Semaphore) -> None:
+    """Cancel all active orders each hour at 59 minute."""
+    while True:
+        wait_seconds = get_seconds_to_next_minutes(59)
+
+        logger.info(f"Wait {wait_seconds} to run find_order_for_cancel")
+        await asyncio.sleep(wait_seconds)
+
+        await find_order_for_cancel(access, semaphore)
+
+
+async def main() -> None:
+    """Main func in microservice."""
+    # Access object
+    access = Access(
+        key=config("KEY", cast=str),
+        secret=config("SECRET", cast=str),
+        passphrase=config("PASSPHRASE", cast=str),
+        base_uri="https://api.kucoin.com",
+    )
+
+    # Corrected clock for sign requests
+    await init_clock(access)
+    sync_clock_task = asyncio.create_task(sync_clock(access))
+
+    # Max of cancel requests in flight
+    semaphore = asyncio.Semaphore(config("CANCEL_CONCURRENCY", cast=int, default=20))
+
+    # Order cancelled after ORDER_TTL seconds since creation,
+    # 0 is cancel of all orders each hour at 59 minute
+    ttl = config("ORDER_TTL", cast=int, default=3540)
+
+    try:
+        if ttl:
+            await watch_orders(access, semaphore, ttl)
+        else:
+            await sweep_orders(access, semaphore)
+    finally:
+        sync_clock_task.cancel()
+        await http_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,168 +1,531 @@
-"""Classes for work."""
-
-import hashlib
-import hmac
-from base64 import b64encode
-from decimal import Decimal
-from typing import Self
-
-
-class Access:
-    """Class for store access condention to exchange."""
-
-    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
-        """Init access condention keys."""
-        self.key: str = key
-        self.secret: str = secret
-        self.passphrase: str = passphrase
-        self.base_uri: str = base_uri
-
-    def encrypted(self: Self, msg: str) -> str:
-        """Encrypted msg for exchange."""
-        return b64encode(
-            hmac.new(
-                self.secret.encode("utf-8"),
-                msg.encode("utf-8"),
-                hashlib.sha256,
-            ).digest(),
-        ).decode()
-
-
-class Token:
-    """Class for store token data for trade."""
-
-    def __init__(
-        self: Self,
-        currency: list,
-        ignore_currency: list,
-        base_keep: Decimal,
-        time_shift: str = "1hour",
-        base_stable: str = "USDT",
-    ) -> None:
-        """Init class for store trade tokens."""
-        self.trade_currency: list[str] = currency  # Tokens for trade in bot
-        self.ignore_currency: list[str] = ignore_currency
-        self.base_keep: Decimal = base_keep
-        self.base_stable: str = base_stable
-        self.time_shift: str = time_shift
-        self.borrow_size: Decimal = Decimal("0")
-        self.avail_size: Decimal = Decimal("0")
-
-        self.accept_tokens: list[str] = []  # tradable tokens
-        self.new_tokens: list[str] = (
-            []
-        )  # tokens that can be traded but are not in the bot
-        self.del_tokens: list[str] = (
-            []
-        )  # tokens that have been removed from the exchange
-        self.history: dict = {}
-
-    def init_history(self: Self) -> None:
-        """Init history."""
-        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
-
-    def get_candles_for_kline(self: Self, tokens: list) -> str:
-        """Get str candles for kline websocket."""
-        return ",".join(
-            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
-        )
-
-    def get_clear_borrow(self: Self) -> Decimal:
-        """Get clear borrow size."""
-        return self.borrow_size - self.avail_size
-
-    def get_percent_borrow(self: Self) -> int:
-        """Get percent of borrowing."""
-        return (
-            self.get_clear_borrow()
-            * 100
-            / (self.trade_currency * float(self.base_keep))
-        )
-
-    def get_len_trade_currency(self: Self) -> int:
-        """Get len of trade_currency."""
-        return len(self.trade_currency)
-
-    def get_len_accept_tokens(self: Self) -> int:
-        """Get len of accept_tokens."""
-        return len(self.accept_tokens)
-
-    def get_len_del_tokens(self: Self) -> int:
-        """Get len del_tokens."""
-        return len(self.del_tokens)
-
-    def get_len_ignore_currency(self: Self) -> int:
-        """Get len of ignore_currency."""
-        return len(self.ignore_currency)
-
-    def get_len_new_tokens(self: Self) -> int:
-        """Get len of new_tokens."""
-        return len(self.new_tokens)
-
-    @staticmethod
-    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
-        """Remove postfix."""
-        return symbol.replace(postfix, "")
-
-    def save_accept_tokens(self: Self, all_token_in_excange: list) -> None:
-        """Save all accepted token."""
-        self.accept_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if token_in_excange["isMarginEnabled"]
-            and token_in_excange["quoteCurrency"] == "USDT"
-            and Token.remove_postfix(token_in_excange["symbol"])
-            not in self.ignore_currency
-        ]
-
-    def save_new_tokens(self: Self, all_token_in_excange: list) -> None:
-        """."""
-        self.new_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if Token.remove_postfix(token_in_excange["symbol"])
-            not in self.accept_tokens
-        ]
-
-    def save_del_tokens(self: Self) -> None:
-        """."""
-        self.del_tokens = [
-            used for used in self.trade_currency if used not in self.accept_tokens
-        ]
-
-
-class OrderBook:
-    """Class for store orders data from excange."""
-
-    def __init__(self: Self, token: Token) -> None:
-        """Init order book by symbol from config by available 0."""
-        self.order_book: dict = {s: {"available": 0} for s in token.trade_currency}
-
-    def fill_order_book(self: Self, account_list: list) -> None:
-        """Fill real available from exchange."""
-        self.order_book: dict = {
-            account["currency"]: {"available": account["available"]}
-            for account in account_list
-            if account["currency"] in self.order_book
-        }
-
-    def fill_base_increment(self: Self, symbol_increments: list) -> None:
-        """Fill real baseincrement from exchange.
-
-        after:
-        {"ICP":{"available":"123"}}
-
-        before:
-        {"ICP":{"available":"123","baseincrement":"0.0001"}}
-        """
-        self.order_book.update(
-            {
-                symbol_increment["baseCurrency"]: {
-                    "baseincrement": symbol_increment["baseIncrement"],
-                    "available": self.order_book[symbol_increment["baseCurrency"]],
-                }
-                for symbol_increment in symbol_increments
-                if symbol_increment["baseCurrency"] in self.order_book
-                and symbol_increment["quoteCurrency"] == "USDT"
-            },
-        )
+"""Classes for work."""
+
+import asyncio
+import hashlib
+import hmac
+from base64 import b64encode
+from collections.abc import Awaitable, Callable, Mapping
+from decimal import Decimal
+from random import SystemRandom
+from time import monotonic, time
+from typing import Self
+
+import aiohttp
+import orjson
+from loguru import logger
+
+
+class Access:
+    """Class for store access condention to exchange."""
+
+    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
+        """Init access condention keys."""
+        self.key: str = key
+        self.secret: str = secret
+        self.passphrase: str = passphrase
+        self.base_uri: str = base_uri
+        # keyed once, each sign work on copy of this state
+        self.hmac_key = hmac.new(self.secret.encode("utf-8"), digestmod=hashlib.sha256)
+        self.encrypted_passphrase: str = self.encrypted(passphrase)
+        self.auth_headers: dict = {
+            "KC-API-PASSPHRASE": self.encrypted_passphrase,
+            "KC-API-KEY": self.key,
+            "Content-Type": "application/json",
+            "KC-API-KEY-VERSION": "2",
+            "User-Agent": "kucoin-python-sdk/2",
+        }
+
+    def encrypted(self: Self, msg: str) -> str:
+        """Encrypted msg for exchange."""
+        signer = self.hmac_key.copy()
+        signer.update(msg.encode("utf-8"))
+        return b64encode(signer.digest()).decode()
+
+    def get_auth_headers(self: Self, str_to_sign: str, now_time: str) -> dict:
+        """Get auth headers, only timestamp and sign computed per call."""
+        return {
+            **self.auth_headers,
+            "KC-API-SIGN": self.encrypted(f"{now_time}{str_to_sign}"),
+            "KC-API-TIMESTAMP": now_time,
+        }
+
+
+class HttpClient:
+    """Class for store long-lived pooled http session to exchange."""
+
+    def __init__(
+        self: Self,
+        limit: int = 100,
+        limit_per_host: int = 50,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: int = 75,
+        timeout: int = 10,
+    ) -> None:
+        """Init settings of connection pool."""
+        self.limit: int = limit
+        self.limit_per_host: int = limit_per_host
+        self.ttl_dns_cache: int = ttl_dns_cache
+        self.keepalive_timeout: int = keepalive_timeout
+        self.timeout: int = timeout
+        self.session: aiohttp.ClientSession | None = None
+
+    def get_session(self: Self) -> aiohttp.ClientSession:
+        """Get opened session or open new one with warm connection pool.
+
+        Session created lazily, because aiohttp need running event loop.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    ttl_dns_cache=self.ttl_dns_cache,
+                    use_dns_cache=True,
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self: Self) -> None:
+        """Close session and release all pooled connections."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+class RateLimit:
+    """Class for store client side rate limit of exchange.
+
+    Token bucket for each resource pool of exchange, refilled on reset of
+    pool window and corrected by gw-ratelimit headers from responses.
+    """
+
+    def __init__(
+        self: Self,
+        limits: dict | None = None,
+        window: float = 30,
+    ) -> None:
+        """Init pools by default quota for 30 seconds window."""
+        self.window: float = window
+        self.limits: dict[str, int] = limits or {
+            "spot": 4000,
+            "margin": 4000,
+            "management": 2000,
+            "public": 2000,
+        }
+        self.remaining: dict[str, int] = self.limits.copy()
+        self.reset_at: dict[str, float] = dict.fromkeys(
+            self.limits,
+            monotonic() + window,
+        )
+        self.locks: dict[str, asyncio.Lock] = {
+            pool: asyncio.Lock() for pool in self.limits
+        }
+
+    def refill(self: Self, pool: str) -> None:
+        """Refill pool if window of pool is over."""
+        if monotonic() >= self.reset_at[pool]:
+            self.remaining[pool] = self.limits[pool]
+            self.reset_at[pool] = monotonic() + self.window
+
+    async def acquire(self: Self, pool: str, weight: int = 1) -> None:
+        """Wait weight in pool, requests go out in order of call."""
+        async with self.locks[pool]:
+            self.refill(pool)
+            while self.remaining[pool] < weight:
+                logger.warning(f"Rate limit {pool}:wait to reset")
+                await asyncio.sleep(self.reset_at[pool] - monotonic())
+                self.refill(pool)
+            self.remaining[pool] -= weight
+
+    def update(self: Self, pool: str, headers: Mapping, code: str) -> None:
+        """Update pool by code and gw-ratelimit headers of response."""
+        if code == "429000":  # pool is empty till reset
+            self.remaining[pool] = 0
+
+        self.update_by_headers(pool, headers)
+
+    def update_by_headers(self: Self, pool: str, headers: Mapping) -> None:
+        """Update pool by gw-ratelimit headers of response."""
+        if "gw-ratelimit-remaining" not in headers:
+            return
+
+        self.limits[pool] = int(headers["gw-ratelimit-limit"])
+        self.remaining[pool] = min(
+            self.remaining[pool],
+            int(headers["gw-ratelimit-remaining"]),
+        )
+        self.reset_at[pool] = monotonic() + int(headers["gw-ratelimit-reset"]) / 1000
+
+
+class Clock:
+    """Class for store offset of local clock to exchange server clock.
+
+    Offset estimated from samples of server timestamp, compensated by half
+    of round trip and smoothed by exponential moving average.
+    """
+
+    def __init__(self: Self, alpha: float = 0.2, max_rtt: float = 1000) -> None:
+        """Init clock without offset."""
+        self.alpha: float = alpha
+        self.max_rtt: float = max_rtt  # ms, samples with longer round trip ignored
+        self.offset: float = 0  # ms, server minus local
+        self.samples: int = 0
+
+    def add_sample(
+        self: Self,
+        server_time: int,
+        sent_at: float,
+        received_at: float,
+    ) -> None:
+        """Add server time in ms, requested between local sent_at and received_at."""
+        if received_at - sent_at > self.max_rtt:
+            logger.warning(f"Skip clock sample:rtt {received_at - sent_at:.0f} ms")
+            return
+
+        alpha = max(self.alpha, 1 / (self.samples + 1))  # first sample as is
+        self.offset += alpha * (server_time - (sent_at + received_at) / 2 - self.offset)
+        self.samples += 1
+
+    def get_timestamp(self: Self) -> str:
+        """Get corrected timestamp in ms for sign request."""
+        return str(int(time() * 1000 + self.offset))
+
+
+class Retry:
+    """Class for store retry policy of requests to exchange.
+
+    Codes of rate limit and unavailable server are retryable, any other code
+    (balance insufficient 200004, invalid size 400100, ...) is terminal.
+    Network errors retried only for idempotent-safe requests.
+    """
+
+    NETWORK_ERRORS = (aiohttp.ClientError, TimeoutError, orjson.JSONDecodeError)
+    NETWORK_ERROR_CODE = "network"
+    RETRYABLE_CODES = frozenset({"429000", "500000", "503000", NETWORK_ERROR_CODE})
+
+    def __init__(
+        self: Self,
+        attempts: int = 4,
+        base_delay: float = 0.1,
+        max_delay: float = 2,
+        hedge_after: float = 0,
+    ) -> None:
+        """Init policy, hedge_after 0 turn off hedged requests."""
+        self.attempts: int = attempts
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.hedge_after: float = hedge_after
+        self.random = SystemRandom()
+
+    def get_delay(self: Self, attempt: int) -> float:
+        """Get exponential backoff with full jitter."""
+        return self.random.uniform(
+            0,
+            min(self.max_delay, self.base_delay * 2**attempt),
+        )
+
+    async def run(
+        self: Self,
+        func: Callable[[], Awaitable[dict]],
+        *,
+        idempotent: bool,
+        attempt: int = 1,
+    ) -> dict:
+        """Run request and repeat it while answer is retryable."""
+        data = await self.try_once(func, idempotent=idempotent)
+
+        if attempt < self.attempts and data["code"] in self.RETRYABLE_CODES:
+            delay = self.get_delay(attempt)
+            logger.warning(f"Retry {attempt}:{data['code']}:after {delay:.2f} s")
+            await asyncio.sleep(delay)
+            return await self.run(func, idempotent=idempotent, attempt=attempt + 1)
+
+        return data
+
+    async def try_once(
+        self: Self,
+        func: Callable[[], Awaitable[dict]],
+        *,
+        idempotent: bool,
+    ) -> dict:
+        """Run request, network error of idempotent request mark as retryable."""
+        errors = self.NETWORK_ERRORS if idempotent else ()
+        try:
+            return await self.hedge(func, idempotent=idempotent)
+        except errors as e:
+            logger.warning(f"Network error:{e!r}")
+            return {"code": self.NETWORK_ERROR_CODE}
+
+    async def hedge(
+        self: Self,
+        func: Callable[[], Awaitable[dict]],
+        *,
+        idempotent: bool,
+    ) -> dict:
+        """Run request, duplicate idempotent one slower than hedge_after."""
+        if not (self.hedge_after and idempotent):
+            return await func()
+
+        return await self.race(func)
+
+    async def race(self: Self, func: Callable[[], Awaitable[dict]]) -> dict:
+        """Get first answer of request and its delayed copy, cancel the other."""
+        tasks = {
+            asyncio.create_task(func()),
+            asyncio.create_task(self.delayed(func)),
+        }
+        try:
+            return await self.first_answer(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def first_answer(self: Self, tasks: set[asyncio.Task]) -> dict:
+        """Get first answer without error, error only if both copies failed."""
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        answered = [task for task in done if task.exception() is None]
+
+        if answered or not pending:
+            return (answered or list(done))[0].result()
+
+        return await pending.pop()
+
+    async def delayed(self: Self, func: Callable[[], Awaitable[dict]]) -> dict:
+        """Run hedged copy of request after hedge_after."""
+        await asyncio.sleep(self.hedge_after)
+        logger.warning("Hedge slow request")
+        return await func()
+
+
+class Token:
+    """Class for store token data for trade."""
+
+    def __init__(
+        self: Self,
+        currency: list,
+        ignore_currency: list,
+        base_keep: Decimal,
+        time_shift: str = "1hour",
+        base_stable: str = "USDT",
+    ) -> None:
+        """Init class for store trade tokens."""
+        self.trade_currency: list[str] = currency  # Tokens for trade in bot
+        self.ignore_currency: list[str] = ignore_currency
+        self.base_keep: Decimal = base_keep
+        self.base_stable: str = base_stable
+        self.time_shift: str = time_shift
+        self.borrow_size: Decimal = Decimal("0")
+        self.avail_size: Decimal = Decimal("0")
+
+        self.accept_tokens: list[str] = []  # tradable tokens
+        self.new_tokens: list[str] = (
+            []
+        )  # tokens that can be traded but are not in the bot
+        self.del_tokens: list[str] = (
+            []
+        )  # tokens that have been removed from the exchange
+        self.history: dict = {}
+
+    def init_history(self: Self) -> None:
+        """Init history."""
+        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
+
+    def get_candles_for_kline(self: Self, tokens: list) -> str:
+        """Get str candles for kline websocket."""
+        return ",".join(
+            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
+        )
+
+    def get_clear_borrow(self: Self) -> Decimal:
+        """Get clear borrow size."""
+        return self.borrow_size - self.avail_size
+
+    def get_percent_borrow(self: Self) -> int:
+        """Get percent of borrowing."""
+        return (
+            self.get_clear_borrow()
+            * 100
+            / (self.trade_currency * float(self.base_keep))
+        )
+
+    def get_len_trade_currency(self: Self) -> int:
+        """Get len of trade_currency."""
+        return len(self.trade_currency)
+
+    def get_len_accept_tokens(self: Self) -> int:
+        """Get len of accept_tokens."""
+        return len(self.accept_tokens)
+
+    def get_len_del_tokens(self: Self) -> int:
+        """Get len del_tokens."""
+        return len(self.del_tokens)
+
+    def get_len_ignore_currency(self: Self) -> int:
+        """Get len of ignore_currency."""
+        return len(self.ignore_currency)
+
+    def get_len_new_tokens(self: Self) -> int:
+        """Get len of new_tokens."""
+        return len(self.new_tokens)
+
+    @staticmethod
+    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
+        """Remove postfix."""
+        return symbol.replace(postfix, "")
+
+    def save_accept_tokens(self: Self, all_token_in_excange: list) -> None:
+        """Save all accepted token."""
+        self.accept_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if token_in_excange["isMarginEnabled"]
+            and token_in_excange["quoteCurrency"] == "USDT"
+            and Token.remove_postfix(token_in_excange["symbol"])
+            not in self.ignore_currency
+        ]
+
+    def save_new_tokens(self: Self, all_token_in_excange: list) -> None:
+        """."""
+        self.new_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if Token.remove_postfix(token_in_excange["symbol"])
+            not in self.accept_tokens
+        ]
+
+    def save_del_tokens(self: Self) -> None:
+        """."""
+        self.del_tokens = [
+            used for used in self.trade_currency if used not in self.accept_tokens
+        ]
+
+
+class OrderBook:
+    """Class for store orders data from excange."""
+
+    def __init__(self: Self, token: Token) -> None:
+        """Init order book by symbol from config by available 0."""
+        self.order_book: dict = {s: {"available": 0} for s in token.trade_currency}
+
+    def fill_order_book(self: Self, account_list: list) -> None:
+        """Fill real available from exchange."""
+        self.order_book: dict = {
+            account["currency"]: {"available": account["available"]}
+            for account in account_list
+            if account["currency"] in self.order_book
+        }
+
+    def fill_base_increment(self: Self, symbol_increments: list) -> None:
+        """Fill real baseincrement from exchange.
+
+        after:
+        {"ICP":{"available":"123"}}
+
+        before:
+        {"ICP":{"available":"123","baseincrement":"0.0001"}}
+        """
+        self.order_book.update(
+            {
+                symbol_increment["baseCurrency"]: {
+                    "baseincrement": symbol_increment["baseIncrement"],
+                    "available": self.order_book[symbol_increment["baseCurrency"]],
+                }
+                for symbol_increment in symbol_increments
+                if symbol_increment["baseCurrency"] in self.order_book
+                and symbol_increment["quoteCurrency"] == "USDT"
+            },
+        )
+
+
+class TimerWheel:
+    """Class for store timers in hierarchical timer wheel.
+
+    Levels of wheel are seconds, minutes and hours. Timer put to level by
+    its distance and cascaded to lower level when its upper slot come, so
+    add, cancel and expire of each timer cost O(1).
+    """
+
+    def __init__(
+        self: Self,
+        now: float,
+        resolution: float = 1,
+        sizes: tuple = (60, 60, 24),
+    ) -> None:
+        """Init empty wheel from now."""
+        self.resolution: float = resolution
+        self.sizes: tuple = sizes
+        self.spans: list[int] = [1]  # ticks in one slot of each level
+        for size in sizes[:-1]:
+            self.spans.append(self.spans[-1] * size)
+
+        self.wheels: list[list[dict]] = [[{} for _ in range(size)] for size in sizes]
+        self.timers: dict[str, dict] = {}  # key -> slot with this key
+        self.current: int = int(now / resolution)
+
+    def __len__(self: Self) -> int:
+        """Get count of timers in wheel."""
+        return len(self.timers)
+
+    def get_level(self: Self, delta: int) -> int:
+        """Get level of wheel for timer after delta ticks."""
+        return sum(
+            delta >= span * size
+            for span, size in zip(self.spans[:-1], self.sizes[:-1], strict=True)
+        )
+
+    def add(self: Self, key: str, deadline: float) -> None:
+        """Add or replace timer by key, expired timer go to next tick."""
+        self.cancel(key)
+        ticks = max(int(deadline / self.resolution), self.current + 1)
+        self.put(key, ticks)
+
+    def put(self: Self, key: str, ticks: int) -> None:
+        """Put timer to slot of level by distance to current tick."""
+        level = self.get_level(ticks - self.current)
+        slot = self.wheels[level][ticks // self.spans[level] % self.sizes[level]]
+        slot[key] = ticks
+        self.timers[key] = slot
+
+    def cancel(self: Self, key: str) -> None:
+        """Cancel timer by key if exist."""
+        self.timers.pop(key, {}).pop(key, None)
+
+    def cascade(self: Self, level: int) -> None:
+        """Move timers of current slot of level to lower levels."""
+        slot = self.wheels[level][self.current // self.spans[level] % self.sizes[level]]
+        timers = slot.copy()
+        slot.clear()
+        for key, ticks in timers.items():
+            self.put(key, ticks)
+
+    def tick(self: Self) -> list[str]:
+        """Move wheel by one tick and get keys of expired timers."""
+        self.current += 1
+        for level in reversed(range(1, len(self.sizes))):
+            self.cascade_on_boundary(level)
+
+        return self.expire()
+
+    def expire(self: Self) -> list[str]:
+        """Clear current slot of lowest level and get its keys."""
+        slot = self.wheels[0][self.current % self.sizes[0]]
+        expired = list(slot)
+        slot.clear()
+        for key in expired:
+            del self.timers[key]
+
+        return expired
+
+    def cascade_on_boundary(self: Self, level: int) -> None:
+        """Cascade level if current tick is boundary of its slot."""
+        if self.current % self.spans[level] == 0:
+            self.cascade(level)
+
+    def advance(self: Self, now: float) -> list[str]:
+        """Move wheel till now and get keys of all expired timers."""
+        expired = []
+        for _ in range(int(now / self.resolution) - self.current):
+            expired.extend(self.tick())
+
+        return expired
@@ -0,0 +1,18 @@
+"""Typed schemas of exchange payloads converted from decoded json."""
+
+from msgspec import Struct
+
+
+class Order(Struct, gc=False, rename="camel"):
+    """Active order of symbol."""
+
+    id: str
+    symbol: str
+    created_at: int
+
+
+class OrderPage(Struct, gc=False, rename="camel"):
+    """Page of order list, empty page on error."""
+
+    items: list[Order] = []
+    total_page: int = 1
@@ -1,133 +1,294 @@
-"""Tools for Orderest."""
-
-from datetime import UTC, datetime
-from time import time
-from urllib.parse import urljoin
-
-import aiohttp
-from loguru import logger
-from orjson import loads
-
-from models import Access
-
-
-def get_data_json(params: dict) -> str:
-    """Convert dict to url params."""
-    data_json = ""
-
-    data_json += "&".join([f"{key}={params[key]}" for key in sorted(params)])
-    return data_json
-
-
-async def request(
-    url: str,
-    method: str,
-    headers: dict,
-    *,
-    data_json: str | None = None,
-) -> dict:
-    """Universal http reqponse."""
-    async with (
-        aiohttp.ClientSession(headers=headers) as session,
-        session.request(method, url, data=data_json) as response,
-    ):
-        res = await response.read()  # bytes
-        data = loads(res)  # dict ['code':str, 'data':dict]
-
-        match data["code"]:
-            case "200000":
-                result = data["data"]
-                logger.success(f"{response.status}:{method}:{url}")
-            case _:
-                logger.warning(f"{response.status}:{method}:{url}:{headers}")
-                result = {}
-
-        return result
-
-
-def get_headers(
-    access: Access = None,
-    str_to_sign: str = "",
-    now_time: str = "",
-    *,
-    auth: bool = True,
-) -> dict:
-    """Get headers for request."""
-    if auth:
-        result = {
-            "KC-API-SIGN": access.encrypted(str_to_sign),
-            "KC-API-TIMESTAMP": now_time,
-            "KC-API-PASSPHRASE": access.encrypted(access.passphrase),
-            "KC-API-KEY": access.key,
-            "Content-Type": "application/json",
-            "KC-API-KEY-VERSION": "2",
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-    else:
-        result = {
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-
-    return result
-
-
-async def cancel_order(
-    access: Access,
-    uri: str,
-    *,
-    method: str = "DELETE",
-) -> None:
-    """Cancel order by number."""
-    logger.info("Run cancel_order")
-
-    now_time = str(int(time()) * 1000)
-
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(
-            access,
-            f"{now_time}{method}{uri}",
-            now_time,
-        ),
-    )
-
-
-async def get_order_list(
-    access: Access,
-    params: dict,
-    *,
-    method: str = "GET",
-    uri: str = "/api/v1/orders",
-) -> dict:
-    """Get all active orders in excange."""
-    logger.info("Run get_order_list")
-
-    uri += "?" + get_data_json(params)
-    now_time = str(int(time()) * 1000)
-
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(
-            access,
-            f"{now_time}{method}{uri}",
-            now_time,
-        ),
-    )
-
-
-def get_seconds_to_next_minutes(minutes: int) -> int:
-    """Get next 10:00 minutes."""
-    logger.info("Run get_seconds_to_next_minutes")
-
-    now = datetime.now(tz=UTC)
-
-    if now.minute > minutes:
-        result_minute = 60 - now.minute + minutes
-    elif now.minute < minutes:
-        result_minute = minutes - now.minute
-    else:
-        result_minute = minutes
-
-    return result_minute * 60
+"""Tools for Orderest."""
+
+import asyncio
+from collections.abc import Callable
+from datetime import UTC, datetime
+from functools import partial
+from itertools import chain
+from time import time
+from urllib.parse import urljoin
+
+from loguru import logger
+from msgspec import convert
+from orjson import loads
+
+from models import Access, Clock, HttpClient, RateLimit, Retry
+from schemas import Order, OrderPage
+
+clock = Clock()
+http_client = HttpClient()
+rate_limit = RateLimit()
+retry = Retry()
+
+PUBLIC_HEADERS = {"User-Agent": "kucoin-python-sdk/2"}
+
+
+def get_data_json(params: dict) -> str:
+    """Convert dict to url params."""
+    data_json = ""
+
+    data_json += "&".join([f"{key}={params[key]}" for key in sorted(params)])
+    return data_json
+
+
+async def fetch(
+    url: str,
+    method: str,
+    headers: Callable[[], dict],
+    *,
+    data_json: str | None = None,
+    pool: tuple[str, int] = ("public", 1),
+) -> dict:
+    """Send request once and get full answer of exchange.
+
+    Request wait own weight in rate limit pool, headers signed after wait.
+    """
+    await rate_limit.acquire(*pool)
+
+    async with http_client.get_session().request(
+        method,
+        url,
+        headers=headers(),
+        data=data_json,
+    ) as response:
+        res = await response.read()  # bytes
+        data = loads(res)  # dict ['code':str, 'data':dict]
+        rate_limit.update(pool[0], response.headers, data["code"])
+        logger.debug(f"{response.status}:{method}:{url}:{data['code']}")
+
+        return data
+
+
+async def request(
+    url: str,
+    method: str,
+    headers: Callable[[], dict],
+    *,
+    data_json: str | None = None,
+    pool: tuple[str, int] = ("public", 1),
+) -> dict:
+    """Universal http reqponse.
+
+    Retryable answers repeated by retry policy with the same body, so order
+    with clientOid is idempotent-safe and can't be filled twice.
+    """
+    data = await retry.run(
+        partial(
+            fetch,
+            url,
+            method,
+            headers,
+            data_json=data_json,
+            pool=pool,
+        ),
+        idempotent=method != "POST" or '"clientOid"' in (data_json or ""),
+    )
+
+    match data["code"]:
+        case "200000":
+            result = data["data"]
+            logger.success(f"{method}:{url}")
+        case _:
+            logger.warning(f"{method}:{url}:{data}")
+            result = {}
+
+    return result
+
+
+def get_headers(
+    access: Access = None,
+    str_to_sign: str = "",
+    *,
+    auth: bool = True,
+) -> dict:
+    """Get headers for request.
+
+    str_to_sign is method, uri and body of request without timestamp.
+    """
+    if auth:
+        result = access.get_auth_headers(str_to_sign, clock.get_timestamp())
+    else:
+        result = PUBLIC_HEADERS
+
+    return result
+
+
+async def cancel_order(
+    access: Access,
+    uri: str,
+    *,
+    method: str = "DELETE",
+    pool: tuple[str, int] = ("spot", 3),  # rate limit pool and weight
+) -> dict:
+    """Cancel order by number."""
+    logger.info("Run cancel_order")
+
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}"),
+        pool=pool,
+    )
+
+
+async def cancel_all_orders(
+    access: Access,
+    params: dict,
+    *,
+    method: str = "DELETE",
+    uri: str = "/api/v1/orders",
+    pool: tuple[str, int] = ("spot", 10),  # rate limit pool and weight
+) -> dict:
+    """Cancel all orders by symbol and tradeType."""
+    logger.info(f"Run cancel_all_orders:{params['symbol']}")
+
+    uri += "?" + get_data_json(params)
+
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}"),
+        pool=pool,
+    )
+
+
+async def get_order_list(
+    access: Access,
+    params: dict,
+    *,
+    method: str = "GET",
+    uri: str = "/api/v1/orders",
+    pool: tuple[str, int] = ("spot", 2),  # rate limit pool and weight
+) -> OrderPage:
+    """Get page of active orders in excange, typed after retries done."""
+    logger.info("Run get_order_list")
+
+    uri += "?" + get_data_json(params)
+
+    data = await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}"),
+        pool=pool,
+    )
+
+    return convert(data, OrderPage)
+
+
+async def get_order_pages(
+    access: Access,
+    params: dict,
+    page_size: int,
+) -> list[OrderPage]:
+    """Get all pages of orders in excange.
+
+    First page tell totalPage, other pages requested concurrently in rate
+    limit.
+    """
+    first_page = await get_order_list(
+        access,
+        {**params, "currentPage": 1, "pageSize": page_size},
+    )
+    pages = await asyncio.gather(
+        *[
+            get_order_list(
+                access,
+                {**params, "currentPage": current_page, "pageSize": page_size},
+            )
+            for current_page in range(2, first_page.total_page + 1)
+        ],
+    )
+    return [first_page, *pages]
+
+
+async def get_all_orders(
+    access: Access,
+    params: dict,
+    *,
+    page_size: int = 500,
+) -> list[Order]:
+    """Get orders of all pages in excange."""
+    return list(
+        chain.from_iterable(
+            page.items for page in await get_order_pages(access, params, page_size)
+        ),
+    )
+
+
+async def get_private_token(
+    access: Access,
+    *,
+    method: str = "POST",
+    uri: str = "/api/v1/bullet-private",
+    pool: tuple[str, int] = ("spot", 10),  # rate limit pool and weight
+) -> dict:
+    """Get auth data for create private websocket connection."""
+    logger.info("Run get_private_token")
+
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}"),
+        pool=pool,
+    )
+
+
+def get_seconds_to_next_minutes(minutes: int) -> int:
+    """Get next 10:00 minutes."""
+    logger.info("Run get_seconds_to_next_minutes")
+
+    now = datetime.now(tz=UTC)
+
+    if now.minute > minutes:
+        result_minute = 60 - now.minute + minutes
+    elif now.minute < minutes:
+        result_minute = minutes - now.minute
+    else:
+        result_minute = minutes
+
+    return result_minute * 60
+
+
+async def get_server_timestamp(
+    access: Access,
+    *,
+    uri: str = "/api/v1/timestamp",
+    method: str = "GET",
+    pool: tuple[str, int] = ("public", 3),  # rate limit pool and weight
+) -> dict:
+    """Get timestamp from excange server."""
+    logger.info("Run get_server_timestamp")
+
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+    )
+
+
+async def update_clock(access: Access) -> None:
+    """Add one sample of server time to clock."""
+    sent_at = time() * 1000
+    server_time = await get_server_timestamp(access)
+    received_at = time() * 1000
+
+    if server_time:
+        clock.add_sample(server_time, sent_at, received_at)
+        logger.info(f"Clock offset:{clock.offset:.0f} ms")
+
+
+async def init_clock(access: Access, samples: int = 3) -> None:
+    """Take first samples of server time one by one for fast start."""
+    for _ in range(samples):
+        await update_clock(access)
+
+
+async def sync_clock(access: Access, interval: int = 60) -> None:
+    """Sync clock with exchange server in infinity loop.
+
+    Sample by interval also keep pooled connection to exchange warm.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await update_clock(access)
@@ -0,0 +1,265 @@
+"""Microbenchmarks for Processor hot paths.
+
+Run inside Processor directory: python benchmark.py
+"""
+
+import hashlib
+import hmac
+import tracemalloc
+from base64 import b64encode
+from collections.abc import Callable
+from decimal import Decimal
+from functools import partial
+from random import Random
+from time import perf_counter_ns, time
+from uuid import uuid4
+
+import numpy as np
+from orjson import dumps
+
+from main import get_side_and_size, get_sides_and_sizes
+from models import Access, Balance, Ledger, Token
+from tools import get_headers, get_margin_limit_order_body
+
+ROUNDS = 100_000
+SYMBOLS = [f"T{number}-USDT" for number in range(2000)]
+
+
+def timeit_ns(func: Callable, rounds: int = ROUNDS) -> float:
+    """Get mean ns per one call of func."""
+    start = perf_counter_ns()
+    for _ in range(rounds):
+        func()
+    return (perf_counter_ns() - start) / rounds
+
+
+def report(name: str, before: float, after: float, unit: str = "ns") -> None:
+    """Print result of one benchmark."""
+    print(  # noqa: T201
+        f"{name:<24}before:{before:>10.0f} {unit}\tafter:{after:>10.0f} {unit}"
+        f"\tx{before / after:.2f}",
+    )
+
+
+def legacy_encrypted(access: Access, msg: str) -> str:
+    """Sign msg as before: new hmac keyed by raw secret each call."""
+    return b64encode(
+        hmac.new(
+            access.secret.encode("utf-8"),
+            msg.encode("utf-8"),
+            hashlib.sha256,
+        ).digest(),
+    ).decode()
+
+
+def legacy_make_margin_limit_order(access: Access) -> dict:
+    """Body and headers of margin order as before signer."""
+    now_time = str(int(time()) * 1000)
+    data_json = dumps(
+        {
+            "clientOid": str(uuid4()).replace("-", ""),
+            "side": "buy",
+            "symbol": "BTC-USDT",
+            "price": "97000.1",
+            "size": "0.00001",
+            "type": "limit",
+            "timeInForce": "GTC",
+            "autoBorrow": True,
+            "autoRepay": True,
+        },
+    ).decode()
+    return {
+        "KC-API-SIGN": legacy_encrypted(
+            access,
+            f"{now_time}POST/api/v1/margin/order{data_json}",
+        ),
+        "KC-API-TIMESTAMP": now_time,
+        "KC-API-PASSPHRASE": legacy_encrypted(access, access.passphrase),
+        "KC-API-KEY": access.key,
+        "Content-Type": "application/json",
+        "KC-API-KEY-VERSION": "2",
+        "User-Agent": "kucoin-python-sdk/2",
+    }
+
+
+def make_margin_limit_order(access: Access) -> dict:
+    """Body and headers of margin order by signer and templates."""
+    data_json = get_margin_limit_order_body(
+        client_oid=uuid4().hex,
+        side="buy",
+        symbol="BTC-USDT",
+        price="97000.1",
+        size="0.00001",
+    )
+    return get_headers(access, f"POST/api/v1/margin/order{data_json}")
+
+
+def bench_signing() -> None:
+    """Per request CPU cost of signing before and after signer."""
+    access = Access(
+        key="key",
+        secret="0123456789abcdef0123456789abcdef",  # noqa: S106
+        passphrase="passphrase",  # noqa: S106
+        base_uri="https://api.kucoin.com",
+    )
+    report(
+        "sign",
+        timeit_ns(lambda: legacy_encrypted(access, "1700000000000GET/api/v1/orders")),
+        timeit_ns(lambda: access.encrypted("1700000000000GET/api/v1/orders")),
+    )
+    report(
+        "margin order request",
+        timeit_ns(lambda: legacy_make_margin_limit_order(access)),
+        timeit_ns(lambda: make_margin_limit_order(access)),
+    )
+
+
+def get_size(build: Callable) -> int:
+    """Get bytes allocated by object from build."""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def legacy_build_ledger() -> dict:
+    """Ledger as before: dict of dicts by symbol."""
+    ledger = {}
+    for symbol in SYMBOLS:
+        ledger.update(
+            {
+                symbol: {
+                    "baseincrement": Decimal("0.0001"),
+                    "available": Decimal("12.5"),
+                },
+            },
+        )
+    return ledger
+
+
+def build_ledger() -> Ledger:
+    """Ledger of slot based records."""
+    ledger = Ledger()
+    for symbol in SYMBOLS:
+        ledger.update(symbol, Decimal("12.5"), Decimal("0.0001"))
+    return ledger
+
+
+def bench_ledger() -> None:
+    """Memory, lookup and update cost of ledger on all symbols."""
+    legacy, ledger = legacy_build_ledger(), build_ledger()
+    rounds = ROUNDS // len(SYMBOLS)
+    available, baseincrement = Decimal("13.5"), Decimal("0.0001")
+    report(
+        f"ledger {len(SYMBOLS)} symbols",
+        get_size(legacy_build_ledger),
+        get_size(build_ledger),
+        "B",
+    )
+    report(
+        f"lookup {len(SYMBOLS)} symbols",
+        timeit_ns(
+            lambda: [
+                legacy[symbol]["available"] for symbol in SYMBOLS if symbol in legacy
+            ],
+            rounds,
+        ),
+        timeit_ns(lambda: [ledger.get(symbol).available for symbol in SYMBOLS], rounds),
+    )
+    report(
+        f"update {len(SYMBOLS)} symbols",
+        timeit_ns(
+            lambda: [
+                legacy.update(
+                    {
+                        symbol: {
+                            "baseincrement": baseincrement,
+                            "available": available,
+                        },
+                    },
+                )
+                for symbol in SYMBOLS
+            ],
+            rounds,
+        ),
+        timeit_ns(
+            lambda: [
+                ledger.update(symbol, available, baseincrement) for symbol in SYMBOLS
+            ],
+            rounds,
+        ),
+    )
+
+
+def get_universe(count: int) -> tuple[list[str], list[Balance], np.ndarray]:
+    """Get random prices, balances and scaled rows of count symbols.
+
+    Price has 6 digits, baseincrement cost about 0.001 USDT and
+    balance cost about 1000 USDT as on exchange.
+    """
+    random = Random(count)  # noqa: S311
+    ledger, prices = Ledger(scaled=True), []
+    for symbol in SYMBOLS[:count]:
+        exponent = random.randint(-6, 5)
+        price = Decimal(random.randint(10**5, 10**6 - 1)).scaleb(exponent - 5)
+        ledger.update(
+            symbol,
+            (Decimal(random.randint(500, 1500)) / price).quantize(Decimal("1E-8")),
+            Decimal(1).scaleb(min(0, -exponent - 3)),
+        )
+        prices.append(str(price))
+
+    balances = [ledger.get(symbol) for symbol in SYMBOLS[:count]]
+    return prices, balances, ledger.scaled[:count]
+
+
+def get_sides_and_sizes_decimal(
+    prices: list[str],
+    balances: list[Balance],
+    token: Token,
+) -> list[dict]:
+    """Side and size of all symbols in tick by Decimal one by one."""
+    return [
+        get_side_and_size(data, Decimal(price), token)
+        for price, data in zip(prices, balances, strict=True)
+    ]
+
+
+def check_rebalance(count: int, token: Token) -> None:
+    """Check the same side and size by Decimal and NumPy on random symbols."""
+    prices, balances, scaled = get_universe(count)
+    if get_sides_and_sizes(
+        prices,
+        balances,
+        scaled,
+        token,
+    ) != get_sides_and_sizes_decimal(prices, balances, token):
+        msg = f"NumPy rebalance differ from Decimal on {count} symbols"
+        raise ValueError(msg)
+
+
+def bench_rebalance() -> None:
+    """Cost of side and size of all symbols in tick: Decimal and NumPy."""
+    token = Token(currency=[], ignore_currency=[], base_keep=Decimal(1000))
+    for count in (50, 1000, len(SYMBOLS)):
+        check_rebalance(count, token)
+        prices, balances, scaled = get_universe(count)
+        report(
+            f"rebalance {count} symbols",
+            timeit_ns(
+                partial(get_sides_and_sizes_decimal, prices, balances, token),
+                100,
+            ),
+            timeit_ns(
+                partial(get_sides_and_sizes, prices, balances, scaled, token),
+                100,
+            ),
+        )
+
+
+if __name__ == "__main__":
+    bench_signing()
+    bench_ledger()
+    bench_rebalance()
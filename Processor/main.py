@@ -1,129 +1,502 @@
-"""KCN Processor."""
-
-import asyncio
-from decimal import ROUND_DOWN, Decimal
-
-import orjson
-from decouple import Csv, config
-from loguru import logger
-from nats.aio.client import Msg
-
-from models import Access, Token
-from natslocal import get_js_context
-from tools import make_margin_limit_order
-
-
-def get_side_and_size(ledger_data: dict, price: Decimal, token: Token) -> dict:
-    """Get side of trade and size of tokens."""
-    new_balance = price * ledger_data["available"]
-
-    tokens_count = Decimal("0")
-
-    if new_balance >= token.base_keep:
-        tokens_count = (new_balance - token.base_keep) / price
-        side = "sell"
-
-    else:
-        tokens_count = (token.base_keep - new_balance) / price
-        side = "buy"
-
-    size = tokens_count.quantize(
-        ledger_data["baseincrement"],
-        ROUND_DOWN,
-    )  # around to baseincrement
-
-    return {"side": side, "size": str(size)}
-
-
-async def candle(msg: Msg) -> None:
-    """Collect data of open price each candle by interval."""
-    try:
-        logger.debug(msg.data.decode())
-        symbol, price_str = orjson.loads(msg.data).popitem()
-
-        if symbol in ledger:
-            # get side and size
-            side_size_data = get_side_and_size(
-                ledger[symbol],
-                Decimal(price_str),
-                token,
-            )
-
-            if float(side_size_data["size"]) != 0.0:  # check on buy '0' count of tokens
-                # make limit order
-                await make_margin_limit_order(
-                    access=access,
-                    side=side_size_data["side"],
-                    price=price_str,
-                    symbol=symbol,
-                    size=side_size_data["size"],
-                )
-
-        await msg.ack()
-    except Exception as e:
-        logger.exception(e)
-
-
-async def balance(msg: Msg) -> None:
-    """Collect balance of each tokens."""
-    try:
-        data = orjson.loads(msg.data)
-
-        symbol = data["symbol"]  # "...-USDT"
-        available = data["available"]
-        baseincrement = data["baseincrement"]
-
-        available_in_ledger = ledger.get(symbol, {"available": "0"})["available"]
-
-        ledger.update(
-            {
-                symbol: {
-                    "baseincrement": Decimal(baseincrement),
-                    "available": Decimal(available),
-                },
-            },
-        )
-
-        logger.success(
-            f"Change balance:{symbol}\t{available_in_ledger} \t-> {available}",
-        )
-    except Exception as e:
-        logger.exception(e)
-    finally:
-        await msg.ack()
-
-
-async def main() -> None:
-    """Main func in microservice."""
-    logger.info("START PROCESSOR")
-    global ledger, access, token
-    ledger = {}
-
-    js = await get_js_context()
-
-    # Access object
-    access = Access(
-        key=config("KEY", cast=str),
-        secret=config("SECRET", cast=str),
-        passphrase=config("PASSPHRASE", cast=str),
-        base_uri="https://api.kucoin.com",
-    )
-    # Token's object
-    token = Token(
-        time_shift=config("TIME_SHIFT", cast=str, default="1hour"),
-        base_stable=config("BASE_STABLE", cast=str, default="USDT"),
-        currency=config("ALLCURRENCY", cast=Csv(str)),
-        ignore_currency=config("IGNORECURRENCY", cast=Csv(str)),
-        base_keep=Decimal(config("BASE_KEEP", cast=int)),
-    )
-
-    await js.add_stream(name="kcn", subjects=["candle", "balance"])
-
-    await js.subscribe("candle", "candle", cb=candle)
-    await js.subscribe("balance", "balance", cb=balance)
-
-    await asyncio.sleep(60 * 60 * 24 * 365)
-
-
-if __name__ == "__main__":
-    asyncio.run(main())
+"""KCN Processor."""
+
+import asyncio
+import socket
+from decimal import ROUND_DOWN, Decimal
+from functools import partial
+
+import numpy as np
+import orjson
+from decouple import Csv, config
+from loguru import logger
+from nats.aio.client import Msg
+from nats.js.api import DeliverPolicy
+from nats.js.errors import KeyNotFoundError
+from nats.js.kv import KeyValue
+
+from models import (
+    MAX_SCALED,
+    Access,
+    Balance,
+    Coalescer,
+    Lanes,
+    Ledger,
+    Membership,
+    Token,
+)
+from natslocal import PullConsumer, PushConsumer, add_stream, get_js_context
+from tools import (
+    http_client,
+    init_clock,
+    make_margin_limit_orders,
+    retry,
+    sync_clock,
+)
+
+MAX_DIGITS = 18  # digits of scaled integers in int64 math
+POWERS = 10 ** np.arange(MAX_DIGITS + 1)
+MIN_PLAIN_ADJUSTED = -6  # Decimal str use exponent notation below it
+MAX_DECIMAL = 10**27  # bound of integers exact in Decimal with 28 digits
+MAX_ESTIMATE = 2**45  # bound of float count of size steps wrong less than 0.1
+
+
+def get_side_and_size(ledger_data: Balance, price: Decimal, token: Token) -> dict:
+    """Get side of trade and size of tokens."""
+    new_balance = price * ledger_data.available
+
+    tokens_count = Decimal("0")
+
+    if new_balance >= token.base_keep:
+        tokens_count = (new_balance - token.base_keep) / price
+        side = "sell"
+
+    else:
+        tokens_count = (token.base_keep - new_balance) / price
+        side = "buy"
+
+    size = tokens_count.quantize(
+        ledger_data.baseincrement,
+        ROUND_DOWN,
+    )  # around to baseincrement
+
+    return {"side": side, "size": str(size)}
+
+
+def get_scaled_prices(prices: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Get prices from str as int64 scaled to integers and decimal places.
+
+    Price with other chars than digits and one point or with more than
+    MAX_DIGITS digits get 0.
+    """
+    text = np.array(prices, np.str_)
+    scaled, scale, digits = np.zeros((3, len(prices)), np.int64)
+    valid, after_point = np.ones(len(prices), np.bool_), np.zeros(len(prices), np.bool_)
+
+    # chars by position in all prices at once
+    for chars in text.view(np.uint32).reshape(len(prices), -1).T.astype(np.int64):
+        digit = (chars >= ord("0")) & (chars <= ord("9"))
+        point = chars == ord(".")
+        scaled = np.where(digit, scaled * 10 + chars - ord("0"), scaled)
+        digits += digit
+        scale += digit & after_point
+        valid &= digit | (point & ~after_point) | (chars == 0)
+        after_point |= point
+
+    return np.where(valid & (digits <= MAX_DIGITS), scaled, 0), scale
+
+
+def get_size_strs(counts: np.ndarray, places: np.ndarray) -> list[str]:
+    """Get counts of baseincrement as str of quantized Decimal."""
+    digits = np.maximum(np.searchsorted(POWERS, counts, side="right"), 1)
+    length = np.maximum(digits, places + 1)  # "0.00..." for small count
+    end = length + (places > 0)
+    width = int(end.max(initial=1))
+    point = np.where(places > 0, length - places, width)[:, None]
+
+    column = np.arange(width)
+    power = length[:, None] - 1 - column + (column > point)
+    chars = np.where(
+        column == point,
+        ord("."),
+        ord("0") + counts[:, None] // POWERS[np.clip(power, 0, MAX_DIGITS)] % 10,
+    )
+    chars = np.where(column < end[:, None], chars, 0)
+    sizes = chars.astype(np.uint32).view(f"<U{width}").ravel().tolist()
+
+    # Decimal use exponent notation for small adjusted exponent
+    for index in np.flatnonzero(digits - places - 1 < MIN_PLAIN_ADJUSTED).tolist():
+        sizes[index] = str(Decimal(f"{counts[index]}E-{places[index]}"))
+    return sizes
+
+
+def get_sides_and_sizes(
+    prices: list[str],
+    ledger_data: list[Balance],
+    scaled: np.ndarray,
+    token: Token,
+) -> list[dict]:
+    """Get side of trade and size of tokens for all symbols of tick at once.
+
+    Math of get_side_and_size on int64 arrays of scaled decimals with the
+    same result, symbols with numbers out of this math use get_side_and_size.
+    scaled is rows of ledger for ledger_data.
+    """
+    price, price_scale = get_scaled_prices(prices)
+    available, available_scale, increment, increment_scale = scaled.T
+    keep, keep_scale = Ledger.get_scaled(token.base_keep)
+
+    # float values for estimate and bounds, quantize use only exponent
+    # of baseincrement, so step of size is 10 ** -increment_scale
+    price_real = price / 10.0**price_scale
+    balance_real = price_real * available / 10.0**available_scale
+    keep_real = keep / 10.0**keep_scale
+    step_value = price_real / 10.0**increment_scale
+
+    # base_keep - price * available on common scale, exact modulo 2**64
+    scale = np.maximum(price_scale + available_scale, keep_scale)
+    difference = keep * 10 ** (scale - keep_scale) - price * available * 10 ** (
+        scale - price_scale - available_scale
+    )
+    difference_real = keep_real - balance_real
+    sell = np.where(
+        np.abs(difference_real) * 10.0**scale < MAX_SCALED,
+        difference <= 0,  # near zero exact integer is right
+        difference_real <= 0,
+    )
+
+    # count of steps is numerator // denominator
+    places = price_scale + increment_scale - scale
+    numerator = np.where(sell, -difference, difference) * 10 ** np.maximum(places, 0)
+    denominator = price * 10 ** np.maximum(-places, 0)
+    denominator_real = price * 10.0 ** np.maximum(-places, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        estimate = np.abs(difference_real) / step_value
+        fits = (
+            (price > 0)
+            & (increment > 0)
+            & (increment < MAX_SCALED)
+            & (increment_scale <= MAX_DIGITS)
+            & (np.abs(available) < MAX_SCALED)
+            & (abs(keep) < MAX_SCALED)
+            & (denominator_real < MAX_SCALED)
+            # Decimal math of get_side_and_size is exact or round after count
+            & (
+                np.maximum(abs(keep_real), np.abs(balance_real)) * 10.0**scale
+                < MAX_DECIMAL
+            )
+            & (estimate * denominator_real < MAX_DECIMAL)
+            # Decimal zero keep sign of -0 available
+            & (difference != 0)
+            # float estimate is less than one step wrong
+            & (
+                np.maximum(abs(keep_real), np.abs(balance_real)) / step_value
+                < MAX_ESTIMATE
+            )
+        )
+
+    # remainder of estimate is small and exact modulo 2**64
+    counts = np.floor(np.where(fits, estimate, 0)).astype(np.int64)
+    remainder = numerator - counts * denominator
+    counts += (remainder >= denominator).astype(np.int64) - (remainder < 0)
+
+    sides_sizes = [
+        {"side": side, "size": size}
+        for side, size in zip(
+            np.where(sell, "sell", "buy").tolist(),
+            get_size_strs(counts, np.where(fits, increment_scale, 0)),
+            strict=True,
+        )
+    ]
+    for index in np.flatnonzero(~fits).tolist():
+        sides_sizes[index] = get_side_and_size(
+            ledger_data[index],
+            Decimal(prices[index]),
+            token,
+        )
+    return sides_sizes
+
+
+def add_order(
+    symbol: str,
+    price_str: str,
+    side_size_data: dict,
+) -> asyncio.Future | None:
+    """Add limit order to batch with orders of other symbols.
+
+    Get future of order result, None for '0' count of tokens.
+    """
+    if float(side_size_data["size"]) != 0.0:  # check on buy '0' count of tokens
+        return orders.add(
+            {
+                "side": side_size_data["side"],
+                "price": price_str,
+                "symbol": symbol,
+                "size": side_size_data["size"],
+            },
+        )
+    return None
+
+
+def size_known(known: list[tuple[str, str]]) -> dict[str, dict]:
+    """Get side and size of candles in ledger at once and make orders."""
+    ledger_data = [ledger.get(symbol) for symbol, _ in known]
+    sides_sizes = get_sides_and_sizes(
+        [price_str for _, price_str in known],
+        ledger_data,
+        ledger.scaled[[data.symbol_id for data in ledger_data]],
+        token,
+    )
+
+    for (symbol, price_str), side_size_data in zip(known, sides_sizes, strict=True):
+        add_order(symbol, price_str, side_size_data)
+
+    return dict(zip((symbol for symbol, _ in known), sides_sizes, strict=True))
+
+
+async def rebalance(candles: list[tuple[str, str]]) -> list[dict]:
+    """Get side and size for own candles of tick at once and make orders.
+
+    Tick without own symbols in ledger is not sized.
+    """
+    known = [
+        (symbol, price_str)
+        for symbol, price_str in candles
+        if symbol in ledger and membership.can_trade(symbol)
+    ]
+    by_symbol = size_known(known) if known else {}
+    return [by_symbol.get(symbol, {}) for symbol, _ in candles]
+
+
+async def candle_batch(msg: Msg) -> None:
+    """Collect open price of candle to rebalance of all symbols in tick."""
+    try:
+        logger.debug(msg.data.decode())
+        candles.add(orjson.loads(msg.data).popitem(), wait=False)
+    except Exception as e:
+        logger.exception(e)
+
+
+def size_candle(symbol: str, price_str: str) -> asyncio.Future | None:
+    """Get side and size of candle by Decimal and make order."""
+    ledger_data = ledger.get(symbol)
+
+    if ledger_data is not None and membership.can_trade(symbol):
+        # get side and size
+        side_size_data = get_side_and_size(
+            ledger_data,
+            Decimal(price_str),
+            token,
+        )
+
+        return add_order(symbol, price_str, side_size_data)
+    return None
+
+
+async def order_candle(symbol: str, price_str: str) -> None:
+    """Size candle in lane of symbol and wait its order.
+
+    Next job of symbol start after exchange answer on this order.
+    """
+    order = size_candle(symbol, price_str)
+
+    if order is not None:
+        await order
+
+
+def submit_candles(candles: list[list[str]]) -> None:
+    """Put candles to lanes of their symbols."""
+    for symbol, price_str in candles:
+        lanes.submit(symbol, partial(order_candle, symbol, price_str))
+
+
+async def candle(msg: Msg) -> None:
+    """Collect data of open price each candle by interval."""
+    try:
+        logger.debug(msg.data.decode())
+        submit_candles([orjson.loads(msg.data).popitem()])
+    except Exception as e:
+        logger.exception(e)
+
+
+async def tick_batch(msg: Msg) -> None:
+    """Rebalance all symbols of tick message at once."""
+    try:
+        logger.debug(msg.data.decode())
+        await rebalance(orjson.loads(msg.data)["candles"])
+    except Exception as e:
+        logger.exception(e)
+
+
+async def tick(msg: Msg) -> None:
+    """Rebalance symbols of tick message in their lanes."""
+    try:
+        logger.debug(msg.data.decode())
+        submit_candles(orjson.loads(msg.data)["candles"])
+    except Exception as e:
+        logger.exception(e)
+
+
+async def update_balance(
+    symbol: str,
+    available: Decimal,
+    baseincrement: Decimal,
+    sequence: int,
+) -> None:
+    """Update balance of symbol in ledger in its lane and snapshot ledger."""
+    try:
+        available_in_ledger = ledger.update(
+            symbol,
+            available=available,
+            baseincrement=baseincrement,
+        )
+    finally:
+        ledger.done(sequence)
+        snapshots.add(ledger.sequence, wait=False)
+
+    logger.success(
+        f"Change balance:{symbol}\t{available_in_ledger} \t-> {available}",
+    )
+
+
+async def balance(msg: Msg) -> None:
+    """Collect balance of each tokens to lane of its symbol."""
+    try:
+        data = orjson.loads(msg.data)
+
+        symbol = data["symbol"]  # "...-USDT"
+        available = Decimal(data["available"])
+        baseincrement = Decimal(data["baseincrement"])
+
+        ledger.expect(msg.metadata.sequence.stream)
+        lanes.submit(
+            symbol,
+            partial(
+                update_balance,
+                symbol,
+                available,
+                baseincrement,
+                msg.metadata.sequence.stream,
+            ),
+        )
+    except Exception as e:
+        logger.exception(e)
+
+
+async def save_ledger(sequences: list[int]) -> list[int]:
+    """Save snapshot of ledger after balances to key value bucket."""
+    revision = await kv.put("ledger", orjson.dumps(ledger.dump()))
+    logger.info(f"Save ledger on sequence {sequences[-1]}")
+    return [revision] * len(sequences)
+
+
+async def load_ledger(kv: KeyValue) -> int:
+    """Restore ledger from snapshot and get stream sequence to continue."""
+    try:
+        entry = await kv.get("ledger")
+    except KeyNotFoundError:
+        logger.info("No ledger snapshot")
+        return 0
+
+    ledger.load(orjson.loads(entry.value))
+    logger.info(f"Restore ledger:{len(ledger)} symbols on sequence {ledger.sequence}")
+    return ledger.sequence + 1
+
+
+async def main() -> None:
+    """Main func in microservice."""
+    logger.info("START PROCESSOR")
+    global ledger, access, token, orders, candles, kv, snapshots, membership, lanes
+    # Batch rebalance size whole tick by int64 math on scaled rows of ledger
+    batch_rebalance = config("BATCH_REBALANCE", cast=bool, default=False)
+    ledger = Ledger(scaled=batch_rebalance)
+
+    js = await get_js_context()
+
+    # Access object
+    access = Access(
+        key=config("KEY", cast=str),
+        secret=config("SECRET", cast=str),
+        passphrase=config("PASSPHRASE", cast=str),
+        base_uri="https://api.kucoin.com",
+    )
+
+    # Corrected clock for sign requests
+    await init_clock(access)
+    sync_clock_task = asyncio.create_task(sync_clock(access))
+
+    # Duplicate order request slower than HEDGE_AFTER seconds, 0 is off
+    retry.hedge_after = config("HEDGE_AFTER", cast=float, default=0)
+
+    # Orders of candles come in ORDER_WINDOW seconds placed together
+    orders = Coalescer(
+        partial(
+            make_margin_limit_orders,
+            access,
+            semaphore=asyncio.Semaphore(
+                config("ORDER_CONCURRENCY", cast=int, default=20),
+            ),
+        ),
+        window=config("ORDER_WINDOW", cast=float, default=0.05),
+    )
+
+    # Events of one symbol handled in order in its lane, lanes of symbols
+    # run concurrently with at most LANE_CONCURRENCY events at once
+    lanes = Lanes(config("LANE_CONCURRENCY", cast=int, default=256))
+
+    # Token's object
+    token = Token(
+        time_shift=config("TIME_SHIFT", cast=str, default="1hour"),
+        base_stable=config("BASE_STABLE", cast=str, default="USDT"),
+        currency=config("ALLCURRENCY", cast=Csv(str)),
+        ignore_currency=config("IGNORECURRENCY", cast=Csv(str)),
+        base_keep=Decimal(config("BASE_KEEP", cast=int)),
+    )
+
+    await add_stream(js, "kcn", ["candle.*", "tick", "balance.*"])
+
+    # Replicas of SHARDING get own consumers of all messages and trade
+    # own part of symbols by consistent hash ring of alive replicas,
+    # candles of symbols moved to replica are dropped for RING_GRACE
+    # seconds after change of ring
+    membership = Membership(
+        config("REPLICA", cast=str, default=socket.gethostname())
+        if config("SHARDING", cast=bool, default=False)
+        else "",
+        config("HEARTBEAT", cast=float, default=5),
+        config("RING_GRACE", cast=float, default=5),
+    )
+    await membership.join(js)
+    membership_task = asyncio.create_task(membership.run())
+
+    # Ledger from snapshot, balances after it come from its sequence
+    kv = await js.create_key_value(bucket="processor")
+    start_sequence = await load_ledger(kv)
+    snapshots = Coalescer(
+        save_ledger,
+        window=config("SNAPSHOT_WINDOW", cast=float, default=1),
+    )
+
+    # Collect candles of REBALANCE_WINDOW seconds and size them together
+    candles = Coalescer(
+        rebalance,
+        window=config("REBALANCE_WINDOW", cast=float, default=0.1),
+    )
+
+    # Pull consumers fetch FETCH_BATCH messages and ack them at once
+    consumer = (
+        PullConsumer(
+            batch=config("FETCH_BATCH", cast=int, default=256),
+            timeout=config("FETCH_TIMEOUT", cast=float, default=1),
+            max_ack_pending=config("MAX_ACK_PENDING", cast=int, default=1024),
+            pending_msgs_limit=config("PENDING_MSGS_LIMIT", cast=int, default=4096),
+            replica=membership.replica,
+        )
+        if config("PULL_CONSUMER", cast=bool, default=False)
+        else PushConsumer(membership.replica)
+    )
+
+    # Candles before start of consumer are stale, balances are not
+    await consumer.subscribe(
+        js,
+        "candle.*",
+        candle_batch if batch_rebalance else candle,
+        deliver_policy=DeliverPolicy.NEW,
+    )
+    await consumer.subscribe(
+        js,
+        "tick",
+        tick_batch if batch_rebalance else tick,
+        deliver_policy=DeliverPolicy.NEW,
+    )
+    await consumer.subscribe(js, "balance.*", balance, start_sequence)
+
+    try:
+        await asyncio.sleep(60 * 60 * 24 * 365)
+    finally:
+        sync_clock_task.cancel()
+        membership_task.cancel()
+        await http_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,131 +1,780 @@
-"""Classes for work."""
-
-import hashlib
-import hmac
-from base64 import b64encode
-from decimal import Decimal
-from typing import Self
-
-
-class Access:
-    """Class for store access condention to exchange."""
-
-    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
-        """Init access condention keys."""
-        self.key: str = key
-        self.secret: str = secret
-        self.passphrase: str = passphrase
-        self.base_uri: str = base_uri
-
-    def encrypted(self: Self, msg: str) -> str:
-        """Encrypted msg for exchange."""
-        return b64encode(
-            hmac.new(
-                self.secret.encode("utf-8"),
-                msg.encode("utf-8"),
-                hashlib.sha256,
-            ).digest(),
-        ).decode()
-
-
-class Token:
-    """Class for store token data for trade."""
-
-    def __init__(
-        self: Self,
-        currency: list,
-        ignore_currency: list,
-        base_keep: Decimal,
-        time_shift: str = "1hour",
-        base_stable: str = "USDT",
-    ) -> None:
-        """Init class for store trade tokens."""
-        self.trade_currency: list[str] = currency  # Tokens for trade in bot
-        self.ignore_currency: list[str] = ignore_currency
-        self.base_keep: Decimal = base_keep
-        self.base_stable: str = base_stable
-        self.time_shift: str = time_shift
-        self.borrow_size: Decimal = Decimal("0")
-        self.avail_size: Decimal = Decimal("0")
-
-        self.accept_tokens: list[str] = []  # tradable tokens
-        self.new_tokens: list[str] = (
-            []
-        )  # tokens that can be traded but are not in the bot
-        self.del_tokens: list[str] = (
-            []
-        )  # tokens that have been removed from the exchange
-        self.history: dict = {}
-
-    def init_history(self: Self) -> None:
-        """Init history."""
-        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
-
-    def get_candles_for_kline(self: Self, tokens: list) -> str:
-        """Get str candles for kline websocket."""
-        return ",".join(
-            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
-        )
-
-    def get_clear_borrow(self: Self) -> Decimal:
-        """Get clear borrow size."""
-        return self.borrow_size - self.avail_size
-
-    def get_percent_borrow(self: Self) -> int:
-        """Get percent of borrowing."""
-        return (
-            self.get_clear_borrow()
-            * 100
-            / (self.trade_currency * float(self.base_keep))
-        )
-
-    def get_len_trade_currency(self: Self) -> int:
-        """Get len of trade_currency."""
-        return len(self.trade_currency)
-
-    def get_len_accept_tokens(self: Self) -> int:
-        """Get len of accept_tokens."""
-        return len(self.accept_tokens)
-
-    def get_len_del_tokens(self: Self) -> int:
-        """Get len del_tokens."""
-        return len(self.del_tokens)
-
-    def get_len_ignore_currency(self: Self) -> int:
-        """Get len of ignore_currency."""
-        return len(self.ignore_currency)
-
-    def get_len_new_tokens(self: Self) -> int:
-        """Get len of new_tokens."""
-        return len(self.new_tokens)
-
-    @staticmethod
-    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
-        """Remove postfix."""
-        return symbol.replace(postfix, "")
-
-    def save_accept_tokens(self: Self, all_token_in_excange: list) -> None:
-        """Save all accepted token."""
-        self.accept_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if token_in_excange["isMarginEnabled"]
-            and token_in_excange["quoteCurrency"] == "USDT"
-            and Token.remove_postfix(token_in_excange["symbol"])
-            not in self.ignore_currency
-        ]
-
-    def save_new_tokens(self: Self, all_token_in_excange: list) -> None:
-        """."""
-        self.new_tokens = [
-            Token.remove_postfix(token_in_excange["symbol"])
-            for token_in_excange in all_token_in_excange
-            if Token.remove_postfix(token_in_excange["symbol"])
-            not in self.accept_tokens
-        ]
-
-    def save_del_tokens(self: Self) -> None:
-        """."""
-        self.del_tokens = [
-            used for used in self.trade_currency if used not in self.accept_tokens
-        ]
+"""Classes for work."""
+
+import asyncio
+import hashlib
+import hmac
+import sys
+from base64 import b64encode
+from bisect import bisect
+from collections import deque
+from collections.abc import Awaitable, Callable, Iterable, Mapping
+from decimal import Decimal
+from random import SystemRandom
+from time import monotonic, time
+from typing import Self
+
+import aiohttp
+import numpy as np
+import orjson
+from loguru import logger
+from nats.js import JetStreamContext
+from nats.js.kv import KeyValue
+
+MAX_SCALED = 2**62  # bound of scaled integers for int64 math without overflow
+
+
+class Access:
+    """Class for store access condention to exchange."""
+
+    def __init__(self, key: str, secret: str, passphrase: str, base_uri: str) -> None:
+        """Init access condention keys."""
+        self.key: str = key
+        self.secret: str = secret
+        self.passphrase: str = passphrase
+        self.base_uri: str = base_uri
+        # keyed once, each sign work on copy of this state
+        self.hmac_key = hmac.new(self.secret.encode("utf-8"), digestmod=hashlib.sha256)
+        self.encrypted_passphrase: str = self.encrypted(passphrase)
+        self.auth_headers: dict = {
+            "KC-API-PASSPHRASE": self.encrypted_passphrase,
+            "KC-API-KEY": self.key,
+            "Content-Type": "application/json",
+            "KC-API-KEY-VERSION": "2",
+            "User-Agent": "kucoin-python-sdk/2",
+        }
+
+    def encrypted(self: Self, msg: str) -> str:
+        """Encrypted msg for exchange."""
+        signer = self.hmac_key.copy()
+        signer.update(msg.encode("utf-8"))
+        return b64encode(signer.digest()).decode()
+
+    def get_auth_headers(self: Self, str_to_sign: str, now_time: str) -> dict:
+        """Get auth headers, only timestamp and sign computed per call."""
+        return {
+            **self.auth_headers,
+            "KC-API-SIGN": self.encrypted(f"{now_time}{str_to_sign}"),
+            "KC-API-TIMESTAMP": now_time,
+        }
+
+
+class HttpClient:
+    """Class for store long-lived pooled http session to exchange."""
+
+    def __init__(
+        self: Self,
+        limit: int = 100,
+        limit_per_host: int = 50,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: int = 75,
+        timeout: int = 10,
+    ) -> None:
+        """Init settings of connection pool."""
+        self.limit: int = limit
+        self.limit_per_host: int = limit_per_host
+        self.ttl_dns_cache: int = ttl_dns_cache
+        self.keepalive_timeout: int = keepalive_timeout
+        self.timeout: int = timeout
+        self.session: aiohttp.ClientSession | None = None
+
+    def get_session(self: Self) -> aiohttp.ClientSession:
+        """Get opened session or open new one with warm connection pool.
+
+        Session created lazily, because aiohttp need running event loop.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    ttl_dns_cache=self.ttl_dns_cache,
+                    use_dns_cache=True,
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self: Self) -> None:
+        """Close session and release all pooled connections."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+class RateLimit:
+    """Class for store client side rate limit of exchange.
+
+    Token bucket for each resource pool of exchange, refilled on reset of
+    pool window and corrected by gw-ratelimit headers from responses.
+    """
+
+    def __init__(
+        self: Self,
+        limits: dict | None = None,
+        window: float = 30,
+    ) -> None:
+        """Init pools by default quota for 30 seconds window."""
+        self.window: float = window
+        self.limits: dict[str, int] = limits or {
+            "spot": 4000,
+            "margin": 4000,
+            "management": 2000,
+            "public": 2000,
+        }
+        self.remaining: dict[str, int] = self.limits.copy()
+        self.reset_at: dict[str, float] = dict.fromkeys(
+            self.limits,
+            monotonic() + window,
+        )
+        self.locks: dict[str, asyncio.Lock] = {
+            pool: asyncio.Lock() for pool in self.limits
+        }
+
+    def refill(self: Self, pool: str) -> None:
+        """Refill pool if window of pool is over."""
+        if monotonic() >= self.reset_at[pool]:
+            self.remaining[pool] = self.limits[pool]
+            self.reset_at[pool] = monotonic() + self.window
+
+    async def acquire(self: Self, pool: str, weight: int = 1) -> None:
+        """Wait weight in pool, requests go out in order of call."""
+        async with self.locks[pool]:
+            self.refill(pool)
+            while self.remaining[pool] < weight:
+                logger.warning(f"Rate limit {pool}:wait to reset")
+                await asyncio.sleep(self.reset_at[pool] - monotonic())
+                self.refill(pool)
+            self.remaining[pool] -= weight
+
+    def update(self: Self, pool: str, headers: Mapping, code: str) -> None:
+        """Update pool by code and gw-ratelimit headers of response."""
+        if code == "429000":  # pool is empty till reset
+            self.remaining[pool] = 0
+
+        self.update_by_headers(pool, headers)
+
+    def update_by_headers(self: Self, pool: str, headers: Mapping) -> None:
+        """Update pool by gw-ratelimit headers of response."""
+        if "gw-ratelimit-remaining" not in headers:
+            return
+
+        self.limits[pool] = int(headers["gw-ratelimit-limit"])
+        self.remaining[pool] = min(
+            self.remaining[pool],
+            int(headers["gw-ratelimit-remaining"]),
+        )
+        self.reset_at[pool] = monotonic() + int(headers["gw-ratelimit-reset"]) / 1000
+
+
+class Clock:
+    """Class for store offset of local clock to exchange server clock.
+
+    Offset estimated from samples of server timestamp, compensated by half
+    of round trip and smoothed by exponential moving average.
+    """
+
+    def __init__(self: Self, alpha: float = 0.2, max_rtt: float = 1000) -> None:
+        """Init clock without offset."""
+        self.alpha: float = alpha
+        self.max_rtt: float = max_rtt  # ms, samples with longer round trip ignored
+        self.offset: float = 0  # ms, server minus local
+        self.samples: int = 0
+
+    def add_sample(
+        self: Self,
+        server_time: int,
+        sent_at: float,
+        received_at: float,
+    ) -> None:
+        """Add server time in ms, requested between local sent_at and received_at."""
+        if received_at - sent_at > self.max_rtt:
+            logger.warning(f"Skip clock sample:rtt {received_at - sent_at:.0f} ms")
+            return
+
+        alpha = max(self.alpha, 1 / (self.samples + 1))  # first sample as is
+        self.offset += alpha * (server_time - (sent_at + received_at) / 2 - self.offset)
+        self.samples += 1
+
+    def get_timestamp(self: Self) -> str:
+        """Get corrected timestamp in ms for sign request."""
+        return str(int(time() * 1000 + self.offset))
+
+
+class Retry:
+    """Class for store retry policy of requests to exchange.
+
+    Codes of rate limit and unavailable server are retryable, any other code
+    (balance insufficient 200004, invalid size 400100, ...) is terminal.
+    Network errors retried only for idempotent-safe requests.
+    """
+
+    NETWORK_ERRORS = (aiohttp.ClientError, TimeoutError, orjson.JSONDecodeError)
+    NETWORK_ERROR_CODE = "network"
+    RETRYABLE_CODES = frozenset({"429000", "500000", "503000", NETWORK_ERROR_CODE})
+
+    def __init__(
+        self: Self,
+        attempts: int = 4,
+        base_delay: float = 0.1,
+        max_delay: float = 2,
+        hedge_after: float = 0,
+    ) -> None:
+        """Init policy, hedge_after 0 turn off hedged requests."""
+        self.attempts: int = attempts
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.hedge_after: float = hedge_after
+        self.random = SystemRandom()
+
+    def get_delay(self: Self, attempt: int) -> float:
+        """Get exponential backoff with full jitter."""
+        return self.random.uniform(
+            0,
+            min(self.max_delay, self.base_delay * 2**attempt),
+        )
+
+    async def run(
+        self: Self,
+        func: Callable[[], Awaitable[dict]],
+        *,
+        idempotent: bool,
+        attempt: int = 1,
+    ) -> dict:
+        """Run request and repeat it while answer is retryable."""
+        data = await self.try_once(func, idempotent=idempotent)
+
+        if attempt < self.attempts and data["code"] in self.RETRYABLE_CODES:
+            delay = self.get_delay(attempt)
+            logger.warning(f"Retry {attempt}:{data['code']}:after {delay:.2f} s")
+            await asyncio.sleep(delay)
+            return await self.run(func, idempotent=idempotent, attempt=attempt + 1)
+
+        return data
+
+    async def try_once(
+        self: Self,
+        func: Callable[[], Awaitable[dict]],
+        *,
+        idempotent: bool,
+    ) -> dict:
+        """Run request, network error of idempotent request mark as retryable."""
+        errors = self.NETWORK_ERRORS if idempotent else ()
+        try:
+            return await self.hedge(func, idempotent=idempotent)
+        except errors as e:
+            logger.warning(f"Network error:{e!r}")
+            return {"code": self.NETWORK_ERROR_CODE}
+
+    async def hedge(
+        self: Self,
+        func: Callable[[], Awaitable[dict]],
+        *,
+        idempotent: bool,
+    ) -> dict:
+        """Run request, duplicate idempotent one slower than hedge_after."""
+        if not (self.hedge_after and idempotent):
+            return await func()
+
+        return await self.race(func)
+
+    async def race(self: Self, func: Callable[[], Awaitable[dict]]) -> dict:
+        """Get first answer of request and its delayed copy, cancel the other."""
+        tasks = {
+            asyncio.create_task(func()),
+            asyncio.create_task(self.delayed(func)),
+        }
+        try:
+            return await self.first_answer(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def first_answer(self: Self, tasks: set[asyncio.Task]) -> dict:
+        """Get first answer without error, error only if both copies failed."""
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        answered = [task for task in done if task.exception() is None]
+
+        if answered or not pending:
+            return (answered or list(done))[0].result()
+
+        return await pending.pop()
+
+    async def delayed(self: Self, func: Callable[[], Awaitable[dict]]) -> dict:
+        """Run hedged copy of request after hedge_after."""
+        await asyncio.sleep(self.hedge_after)
+        logger.warning("Hedge slow request")
+        return await func()
+
+
+class Token:
+    """Class for store token data for trade."""
+
+    def __init__(
+        self: Self,
+        currency: list,
+        ignore_currency: list,
+        base_keep: Decimal,
+        time_shift: str = "1hour",
+        base_stable: str = "USDT",
+    ) -> None:
+        """Init class for store trade tokens."""
+        self.trade_currency: list[str] = currency  # Tokens for trade in bot
+        self.ignore_currency: list[str] = ignore_currency
+        self.base_keep: Decimal = base_keep
+        self.base_stable: str = base_stable
+        self.time_shift: str = time_shift
+        self.borrow_size: Decimal = Decimal("0")
+        self.avail_size: Decimal = Decimal("0")
+
+        self.accept_tokens: list[str] = []  # tradable tokens
+        self.new_tokens: list[str] = (
+            []
+        )  # tokens that can be traded but are not in the bot
+        self.del_tokens: list[str] = (
+            []
+        )  # tokens that have been removed from the exchange
+        self.history: dict = {}
+
+    def init_history(self: Self) -> None:
+        """Init history."""
+        self.history = {f"{key}-{self.base_stable}": "" for key in self.trade_currency}
+
+    def get_candles_for_kline(self: Self, tokens: list) -> str:
+        """Get str candles for kline websocket."""
+        return ",".join(
+            [f"{sym}-{self.base_stable}_{self.time_shift}" for sym in tokens],
+        )
+
+    def get_clear_borrow(self: Self) -> Decimal:
+        """Get clear borrow size."""
+        return self.borrow_size - self.avail_size
+
+    def get_percent_borrow(self: Self) -> int:
+        """Get percent of borrowing."""
+        return (
+            self.get_clear_borrow()
+            * 100
+            / (self.trade_currency * float(self.base_keep))
+        )
+
+    def get_len_trade_currency(self: Self) -> int:
+        """Get len of trade_currency."""
+        return len(self.trade_currency)
+
+    def get_len_accept_tokens(self: Self) -> int:
+        """Get len of accept_tokens."""
+        return len(self.accept_tokens)
+
+    def get_len_del_tokens(self: Self) -> int:
+        """Get len del_tokens."""
+        return len(self.del_tokens)
+
+    def get_len_ignore_currency(self: Self) -> int:
+        """Get len of ignore_currency."""
+        return len(self.ignore_currency)
+
+    def get_len_new_tokens(self: Self) -> int:
+        """Get len of new_tokens."""
+        return len(self.new_tokens)
+
+    @staticmethod
+    def remove_postfix(symbol: str, postfix: str = "-USDT") -> str:
+        """Remove postfix."""
+        return symbol.replace(postfix, "")
+
+    def save_accept_tokens(self: Self, all_token_in_excange: list) -> None:
+        """Save all accepted token."""
+        self.accept_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if token_in_excange["isMarginEnabled"]
+            and token_in_excange["quoteCurrency"] == "USDT"
+            and Token.remove_postfix(token_in_excange["symbol"])
+            not in self.ignore_currency
+        ]
+
+    def save_new_tokens(self: Self, all_token_in_excange: list) -> None:
+        """."""
+        self.new_tokens = [
+            Token.remove_postfix(token_in_excange["symbol"])
+            for token_in_excange in all_token_in_excange
+            if Token.remove_postfix(token_in_excange["symbol"])
+            not in self.accept_tokens
+        ]
+
+    def save_del_tokens(self: Self) -> None:
+        """."""
+        self.del_tokens = [
+            used for used in self.trade_currency if used not in self.accept_tokens
+        ]
+
+
+class Coalescer:
+    """Class for store items collected in short window to flush together."""
+
+    def __init__(
+        self: Self,
+        flush: Callable[[list], Awaitable[list]],
+        window: float = 0.05,
+    ) -> None:
+        """Init empty window.
+
+        flush get items of window and return results in the same order,
+        errors of items must be returned as results too.
+        """
+        self.flush: Callable[[list], Awaitable[list]] = flush
+        self.window: float = window
+        self.items: list = []
+        self.futures: list[asyncio.Future | None] = []
+        self.flush_task: asyncio.Task | None = None
+
+    def add(self: Self, item: object, *, wait: bool = True) -> asyncio.Future | None:
+        """Add item to current window and get future of its result.
+
+        First item of window start timer of flush. Item added without wait
+        has no future, so its result and error are not kept.
+        """
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self.items.append(item)
+        self.futures.append(future)
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+        return future
+
+    async def flush_later(self: Self) -> None:
+        """Flush all items of window after window is over."""
+        await asyncio.sleep(self.window)
+
+        items, futures = self.items, self.futures
+        self.items, self.futures, self.flush_task = [], [], None
+
+        logger.info(f"Flush {len(items)} items")
+        try:
+            Coalescer.set_results(futures, await self.flush(items))
+        except Exception as e:
+            logger.exception(e)
+            Coalescer.set_exception(futures, e)
+
+    @staticmethod
+    def set_results(futures: list[asyncio.Future | None], results: list) -> None:
+        """Set results of flush to futures of items in the same order."""
+        for future, result in (
+            (future, result)
+            for future, result in zip(futures, results, strict=True)
+            if future is not None
+        ):
+            future.set_result(result)
+
+    @staticmethod
+    def set_exception(futures: list[asyncio.Future | None], error: Exception) -> None:
+        """Set error of failed flush to futures of items not done yet."""
+        for future in (
+            future for future in futures if future is not None and not future.done()
+        ):
+            future.set_exception(error)
+
+
+class Lanes:
+    """Class for run jobs of each symbol in own ordered lane.
+
+    Jobs of one symbol run one by one in order of submit, lanes of
+    different symbols run concurrently, at most limit jobs at once.
+    Task of lane live while its queue is not empty.
+    """
+
+    def __init__(self: Self, limit: int = 20) -> None:
+        """Init lanes with limit of concurrent jobs."""
+        self.semaphore = asyncio.Semaphore(limit)
+        self.queues: dict[str, deque[Callable[[], Awaitable[object]]]] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def submit(self: Self, symbol: str, job: Callable[[], Awaitable[object]]) -> None:
+        """Add job to lane of symbol, start lane if it is idle."""
+        if symbol in self.queues:
+            self.queues[symbol].append(job)
+            return
+
+        self.queues[symbol] = deque([job])
+        task = asyncio.create_task(self.run(symbol))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self: Self, symbol: str) -> None:
+        """Run jobs of lane till its queue is empty."""
+        queue = self.queues[symbol]
+        while queue:
+            await self.try_job(queue[0])  # job in queue keep lane busy
+            queue.popleft()
+        del self.queues[symbol]
+
+    async def try_job(self: Self, job: Callable[[], Awaitable[object]]) -> None:
+        """Run job in limit, its failure is only logged."""
+        async with self.semaphore:
+            try:
+                await job()
+            except Exception as e:
+                logger.exception(e)
+
+
+class Balance:
+    """Class for store balance of one symbol in ledger."""
+
+    __slots__ = ("available", "baseincrement", "symbol_id")
+
+    def __init__(
+        self: Self,
+        symbol_id: int,
+        available: Decimal,
+        baseincrement: Decimal,
+    ) -> None:
+        """Init balance of symbol."""
+        self.symbol_id: int = symbol_id  # order of symbol in ledger
+        self.available: Decimal = available
+        self.baseincrement: Decimal = baseincrement
+
+
+class Ledger:
+    """Class for store balances of symbols by interned symbol."""
+
+    __slots__ = ("get", "last", "pending", "records", "scaled", "sequence")
+
+    def __init__(self: Self, *, scaled: bool = False) -> None:
+        """Init empty ledger, scaled rows are kept only for batch rebalance."""
+        self.records: dict[str, Balance] = {}  # "...-USDT" -> balance
+        # balance of symbol without copy, bound dict.get skip python call
+        # on hot path of candles
+        self.get: Callable[[str], Balance | None] = self.records.get
+        self.sequence: int = 0  # stream sequence of all balances applied
+        self.last: int = 0  # stream sequence of last balance message
+        self.pending: set[int] = set()  # sequences of balances in lanes
+        # rows by symbol_id: available and baseincrement as integer
+        # and decimal places of it for int64 math
+        self.scaled: np.ndarray | None = np.zeros((64, 4), np.int64) if scaled else None
+
+    def __contains__(self: Self, symbol: str) -> bool:
+        """Check symbol in ledger."""
+        return symbol in self.records
+
+    def __len__(self: Self) -> int:
+        """Get count of symbols in ledger."""
+        return len(self.records)
+
+    @staticmethod
+    def get_scaled(value: Decimal) -> tuple[int, int]:
+        """Get decimal as integer and count of decimal places.
+
+        Integer is limited by MAX_SCALED, number with positive exponent
+        get MAX_SCALED too, so int64 math never take it.
+        """
+        exponent = value.as_tuple().exponent
+        if not value.is_finite() or exponent > 0:
+            return MAX_SCALED, 0
+        scaled = int(value.scaleb(-exponent))
+        return max(-MAX_SCALED, min(scaled, MAX_SCALED)), -exponent
+
+    def add(self: Self, symbol: str, baseincrement: Decimal) -> Balance:
+        """Add symbol with empty balance."""
+        record = Balance(len(self.records), Decimal(0), baseincrement)
+        self.records[sys.intern(symbol)] = record
+        return record
+
+    def set_scaled(self: Self, record: Balance) -> None:
+        """Set row of record for int64 math."""
+        if record.symbol_id == len(self.scaled):  # double rows
+            self.scaled = np.concatenate((self.scaled, np.zeros_like(self.scaled)))
+
+        self.scaled[record.symbol_id] = (
+            *Ledger.get_scaled(record.available),
+            *Ledger.get_scaled(record.baseincrement),
+        )
+
+    def update(
+        self: Self,
+        symbol: str,
+        available: Decimal,
+        baseincrement: Decimal,
+    ) -> Decimal:
+        """Set balance of symbol in one step and get previous available."""
+        record = self.records.get(symbol) or self.add(symbol, baseincrement)
+
+        previous = record.available
+        record.available, record.baseincrement = available, baseincrement
+
+        if self.scaled is not None:
+            self.set_scaled(record)
+        return previous
+
+    def expect(self: Self, sequence: int) -> None:
+        """Mark balance message of stream sequence as waiting in lane."""
+        self.pending.add(sequence)
+        self.last = sequence
+
+    def done(self: Self, sequence: int) -> None:
+        """Mark balance message as applied.
+
+        Lanes apply balances of symbols out of stream order, so sequence
+        of ledger stop before first balance still waiting.
+        """
+        self.pending.discard(sequence)
+        self.sequence = min(self.pending, default=self.last + 1) - 1
+
+    def dump(self: Self) -> dict:
+        """Get ledger as dict of str for snapshot."""
+        return {
+            "sequence": self.sequence,
+            "balances": {
+                symbol: [str(record.available), str(record.baseincrement)]
+                for symbol, record in self.records.items()
+            },
+        }
+
+    def load(self: Self, snapshot: dict) -> None:
+        """Set ledger from snapshot of dump."""
+        for symbol, (available, baseincrement) in snapshot["balances"].items():
+            self.update(symbol, Decimal(available), Decimal(baseincrement))
+        self.sequence = self.last = snapshot["sequence"]
+
+
+class Ring:
+    """Class for consistent hash ring of replicas.
+
+    Each replica has vnodes points on ring, symbol belong to replica of
+    first point after hash of symbol, so replica join or leave move only
+    symbols of its points.
+    """
+
+    def __init__(self: Self, replicas: Iterable[str] = (), vnodes: int = 64) -> None:
+        """Init ring of replicas."""
+        self.vnodes: int = vnodes
+        self.hashes: list[int] = []
+        self.replicas: list[str] = []
+        self.owners: dict[str, str] = {}  # cache of owner by symbol
+        self.update(replicas)
+
+    @staticmethod
+    def get_hash(key: str) -> int:
+        """Get 64 bit hash of key, the same in all replicas."""
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest())
+
+    def update(self: Self, replicas: Iterable[str]) -> None:
+        """Set points of replicas on ring."""
+        points = sorted(
+            (Ring.get_hash(f"{replica}:{vnode}"), replica)
+            for replica in replicas
+            for vnode in range(self.vnodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.replicas = [replica for _, replica in points]
+        self.owners = {}
+
+    def get_owner(self: Self, symbol: str) -> str:
+        """Get replica of symbol."""
+        if symbol not in self.owners:
+            index = bisect(self.hashes, Ring.get_hash(symbol)) % len(self.hashes)
+            self.owners[symbol] = self.replicas[index]
+        return self.owners[symbol]
+
+
+class Membership:
+    """Class for replicas of Processor alive in key value bucket.
+
+    Replica put own key each heartbeat, key of stopped replica expire by
+    ttl of bucket. Ring follow keys on each heartbeat, views of replicas
+    can differ up to one heartbeat, so symbols moved to this replica since
+    last settled ring are not traded for grace seconds after change.
+    """
+
+    def __init__(
+        self: Self,
+        replica: str,
+        heartbeat: float = 5,
+        grace: float = 5,
+    ) -> None:
+        """Init membership of replica, it is alone till first heartbeat."""
+        self.replica: str = replica
+        self.heartbeat: float = heartbeat
+        self.grace: float = grace
+        self.alive: frozenset[str] = frozenset([replica])
+        self.ring = Ring(self.alive)
+        # ring before changes of last grace seconds
+        self.settled_alive: frozenset[str] = self.alive
+        self.settled = self.ring
+        self.changed_at: float = float("-inf")
+        self.kv: KeyValue | None = None
+
+    def is_own(self: Self, symbol: str) -> bool:
+        """Symbol belong to this replica."""
+        return self.ring.get_owner(symbol) == self.replica
+
+    def is_settled(self: Self) -> bool:
+        """Ring did not change for grace seconds."""
+        return monotonic() - self.changed_at >= self.grace
+
+    def was_own(self: Self, symbol: str) -> bool:
+        """Symbol belonged to this replica by settled ring."""
+        return (
+            self.replica in self.settled_alive
+            and self.settled.get_owner(symbol) == self.replica
+        )
+
+    def can_trade(self: Self, symbol: str) -> bool:
+        """Symbol belong to this replica and did not move to it in grace."""
+        return self.is_own(symbol) and (self.is_settled() or self.was_own(symbol))
+
+    def follow(self: Self, alive: frozenset[str]) -> None:
+        """Take ring of alive replicas, keep ring settled before change."""
+        logger.warning(f"Replicas:{sorted(self.alive)}\t-> {sorted(alive)}")
+        if self.is_settled():
+            self.settled_alive, self.settled = self.alive, self.ring
+
+        self.alive, self.ring = alive, Ring(alive)
+        self.changed_at = monotonic()
+
+    async def beat(self: Self, kv: KeyValue) -> None:
+        """Put own key and follow alive replicas."""
+        await kv.put(self.replica, str(time()).encode())
+        alive = frozenset(await kv.keys())
+
+        if alive != self.alive:
+            self.follow(alive)
+
+    async def join(self: Self, js: JetStreamContext) -> None:
+        """Take first heartbeat in bucket of replicas before consume.
+
+        Replica without name stay alone and has no bucket.
+        """
+        if self.replica:
+            self.kv = await js.create_key_value(
+                bucket="processor_replicas",
+                ttl=self.heartbeat * 3,
+            )
+            # other replicas do not know this one yet, it owned nothing
+            self.alive = frozenset()
+            await self.beat(self.kv)
+
+    async def run(self: Self) -> None:
+        """Heartbeat of joined replica till cancel."""
+        if self.kv is not None:
+            await self.keep_alive(self.kv)
+
+    async def try_beat(self: Self, kv: KeyValue) -> None:
+        """Heartbeat, its failure is only logged."""
+        try:
+            await self.beat(kv)
+        except Exception as e:
+            logger.exception(e)
+
+    async def keep_alive(self: Self, kv: KeyValue) -> None:
+        """Heartbeat till cancel, then delete own key.
+
+        Other replicas take symbols of stopped one on next heartbeat
+        without wait of ttl.
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.heartbeat)
+                await self.try_beat(kv)
+        finally:
+            await kv.delete(self.replica)
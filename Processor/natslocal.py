@@ -1,41 +1,235 @@
-"""Nats tools for get js context."""
-
-from loguru import logger
-from nats.aio.client import Client
-from nats.js import JetStreamContext
-
-
-async def disconnected_cb(*args: list) -> None:
-    """CallBack на отключение от nats."""
-    logger.error(f"Got disconnected... {args}")
-
-
-async def reconnected_cb(*args: list) -> None:
-    """CallBack на переподключение к nats."""
-    logger.error(f"Got reconnected... {args}")
-
-
-async def error_cb(excep: Exception) -> None:
-    """CallBack на ошибку подключения к nats."""
-    logger.error(f"Error ... {excep}")
-
-
-async def closed_cb(*args: list) -> None:
-    """CallBack на закрытие подключения к nats."""
-    logger.error(f"Closed ... {args}")
-
-
-async def get_js_context() -> JetStreamContext:
-    """Get JetStream Context."""
-    nc = Client()
-
-    await nc.connect(
-        servers="kcn_nats",
-        max_reconnect_attempts=-1,
-        reconnected_cb=reconnected_cb,
-        disconnected_cb=disconnected_cb,
-        error_cb=error_cb,
-        closed_cb=closed_cb,
-    )
-
-    return nc.jetstream()
+"""Nats tools for get js context."""
+
+import asyncio
+from collections.abc import Awaitable, Callable
+from contextlib import suppress
+from functools import partial
+from typing import Self
+
+from loguru import logger
+from nats.aio.client import Client
+from nats.aio.msg import Msg
+from nats.errors import Error as NatsError
+from nats.js import JetStreamContext
+from nats.js.api import AckPolicy, ConsumerConfig, DeliverPolicy
+from nats.js.errors import BadRequestError, NotFoundError
+
+
+async def disconnected_cb(*args: list) -> None:
+    """CallBack на отключение от nats."""
+    logger.error(f"Got disconnected... {args}")
+
+
+async def reconnected_cb(*args: list) -> None:
+    """CallBack на переподключение к nats."""
+    logger.error(f"Got reconnected... {args}")
+
+
+async def error_cb(excep: Exception) -> None:
+    """CallBack на ошибку подключения к nats."""
+    logger.error(f"Error ... {excep}")
+
+
+async def closed_cb(*args: list) -> None:
+    """CallBack на закрытие подключения к nats."""
+    logger.error(f"Closed ... {args}")
+
+
+async def get_js_context() -> JetStreamContext:
+    """Get JetStream Context."""
+    nc = Client()
+
+    await nc.connect(
+        servers="kcn_nats",
+        max_reconnect_attempts=-1,
+        reconnected_cb=reconnected_cb,
+        disconnected_cb=disconnected_cb,
+        error_cb=error_cb,
+        closed_cb=closed_cb,
+    )
+
+    return nc.jetstream()
+
+
+async def ack_after(handler: Callable[[Msg], Awaitable[None]], msg: Msg) -> None:
+    """Handle message of push consumer and ack it."""
+    await handler(msg)
+    await msg.ack()
+
+
+# Pull consumer wait so many seconds after failed fetch or ack
+FETCH_RETRY_DELAY = 1
+
+# Consumer without subscription so many seconds is removed by server,
+# so consumers of gone replicas do not pile up
+INACTIVE_THRESHOLD = 60 * 60
+
+
+class PushConsumer:
+    """Class for store settings of durable push consumers of replica.
+
+    Each replica has own durable consumers and get all messages of subject.
+    """
+
+    def __init__(self: Self, replica: str = "") -> None:
+        """Init consumers of replica, without replica they are shared."""
+        self.replica: str = replica
+
+    def get_durable(self: Self, subject: str) -> str:
+        """Get durable name of subject, dots and wildcard are not allowed in it."""
+        durable = subject.replace(".", "_").replace("*", "all")
+        return f"{durable}_{self.replica}" if self.replica else durable
+
+    async def subscribe(
+        self: Self,
+        js: JetStreamContext,
+        subject: str,
+        handler: Callable[[Msg], Awaitable[None]],
+        start_sequence: int = 0,
+        deliver_policy: DeliverPolicy = DeliverPolicy.ALL,
+    ) -> None:
+        """Subscribe durable push consumer of subject and ack after handler."""
+        durable = self.get_durable(subject)
+        await js.subscribe(
+            subject,
+            durable,
+            cb=partial(ack_after, handler),
+            config=await get_start_config(
+                js,
+                subject,
+                durable,
+                start_sequence,
+                deliver_policy,
+            ),
+        )
+
+
+class PullConsumer(PushConsumer):
+    """Class for store settings of pull consumers fetched by batch."""
+
+    def __init__(
+        self: Self,
+        batch: int = 256,
+        timeout: float = 1,
+        max_ack_pending: int = 1024,
+        pending_msgs_limit: int = 4096,
+        replica: str = "",
+    ) -> None:
+        """Init settings of fetch and pending limits.
+
+        max_ack_pending limit messages sent by server and not acked,
+        pending_msgs_limit limit messages buffered in client.
+        """
+        super().__init__(replica)
+        self.batch: int = batch
+        self.timeout: float = timeout
+        self.max_ack_pending: int = max_ack_pending
+        self.pending_msgs_limit: int = pending_msgs_limit
+        self.tasks: set[asyncio.Task] = set()
+
+    async def subscribe(
+        self: Self,
+        js: JetStreamContext,
+        subject: str,
+        handler: Callable[[Msg], Awaitable[None]],
+        start_sequence: int = 0,
+        deliver_policy: DeliverPolicy = DeliverPolicy.ALL,
+    ) -> None:
+        """Subscribe durable pull consumer of subject and handle it in task."""
+        durable = f"{self.get_durable(subject)}_pull"
+        consumer_config = await get_start_config(
+            js,
+            subject,
+            durable,
+            start_sequence,
+            deliver_policy,
+        )
+        consumer_config.ack_policy = AckPolicy.ALL
+        consumer_config.max_ack_pending = self.max_ack_pending
+
+        subscription = await js.pull_subscribe(
+            subject,
+            durable=durable,
+            config=consumer_config,
+            pending_msgs_limit=self.pending_msgs_limit,
+        )
+
+        task = asyncio.create_task(self.consume(subscription, handler))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def consume(
+        self: Self,
+        subscription: JetStreamContext.PullSubscription,
+        handler: Callable[[Msg], Awaitable[None]],
+    ) -> None:
+        """Fetch messages by batch and handle them forever."""
+        while True:
+            await self.try_fetch(subscription, handler)
+
+    async def try_fetch(
+        self: Self,
+        subscription: JetStreamContext.PullSubscription,
+        handler: Callable[[Msg], Awaitable[None]],
+    ) -> None:
+        """Fetch and handle one batch.
+
+        Failed fetch or ack, as on deleted consumer or leader change, is
+        logged and repeated after FETCH_RETRY_DELAY.
+        """
+        try:
+            with suppress(TimeoutError):  # no messages while timeout
+                await PullConsumer.handle_batch(
+                    await subscription.fetch(self.batch, timeout=self.timeout),
+                    handler,
+                )
+        except NatsError as e:
+            logger.exception(e)
+            await asyncio.sleep(FETCH_RETRY_DELAY)
+
+    @staticmethod
+    async def handle_batch(
+        msgs: list[Msg],
+        handler: Callable[[Msg], Awaitable[None]],
+    ) -> None:
+        """Handle messages in order and ack all of them by last one."""
+        for msg in msgs:
+            await handler(msg)
+        await msgs[-1].ack()  # AckPolicy.ALL ack messages before it too
+
+
+async def add_stream(js: JetStreamContext, name: str, subjects: list[str]) -> None:
+    """Add stream or update subjects of stream made by older version."""
+    try:
+        await js.add_stream(name=name, subjects=subjects)
+    except BadRequestError:
+        await js.update_stream(name=name, subjects=subjects)
+
+
+async def get_start_config(
+    js: JetStreamContext,
+    subject: str,
+    durable: str,
+    start_sequence: int,
+    deliver_policy: DeliverPolicy = DeliverPolicy.ALL,
+) -> ConsumerConfig:
+    """Get config of durable consumer, it start from start_sequence if not 0.
+
+    Durable consumer with start_sequence is deleted and created again,
+    without it continue from last ack, new one start by deliver_policy.
+    """
+    if start_sequence:
+        with suppress(NotFoundError):
+            await js.delete_consumer(
+                await js.find_stream_name_by_subject(subject),
+                durable,
+            )
+        return ConsumerConfig(
+            deliver_policy=DeliverPolicy.BY_START_SEQUENCE,
+            opt_start_seq=start_sequence,
+            inactive_threshold=INACTIVE_THRESHOLD,
+        )
+    return ConsumerConfig(
+        deliver_policy=deliver_policy,
+        inactive_threshold=INACTIVE_THRESHOLD,
+    )
@@ -0,0 +1,87 @@
+"""Check NumPy sizing of tick against Decimal sizing on random numbers.
+
+Run inside Processor directory: python -m pytest test_sizing.py
+"""
+
+from decimal import Decimal
+from random import Random
+
+import numpy as np
+import pytest
+
+from main import get_side_and_size, get_sides_and_sizes
+from models import Balance, Ledger, Token
+
+SYMBOLS = [f"T{number}-USDT" for number in range(2000)]
+RANDOM_SEEDS = 100  # universes of random numbers checked against Decimal
+
+
+def get_random_decimal(random: Random, digits: int, places: int) -> str:
+    """Get random plain decimal str with up to digits digits."""
+    return str(Decimal(random.randrange(10**digits)).scaleb(-places))
+
+
+def get_random_case(random: Random) -> tuple[str, Decimal, Decimal]:
+    """Get random price, available and baseincrement for sizing.
+
+    Numbers have up to 30 digits, so cases out of int64 math and
+    Decimal rounding are taken too.
+    """
+    return (
+        get_random_decimal(random, random.randint(1, 20), random.randint(0, 12)),
+        Decimal(
+            get_random_decimal(random, random.randint(1, 30), random.randint(0, 20)),
+        ).copy_sign(random.choice((1, 1, -1))),
+        Decimal(1).scaleb(-random.randint(0, 12)) * random.choice((1, 5, 25)),
+    )
+
+
+def is_sized(price: str, data: Balance, token: Token) -> bool:
+    """Decimal get side and size without arithmetic error."""
+    try:
+        get_side_and_size(data, Decimal(price), token)
+    except ArithmeticError:
+        return False
+    return True
+
+
+def get_random_universe(
+    random: Random,
+    token: Token,
+) -> tuple[list[str], list[Balance], np.ndarray]:
+    """Get random prices, balances and scaled rows Decimal size without error."""
+    ledger = Ledger(scaled=True)
+    cases = [(symbol, *get_random_case(random)) for symbol in SYMBOLS]
+    for symbol, _, available, baseincrement in cases:
+        ledger.update(symbol, available, baseincrement)
+
+    sized = [
+        (price, ledger.get(symbol))
+        for symbol, price, _, _ in cases
+        if is_sized(price, ledger.get(symbol), token)
+    ]
+    balances = [data for _, data in sized]
+    return (
+        [price for price, _ in sized],
+        balances,
+        ledger.scaled[[data.symbol_id for data in balances]],
+    )
+
+
+@pytest.mark.parametrize("seed", range(RANDOM_SEEDS))
+def test_random_rebalance(seed: int) -> None:
+    """NumPy and Decimal get the same side and size on random numbers."""
+    random = Random(seed)  # noqa: S311
+    token = Token(
+        currency=[],
+        ignore_currency=[],
+        base_keep=Decimal(
+            get_random_decimal(random, random.randint(0, 30), random.randint(0, 8)),
+        ),
+    )
+    prices, balances, scaled = get_random_universe(random, token)
+
+    assert get_sides_and_sizes(prices, balances, scaled, token) == [
+        get_side_and_size(data, Decimal(price), token)
+        for price, data in zip(prices, balances, strict=True)
+    ]
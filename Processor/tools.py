@@ -1,115 +1,259 @@
-"""Tools for Processor."""
-
-from time import time
-from urllib.parse import urljoin
-from uuid import uuid4
-
-import aiohttp
-from loguru import logger
-from orjson import dumps, loads
-
-from models import Access
-
-
-async def request(
-    url: str,
-    method: str,
-    headers: dict,
-    *,
-    data_json: str | None = None,
-) -> dict:
-    """Universal http reqponse."""
-    async with (
-        aiohttp.ClientSession(headers=headers) as session,
-        session.request(method, url, data=data_json) as response,
-    ):
-        res = await response.read()  # bytes
-        data = loads(res)  # dict ['code':str, 'data':dict]
-
-        match data["code"]:
-            case "200000":
-                result = data["data"]
-                logger.success(f"{response.status}:{method}:{url}")
-            case _:
-                logger.warning(f"{response.status}:{method}:{url}:{headers}")
-                result = {}
-
-        return result
-
-
-def get_headers(
-    access: Access = None,
-    str_to_sign: str = "",
-    now_time: str = "",
-    *,
-    auth: bool = True,
-) -> dict:
-    """Get headers for request."""
-    if auth:
-        result = {
-            "KC-API-SIGN": access.encrypted(str_to_sign),
-            "KC-API-TIMESTAMP": now_time,
-            "KC-API-PASSPHRASE": access.encrypted(access.passphrase),
-            "KC-API-KEY": access.key,
-            "Content-Type": "application/json",
-            "KC-API-KEY-VERSION": "2",
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-    else:
-        result = {
-            "User-Agent": "kucoin-python-sdk/2",
-        }
-
-    return result
-
-
-async def margin_limit_order(
-    access: Access,
-    params: dict,
-    *,
-    method: str = "POST",
-    uri: str = "/api/v1/margin/order",
-) -> dict:
-    """Get all active orders in excange."""
-    logger.info("Run get_order_list")
-
-    now_time = str(int(time()) * 1000)
-
-    data_json = dumps(params).decode()
-
-    return await request(
-        urljoin(access.base_uri, uri),
-        method,
-        get_headers(
-            access,
-            f"{now_time}{method}{uri}{data_json}",
-            now_time,
-        ),
-        data_json=data_json,
-    )
-
-
-async def make_margin_limit_order(
-    access: Access,
-    side: str,
-    price: str,
-    symbol: str,
-    size: str,
-) -> dict:
-    """Make limit order by price."""
-    logger.info(f"Run make_margin_limit_order:{side}:{symbol}")
-
-    return await margin_limit_order(
-        access,
-        {
-            "clientOid": str(uuid4()).replace("-", ""),
-            "side": side,
-            "symbol": symbol,
-            "price": price,
-            "size": size,
-            "type": "limit",
-            "timeInForce": "GTC",
-            "autoBorrow": True,
-            "autoRepay": True,
-        },
-    )
+"""Tools for Processor."""
+
+import asyncio
+from collections.abc import Callable
+from functools import cache, partial
+from time import time
+from urllib.parse import urljoin
+from uuid import uuid4
+
+from loguru import logger
+from orjson import dumps, loads
+
+from models import Access, Clock, HttpClient, RateLimit, Retry
+
+clock = Clock()
+http_client = HttpClient()
+rate_limit = RateLimit()
+retry = Retry()
+
+PUBLIC_HEADERS = {"User-Agent": "kucoin-python-sdk/2"}
+
+# static part of margin limit order body, serialized once
+MARGIN_LIMIT_ORDER_TAIL = dumps(
+    {
+        "type": "limit",
+        "timeInForce": "GTC",
+        "autoBorrow": True,
+        "autoRepay": True,
+    },
+).decode()[1:]
+
+
+async def fetch(
+    url: str,
+    method: str,
+    headers: Callable[[], dict],
+    *,
+    data_json: str | None = None,
+    pool: tuple[str, int] = ("public", 1),
+) -> dict:
+    """Send request once and get full answer of exchange.
+
+    Request wait own weight in rate limit pool, headers signed after wait.
+    """
+    await rate_limit.acquire(*pool)
+
+    async with http_client.get_session().request(
+        method,
+        url,
+        headers=headers(),
+        data=data_json,
+    ) as response:
+        res = await response.read()  # bytes
+        data = loads(res)  # dict ['code':str, 'data':dict]
+        rate_limit.update(pool[0], response.headers, data["code"])
+        logger.debug(f"{response.status}:{method}:{url}:{data['code']}")
+
+        return data
+
+
+async def request(
+    url: str,
+    method: str,
+    headers: Callable[[], dict],
+    *,
+    data_json: str | None = None,
+    pool: tuple[str, int] = ("public", 1),
+) -> dict:
+    """Universal http reqponse.
+
+    Retryable answers repeated by retry policy with the same body, so order
+    with clientOid is idempotent-safe and can't be filled twice.
+    """
+    data = await retry.run(
+        partial(
+            fetch,
+            url,
+            method,
+            headers,
+            data_json=data_json,
+            pool=pool,
+        ),
+        idempotent=method != "POST" or '"clientOid"' in (data_json or ""),
+    )
+
+    match data["code"]:
+        case "200000":
+            result = data["data"]
+            logger.success(f"{method}:{url}")
+        case _:
+            logger.warning(f"{method}:{url}:{data}")
+            result = {}
+
+    return result
+
+
+@cache
+def get_url(base_uri: str, uri: str) -> str:
+    """Get full url of endpoint, joined once."""
+    return urljoin(base_uri, uri)
+
+
+def get_headers(
+    access: Access = None,
+    str_to_sign: str = "",
+    *,
+    auth: bool = True,
+) -> dict:
+    """Get headers for request.
+
+    str_to_sign is method, uri and body of request without timestamp.
+    """
+    if auth:
+        result = access.get_auth_headers(str_to_sign, clock.get_timestamp())
+    else:
+        result = PUBLIC_HEADERS
+
+    return result
+
+
+def get_margin_limit_order_body(
+    client_oid: str,
+    side: str,
+    symbol: str,
+    price: str,
+    size: str,
+) -> str:
+    """Get serialized body of margin limit order by precompiled template."""
+    return (
+        f'{{"clientOid":"{client_oid}","side":"{side}","symbol":"{symbol}",'
+        f'"price":"{price}","size":"{size}",{MARGIN_LIMIT_ORDER_TAIL}'
+    )
+
+
+async def margin_limit_order(
+    access: Access,
+    data_json: str,
+    *,
+    method: str = "POST",
+    uri: str = "/api/v1/margin/order",
+    pool: tuple[str, int] = ("margin", 5),  # rate limit pool and weight
+) -> dict:
+    """Get all active orders in excange."""
+    logger.info("Run get_order_list")
+
+    return await request(
+        get_url(access.base_uri, uri),
+        method,
+        partial(get_headers, access, f"{method}{uri}{data_json}"),
+        pool=pool,
+        data_json=data_json,
+    )
+
+
+async def make_margin_limit_order(
+    access: Access,
+    side: str,
+    price: str,
+    symbol: str,
+    size: str,
+) -> dict:
+    """Make limit order by price."""
+    logger.info(f"Run make_margin_limit_order:{side}:{symbol}")
+
+    return await margin_limit_order(
+        access,
+        get_margin_limit_order_body(
+            client_oid=uuid4().hex,
+            side=side,
+            symbol=symbol,
+            price=price,
+            size=size,
+        ),
+    )
+
+
+async def make_margin_limit_order_in_limit(
+    access: Access,
+    order: dict,
+    semaphore: asyncio.Semaphore,
+) -> dict:
+    """Make limit order while count of orders in flight is limited."""
+    async with semaphore:
+        return await make_margin_limit_order(access, **order)
+
+
+async def make_margin_limit_orders(
+    access: Access,
+    orders: list[dict],
+    semaphore: asyncio.Semaphore,
+) -> list[dict]:
+    """Make limit orders of batch.
+
+    Exchange has no multi orders endpoint for margin, so orders of batch
+    placed by single requests in parallel. Failed order logged and get {}.
+    """
+    results = await asyncio.gather(
+        *[
+            make_margin_limit_order_in_limit(access, order, semaphore)
+            for order in orders
+        ],
+        return_exceptions=True,
+    )
+
+    for result in results:
+        log_exception(result)
+
+    return [{} if isinstance(result, Exception) else result for result in results]
+
+
+def log_exception(result: object) -> None:
+    """Log result if it is exception."""
+    if isinstance(result, Exception):
+        logger.opt(exception=result).error(f"Order failed:{result!r}")
+
+
+async def get_server_timestamp(
+    access: Access,
+    *,
+    uri: str = "/api/v1/timestamp",
+    method: str = "GET",
+    pool: tuple[str, int] = ("public", 3),  # rate limit pool and weight
+) -> dict:
+    """Get timestamp from excange server."""
+    logger.info("Run get_server_timestamp")
+
+    return await request(
+        urljoin(access.base_uri, uri),
+        method,
+        partial(get_headers, auth=False),
+        pool=pool,
+    )
+
+
+async def update_clock(access: Access) -> None:
+    """Add one sample of server time to clock."""
+    sent_at = time() * 1000
+    server_time = await get_server_timestamp(access)
+    received_at = time() * 1000
+
+    if server_time:
+        clock.add_sample(server_time, sent_at, received_at)
+        logger.info(f"Clock offset:{clock.offset:.0f} ms")
+
+
+async def init_clock(access: Access, samples: int = 3) -> None:
+    """Take first samples of server time one by one for fast start."""
+    for _ in range(samples):
+        await update_clock(access)
+
+
+async def sync_clock(access: Access, interval: int = 60) -> None:
+    """Sync clock with exchange server in infinity loop.
+
+    Sample by interval also keep pooled connection to exchange warm.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await update_clock(access)